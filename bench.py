@@ -0,0 +1,356 @@
+"""
+Офлайн-бенчмарк бота: синтетические обновления подаются прямо в
+Dispatcher.feed_update с настоящим router из main.py, а запросы к Bot API
+обрабатывает заглушка сессии с имитацией задержки сети и ответов 429.
+
+Запуск:
+    python bench.py                       # все сценарии
+    python bench.py -s menu -u 2000       # один сценарий
+    python bench.py --latency 0.05 --flood-rate 0.01 --alloc
+    python bench.py -s api --transport default   # HTTP-сессия против локального mock-сервера Bot API
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+SCENARIOS = ("menu", "dialog_storm", "mass_expiry", "api")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработчиков бота")
+    parser.add_argument("-s", "--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("-u", "--users", type=int, default=500, help="Число синтетических клиентов")
+    parser.add_argument("-m", "--messages", type=int, default=5, help="Сообщений на клиента в dialog_storm")
+    parser.add_argument("-c", "--concurrency", type=int, default=32, help="Одновременно обрабатываемых обновлений")
+    parser.add_argument("--latency", type=float, default=0.0, help="Средняя задержка ответа Bot API, секунды")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="Доля запросов, получающих 429")
+    parser.add_argument("--send-rate", type=float, default=1e6, help="SEND_GLOBAL_RATE/SEND_CHAT_RATE для очереди")
+    parser.add_argument("--alloc", action="store_true", help="Считать выделения памяти (tracemalloc, медленнее)")
+    parser.add_argument("--transport", choices=("aiohttp", "httpx", "default"), default="aiohttp",
+                        help="Сессия для сценария api (default — AiohttpSession aiogram без настроек)")
+    return parser.parse_args()
+
+
+ARGS = parse_args()
+
+# Конфигурация main.py читается при импорте — задаём её заранее
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("MANAGER_ID", "1000")
+os.environ["SEND_GLOBAL_RATE"] = str(ARGS.send_rate)
+os.environ["SEND_CHAT_RATE"] = str(ARGS.send_rate)
+os.environ["SEND_CHAT_BURST"] = str(max(int(ARGS.send_rate), 1))
+os.environ["COALESCE_DELAY"] = "0"
+# Сценарии повторяют действия одних и тех же клиентов — защита от флуда исказила бы замер
+os.environ["THROTTLE_RATE"] = os.environ["THROTTLE_BURST"] = str(max(int(ARGS.send_rate), 1))
+os.environ["DIALOG_REQUEST_COOLDOWN"] = os.environ["CALL_REQUEST_COOLDOWN"] = "0"
+if ARGS.transport != "default":
+    os.environ["API_TRANSPORT"] = ARGS.transport
+
+import logging
+
+logging.disable(logging.INFO)
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.base import BaseSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Chat, Message, MessageId, Update, User
+
+import main
+
+MANAGER_ID = main.MANAGER_IDS[0]
+
+
+# ============================================
+# 🧪 ЗАГЛУШКА BOT API
+# ============================================
+
+class StubSession(BaseSession):
+    """Сессия без сети: записывает вызовы, имитирует задержку и ответы 429"""
+
+    def __init__(self, latency: float, flood_rate: float):
+        super().__init__()
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.calls: Counter[str] = Counter()
+        self.floods = 0
+        self._ids = itertools.count(1_000_000)
+
+    async def close(self) -> None:
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def make_request(self, bot: Bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        if self.flood_rate and random.random() < self.flood_rate:
+            self.floods += 1
+            raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=1)
+        return self._result(name, method)
+
+    def _result(self, name: str, method):
+        if name == "CopyMessages":
+            return [MessageId(message_id=next(self._ids)) for _ in method.message_ids]
+        if name == "CopyMessage":
+            return MessageId(message_id=next(self._ids))
+        if name == "GetMe":
+            return User(id=1, is_bot=True, first_name="bench", username="bench_bot")
+        if name.startswith("Send") or name == "EditMessageText":
+            chat_id = getattr(method, "chat_id", 0)
+            return Message(message_id=next(self._ids), date=0, chat=Chat(id=chat_id, type="private"))
+        return True
+
+
+# ============================================
+# 🧬 СИНТЕТИЧЕСКИЕ ОБНОВЛЕНИЯ
+# ============================================
+
+_update_ids = itertools.count(1)
+
+
+def message_update(user_id: int, text: str) -> Update:
+    update_id = next(_update_ids)
+    return Update(update_id=update_id, message={
+        "message_id": update_id,
+        "date": 0,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}"},
+        "text": text,
+    })
+
+
+def callback_update(user_id: int, data: str) -> Update:
+    update_id = next(_update_ids)
+    return Update(update_id=update_id, callback_query={
+        "id": str(update_id),
+        "chat_instance": "bench",
+        "data": data,
+        "from": {"id": user_id, "is_bot": False, "first_name": "Manager"},
+        "message": {"message_id": update_id, "date": 0, "chat": {"id": user_id, "type": "private"}, "text": "…"},
+    })
+
+
+def menu_updates(users: int) -> list[Update]:
+    """Клиенты листают меню"""
+    texts = ["/start", "ℹ️ О компании", "⬅️ Назад", "💰 Прайс материалов", "⬅️ Назад", "что-то непонятное"]
+    return [message_update(10_000 + u, text) for u in range(users) for text in texts]
+
+
+def dialog_request_updates(users: int) -> list[Update]:
+    return [message_update(10_000 + u, "💬 Начать диалог с менеджером") for u in range(users)]
+
+
+def dialog_accept_updates(users: int) -> list[Update]:
+    return [
+        callback_update(MANAGER_ID, main.DialogRequestCallback(action="accept", client_id=10_000 + u).pack())
+        for u in range(users)
+    ]
+
+
+def dialog_message_updates(users: int, messages: int) -> list[Update]:
+    return [message_update(10_000 + u, f"сообщение {i}") for i in range(messages) for u in range(users)]
+
+
+# ============================================
+# ⏱️ ПРОГОН СЦЕНАРИЕВ
+# ============================================
+
+class Result:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: list[float] = []
+        self.elapsed = 0.0
+        self.drain = 0.0
+        self.alloc_kib = 0.0
+        self.errors = 0
+        self.api_calls: int | None = None  # Для сценариев, которые ходят не через заглушку
+        self.connections: int | None = None
+
+
+async def feed(dp: Dispatcher, bot: Bot, updates: list[Update], result: Result) -> None:
+    """Подаёт обновления в диспетчер с ограничением параллельности, как при polling"""
+    semaphore = asyncio.Semaphore(ARGS.concurrency)
+
+    async def one(update: Update) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:
+                # Например, 429 на прямом вызове API из обработчика
+                result.errors += 1
+            result.latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(u) for u in updates))
+    result.elapsed += time.perf_counter() - started
+
+
+async def drain() -> float:
+    started = time.perf_counter()
+    await main.outbox.close(timeout=600)
+    main.outbox.start(main.outbox.bot)
+    return time.perf_counter() - started
+
+
+async def reset_state(dp: Dispatcher) -> None:
+    main.dialog_store = main.MemoryDialogStore()
+    main.dialog_expiry = main.ExpiryQueue(main.DIALOG_TIMEOUT)
+    main.manager_pool = main.ManagerPool(main.MANAGER_IDS, main.MANAGER_STRATEGY, main.MANAGER_CAPACITY)
+    main.dialog_requests = main.DialogRequests(main.DIALOG_REQUEST_TTL)
+    dp.fsm.storage = MemoryStorage()
+
+
+async def scenario_menu(dp: Dispatcher, bot: Bot) -> Result:
+    result = Result("menu")
+    await feed(dp, bot, menu_updates(ARGS.users), result)
+    result.drain = await drain()
+    return result
+
+
+async def scenario_dialog_storm(dp: Dispatcher, bot: Bot) -> Result:
+    result = Result("dialog_storm")
+    await feed(dp, bot, dialog_request_updates(ARGS.users), result)
+    await feed(dp, bot, dialog_accept_updates(ARGS.users), result)
+    await feed(dp, bot, dialog_message_updates(ARGS.users, ARGS.messages), result)
+    result.drain = await drain()
+    return result
+
+
+async def scenario_mass_expiry(dp: Dispatcher, bot: Bot) -> Result:
+    """Все диалоги истекают одновременно; измеряется время до отправки всех уведомлений"""
+    result = Result("mass_expiry")
+    await feed(dp, bot, dialog_request_updates(ARGS.users), Result("setup"))
+    await feed(dp, bot, dialog_accept_updates(ARGS.users), Result("setup"))
+    await drain()
+    bot.session.calls.clear()
+
+    timeout, main.DIALOG_TIMEOUT = main.DIALOG_TIMEOUT, 0
+    main.dialog_expiry.ttl = 0
+    for client_id, record in (await main.dialog_store.all()).items():
+        main.dialog_store._dialogs[client_id] = main.DialogRecord(last_active=0, manager_id=record.manager_id)
+        main.dialog_expiry.touch(client_id, 0)
+
+    started = time.perf_counter()
+    task = asyncio.create_task(main.cleanup_inactive_dialogs(bot))
+    while await main.dialog_store.count():
+        await asyncio.sleep(0.001)
+    result.elapsed = time.perf_counter() - started
+    task.cancel()
+    main.DIALOG_TIMEOUT = timeout
+    result.latencies = [result.elapsed / max(ARGS.users, 1)] * ARGS.users
+    result.drain = await drain()
+    return result
+
+
+async def scenario_api(dp: Dispatcher, bot: Bot) -> Result:
+    """sendMessage через настоящую HTTP-сессию к локальному mock-серверу Bot API"""
+    result = Result(f"api/{ARGS.transport}")
+    protocols = set()
+    message_ids = itertools.count(1)
+
+    async def handle(request: web.Request) -> web.Response:
+        # Каждое соединение обслуживается своим экземпляром протокола
+        protocols.add(request.protocol)
+        if ARGS.latency:
+            await asyncio.sleep(random.expovariate(1 / ARGS.latency))
+        data = await request.post()
+        return web.json_response({"ok": True, "result": {
+            "message_id": next(message_ids), "date": 0,
+            "chat": {"id": int(data.get("chat_id", 0)), "type": "private"}, "text": data.get("text", ""),
+        }})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    api = TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")
+    session = AiohttpSession(api=api) if ARGS.transport == "default" else main.build_session(api=api)
+    api_bot = Bot(token=os.environ["BOT_TOKEN"], session=session)
+    semaphore = asyncio.Semaphore(ARGS.concurrency)
+
+    async def one(user_id: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await api_bot.send_message(user_id, "bench")
+            except Exception:
+                result.errors += 1
+            result.latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(10_000 + u) for u in range(ARGS.users) for _ in range(ARGS.messages)))
+    result.elapsed = time.perf_counter() - started
+    result.api_calls = len(result.latencies)
+    result.connections = len(protocols)
+    await session.close()
+    await runner.cleanup()
+    return result
+
+
+def report(result: Result, session: StubSession) -> None:
+    latencies = sorted(result.latencies) or [0.0]
+    count = len(result.latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    line = (
+        f"{result.name:<13} обновлений: {count:>7}  "
+        f"{count / result.elapsed if result.elapsed else 0:>9.0f} upd/s  "
+        f"p50 {statistics.median(latencies) * 1000:>7.3f} мс  "
+        f"p99 {p99 * 1000:>7.3f} мс  "
+        f"очередь {result.drain:>6.2f} с  "
+        f"API {sum(session.calls.values()) if result.api_calls is None else result.api_calls:>7} "
+        f"(429: {session.floods})  "
+        f"ошибок {result.errors}"
+    )
+    if result.connections is not None:
+        line += f"  соединений {result.connections}"
+    if ARGS.alloc:
+        line += f"  память {result.alloc_kib / max(count, 1):>6.2f} КиБ/обн."
+    print(line)
+
+
+async def run() -> None:
+    session = StubSession(ARGS.latency, ARGS.flood_rate)
+    bot = Bot(token=os.environ["BOT_TOKEN"], session=session)
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.include_router(main.router)
+    main.outbox.start(bot)
+
+    scenarios = SCENARIOS if ARGS.scenario == "all" else (ARGS.scenario,)
+    print(f"Python {sys.version.split()[0]}, клиентов: {ARGS.users}, параллельность: {ARGS.concurrency}, "
+          f"задержка API: {ARGS.latency * 1000:.0f} мс, доля 429: {ARGS.flood_rate:.2%}")
+    for name in scenarios:
+        await reset_state(dp)
+        session.calls.clear()
+        session.floods = 0
+        if ARGS.alloc:
+            tracemalloc.start()
+        result = await globals()[f"scenario_{name}"](dp, bot)
+        if ARGS.alloc:
+            result.alloc_kib = tracemalloc.get_traced_memory()[1] / 1024
+            tracemalloc.stop()
+        report(result, session)
+
+    await main.outbox.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
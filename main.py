@@ -1,638 +1,4844 @@
-import os
-import logging
-from datetime import datetime, timedelta
-from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import (
-    Message,
-    KeyboardButton,
-    ReplyKeyboardMarkup,
-    Contact,
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-    CallbackQuery  # 🔑 КРИТИЧЕСКИ ВАЖНЫЙ ИМПОРТ
-)
-from aiogram.filters import CommandStart
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-import asyncio
-
-# ============================================
-# 🔧 КОНФИГУРАЦИЯ
-# ============================================
-
-load_dotenv()
-
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-MANAGER_ID = int(os.getenv("MANAGER_ID", "0"))
-
-if not BOT_TOKEN or MANAGER_ID == 0:
-    raise ValueError("❌ Отсутствуют обязательные переменные окружения: BOT_TOKEN или MANAGER_ID")
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-)
-logger = logging.getLogger(__name__)
-
-# ============================================
-# 📋 ДАННЫЕ БОТА
-# ============================================
-
-PRICE_LIST = {
-    "💧 Картриджи и фильтрующие элементы":[],
-    "🌀 Картридж из нетканного полипропилена BB10 — 330 ₽": [
-        "Глубинная очистка от механических примесей: песок, ржавчина, илистые частицы"
-    ],
-    "⚫ Картридж из прессованного активированного угля BB20 — 1 100 ₽": [
-        "Удаление хлора, органики, неприятных запахов и привкусов",
-    ],
-    "🧂 Соль таблетированная для систем умягчения (мешок 25 кг) — от 875 ₽": [
-        "Высокая степень очистки, не содержит примесей, идеальна для регенерации ионообменных смол"
-    ],
-    "🛠️ Сервисное обслуживание систем очистки воды, всего — от 4 000 р.": []
-}
-
-COMPANY_INFO = """💧 Аквафреска — ваш эксперт в сфере водоочистки в Санкт-Петербурге и Ленинградской области! 🌊
-📍 Наше основное направление — профессиональная очистка воды из:
-• 🕳️ Скважин
-• 🪣 Колодцев
-• 🌊 Открытых источников
-• 🏠 Центрального водоснабжения
-❤️ Мы понимаем, насколько важны безопасность и качество воды для здоровья вашей семьи 👨‍👩‍👧‍👦 и бесперебойной работы предприятия 🏢. Поэтому мы используем передовые технологии ⚙️ и инновационные системы фильтрации 🔬, которые гарантируют полное удаление всех видов загрязнений:
-🚫 Эффективно удаляем:
-• 💎 Жёсткость воды
-• ⚫ Железо (двух- и трёхвалентное)
-• 🟣 Растворённый марганец
-• 🦠 Бактерии и микроорганизмы
-• ⚠️ Другие вещества, превышающие нормативы СанПиН
-🏭 Промышленная водоподготовка:
-Мы специализируемся на решениях для предприятий пищевой промышленности 🥫, котельных 🔥 и промышленных производств ⚙️. Каждая система разрабатывается индивидуально 📐✨ под ваши технические требования и производственные задачи.
-✅ Почему выбирают «Аквафреска»?
-• 🏆 10+ лет опыта работы в водоочистке СПб и ЛО
-• 🔬 Сертифицированное оборудование проверенных временем брендов
-• 👷‍♂️ Собственная сервисная служб
-• 💰 Честные цены без скрытых платежей
-• 📜 Гарантия до 3 лет на оборудование и монтажные работы
-📞 Свяжитесь с нами уже сегодня!
-Наши инженеры-экологи бесплатно проконсультируют вас и подберут оптимальное решение 💧✨ для чистой, безопасной и приятной на вкус воды.
-🌟 Вы заслуживаете чистую воду — «Аквафреска» сделает её такой! 💧💙"""
-
-# ============================================
-# 🧠 FSM И ХРАНИЛИЩЕ ДИАЛОГОВ
-# ============================================
-
-class DialogState(StatesGroup):
-    in_dialog = State()  # Клиент находится в активном диалоге с менеджером
-
-# Хранилище активных диалогов: {client_id: timestamp_последней_активности}
-active_dialogs = {}
-
-# ============================================
-# 🎨 ФУНКЦИИ СОЗДАНИЯ КЛАВИАТУР
-# ============================================
-
-def get_main_menu() -> ReplyKeyboardMarkup:
-    """Главное меню"""
-    keyboard = [
-        [KeyboardButton(text="ℹ️ О компании"), KeyboardButton(text="💰 Прайс материалов")],
-        [KeyboardButton(text="💬 Начать диалог с менеджером"), KeyboardButton(text="📞 Заказать звонок")]
-    ]
-    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True, input_field_placeholder="Выберите действие")
-
-def get_dialog_menu() -> ReplyKeyboardMarkup:
-    """Меню во время диалога с менеджером"""
-    keyboard = [[KeyboardButton(text="⏹️ Завершить диалог")]]
-    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True, input_field_placeholder="Пишите сообщение менеджеру...")
-
-def get_back_menu() -> ReplyKeyboardMarkup:
-    """Клавиатура с кнопкой «Назад»"""
-    keyboard = [[KeyboardButton(text="⬅️ Назад")]]
-    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
-
-def get_contact_request_menu() -> ReplyKeyboardMarkup:
-    """Клавиатура для отправки контакта"""
-    keyboard = [
-        [KeyboardButton(text="📱 Отправить контакт", request_contact=True)],
-        [KeyboardButton(text="⬅️ Назад")]
-    ]
-    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
-
-def get_manager_accept_keyboard(client_id: int) -> InlineKeyboardMarkup:
-    """Inline-кнопки для менеджера: принять/отклонить диалог"""
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="✅ Принять", callback_data=f"accept_{client_id}"),
-            InlineKeyboardButton(text="❌ Отклонить", callback_data=f"reject_{client_id}")
-        ]
-    ])
-    return keyboard
-
-# ============================================
-# 🤖 ОСНОВНЫЕ ОБРАБОТЧИКИ
-# ============================================
-
-router = Router()
-
-@router.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext) -> None:
-    """Стартовая команда"""
-    await state.clear()
-    client_id = message.from_user.id
-    
-    # Если клиент в активном диалоге — продолжаем диалог
-    if client_id in active_dialogs:
-        await state.set_state(DialogState.in_dialog)
-        await message.answer(
-            "💬 Вы возобновили диалог с менеджером.\n"
-            "Все ваши сообщения будут пересылаться менеджеру.\n"
-            "Нажмите «⏹️ Завершить диалог», чтобы выйти.",
-            reply_markup=get_dialog_menu()
-        )
-        return
-    
-    greeting = (
-        "👋 Добро пожаловать в *«Аквафреска»*!\n\n"
-        "Ваш эксперт в сфере водоочистки в Санкт-Петербурге и Ленинградской области! 🌊\n"
-        "Выберите действие ниже 👇"
-    )
-    await message.answer(greeting, reply_markup=get_main_menu(), parse_mode="Markdown")
-
-@router.message(F.text == "⬅️ Назад")
-async def back_to_menu(message: Message, state: FSMContext) -> None:
-    """Возврат в главное меню"""
-    client_id = message.from_user.id
-    
-    # Если клиент в диалоге — завершаем диалог при нажатии «Назад»
-    if client_id in active_dialogs:
-        del active_dialogs[client_id]
-        await state.clear()
-        await message.answer(
-            "ℹ️ Диалог с менеджером завершён.\n"
-            "Вы вернулись в главное меню.",
-            reply_markup=get_main_menu()
-        )
-        # Уведомляем менеджера
-        try:
-            await message.bot.send_message(
-                chat_id=MANAGER_ID,
-                text=f"ℹ️ Клиент {client_id} завершил диалог."
-            )
-        except:
-            pass
-        return
-    
-    await state.clear()
-    await message.answer("↩️ Вы вернулись в главное меню", reply_markup=get_main_menu())
-
-@router.message(F.text == "ℹ️ О компании")
-async def about_company(message: Message, state: FSMContext) -> None:
-    """Показать информацию о компании"""
-    client_id = message.from_user.id
-    if client_id in active_dialogs:
-        await message.answer("⚠️ Сначала завершите диалог с менеджером.", reply_markup=get_dialog_menu())
-        return
-    
-    await message.answer(COMPANY_INFO, reply_markup=get_back_menu(), parse_mode="Markdown")
-
-@router.message(F.text == "💰 Прайс материалов")
-async def show_price_list(message: Message, state: FSMContext) -> None:
-    """Показать прайс-лист"""
-    client_id = message.from_user.id
-    if client_id in active_dialogs:
-        await message.answer("⚠️ Сначала завершите диалог с менеджером.", reply_markup=get_dialog_menu())
-        return
-    
-    price_text = "📊 *Прайс-лист на расходные материалы для водоочистки*\n\n"
-    
-    for category, items in PRICE_LIST.items():
-        price_text += f"*{category}*\n"
-        for item in items:
-            price_text += f"{item}\n"
-        price_text += "\n"
-    
-    await message.answer(price_text, reply_markup=get_back_menu(), parse_mode="Markdown")
-
-@router.message(F.text == "📞 Заказать звонок")
-async def request_contact(message: Message, state: FSMContext) -> None:
-    """Запросить контакт для звонка"""
-    client_id = message.from_user.id
-    if client_id in active_dialogs:
-        await message.answer("⚠️ Сначала завершите диалог с менеджером.", reply_markup=get_dialog_menu())
-        return
-    
-    await message.answer(
-        "📱 Нажмите кнопку ниже, чтобы отправить свой номер телефона.\n"
-        "Менеджер перезвонит вам в течение 30 минут.",
-        reply_markup=get_contact_request_menu()
-    )
-
-@router.message(F.contact)
-async def handle_contact(message: Message, state: FSMContext) -> None:
-    """Обработка полученного контакта"""
-    contact: Contact = message.contact
-    phone = contact.phone_number
-    user_name = contact.first_name or "Пользователь"
-    client_id = message.from_user.id
-    
-    # Формируем сообщение для менеджера
-    manager_msg = (
-        f"🔔 *Новая заявка на звонок!*\n"
-        f"👤 Имя: {user_name}\n"
-        f"📱 Телефон: +{phone}\n"
-        f"🆔 ID пользователя: {client_id}"
-    )
-    
-    try:
-        await message.bot.send_message(
-            chat_id=MANAGER_ID,
-            text=manager_msg,
-            parse_mode="Markdown"
-        )
-        logger.info(f"Заявка на звонок от {client_id} отправлена менеджеру")
-    except Exception as e:
-        logger.error(f"Ошибка отправки заявки менеджеру: {e}")
-        await message.answer("⚠️ Не удалось отправить заявку. Попробуйте позже.", reply_markup=get_main_menu())
-        return
-    
-    await message.answer(
-        "✅ Заявка на звонок принята!\n"
-        "Менеджер перезвонит вам в течение 30 минут.",
-        reply_markup=get_main_menu()
-    )
-    await state.clear()
-
-# ============================================
-# 💬 СИСТЕМА ДИАЛОГА С МЕНЕДЖЕРОМ
-# ============================================
-
-@router.message(F.text == "💬 Начать диалог с менеджером")
-async def start_dialog_request(message: Message, state: FSMContext) -> None:
-    """Запрос на начало диалога с менеджером"""
-    client_id = message.from_user.id
-    
-    # Проверяем, не в диалоге ли уже клиент
-    if client_id in active_dialogs:
-        await message.answer(
-            "💬 Вы уже находитесь в диалоге с менеджером.\n"
-            "Все ваши сообщения пересылаются менеджеру.",
-            reply_markup=get_dialog_menu()
-        )
-        await state.set_state(DialogState.in_dialog)
-        return
-    
-    # Отправляем запрос менеджеру
-    username = f"@{message.from_user.username}" if message.from_user.username else "не указан"
-    request_msg = (
-        f"💬 *Новый запрос на диалог!*\n"
-        f"👤 Имя: {message.from_user.full_name}\n"
-        f"🆔 ID: `{client_id}`\n"
-        f"🔗 Username: {username}\n\n"
-        f"Нажмите ✅ чтобы начать диалог"
-    )
-    
-    try:
-        await message.bot.send_message(
-            chat_id=MANAGER_ID,
-            text=request_msg,
-            parse_mode="Markdown",
-            reply_markup=get_manager_accept_keyboard(client_id)
-        )
-        logger.info(f"Запрос на диалог от {client_id} отправлен менеджеру")
-    except Exception as e:
-        logger.error(f"Ошибка отправки запроса менеджеру: {e}")
-        await message.answer(
-            "⚠️ Менеджер временно недоступен. Попробуйте позже или закажите звонок.",
-            reply_markup=get_main_menu()
-        )
-        return
-    
-    await message.answer(
-        "⏳ Ожидайте подключения менеджера...\n"
-        "Как только менеджер примет запрос, вы сможете общаться в реальном времени.",
-        reply_markup=get_back_menu()
-    )
-
-@router.callback_query(F.data.startswith("accept_"))
-async def accept_dialog(callback: CallbackQuery, state: FSMContext) -> None:
-    """Менеджер принял запрос на диалог"""
-    client_id = int(callback.data.split("_")[1])
-    
-    # Проверяем, не завершил ли клиент диалог за это время
-    if client_id not in active_dialogs:
-        active_dialogs[client_id] = datetime.now()
-    
-    # Уведомляем менеджера
-    await callback.message.edit_text(
-        f"✅ Диалог с клиентом {client_id} начат.\n"
-        f"Все ваши сообщения будут пересылаться клиенту.\n"
-        f"Чтобы завершить диалог, напишите /стоп_{client_id}"
-    )
-    
-    # Уведомляем клиента
-    try:
-        await callback.bot.send_message(
-            chat_id=client_id,
-            text="✅ Менеджер подключился к диалогу!\n"
-                 "Теперь вы можете общаться в реальном времени.\n"
-                 "Все сообщения будут доставлены мгновенно.",
-            reply_markup=get_dialog_menu()
-        )
-        # Устанавливаем состояние диалога для клиента
-        # Нужно получить состояние клиента через отдельный экземпляр FSMContext
-        # Для простоты используем глобальное состояние через роутер
-        # В реальном проекте лучше использовать отдельное хранилище состояний
-    except Exception as e:
-        logger.error(f"Не удалось уведомить клиента {client_id}: {e}")
-        await callback.bot.send_message(
-            chat_id=MANAGER_ID,
-            text=f"⚠️ Клиент {client_id} заблокировал бота или недоступен."
-        )
-        if client_id in active_dialogs:
-            del active_dialogs[client_id]
-        return
-    
-    logger.info(f"Диалог между клиентом {client_id} и менеджером начат")
-    await callback.answer()
-
-@router.callback_query(F.data.startswith("reject_"))
-async def reject_dialog(callback: CallbackQuery) -> None:
-    """Менеджер отклонил запрос на диалог"""
-    client_id = int(callback.data.split("_")[1])
-    
-    # Уведомляем клиента
-    try:
-        await callback.bot.send_message(
-            chat_id=client_id,
-            text="❌ Менеджер временно занят.\n"
-                 "Попробуйте начать диалог позже или закажите обратный звонок.",
-            reply_markup=get_main_menu()
-        )
-    except:
-        pass  # Клиент может быть недоступен
-    
-    # Уведомляем менеджера
-    await callback.message.edit_text(f"❌ Запрос от клиента {client_id} отклонён")
-    await callback.answer()
-    logger.info(f"Запрос на диалог от {client_id} отклонён менеджером")
-
-@router.message(F.text == "⏹️ Завершить диалог")
-async def end_dialog_by_client(message: Message, state: FSMContext) -> None:
-    """Клиент завершил диалог"""
-    client_id = message.from_user.id
-    
-    if client_id in active_dialogs:
-        del active_dialogs[client_id]
-        await state.clear()
-        
-        # Уведомляем менеджера
-        try:
-            await message.bot.send_message(
-                chat_id=MANAGER_ID,
-                text=f"ℹ️ Клиент {client_id} завершил диалог."
-            )
-        except:
-            pass
-        
-        await message.answer(
-            "✅ Диалог с менеджером завершён.\n"
-            "Спасибо за обращение! Возвращайтесь в главное меню.",
-            reply_markup=get_main_menu()
-        )
-        logger.info(f"Клиент {client_id} завершил диалог")
-    else:
-        await message.answer("ℹ️ Диалог уже завершён.", reply_markup=get_main_menu())
-        await state.clear()
-
-@router.message(DialogState.in_dialog)
-async def forward_client_message_to_manager(message: Message, state: FSMContext) -> None:
-    """Пересылка сообщений клиента менеджеру во время диалога"""
-    client_id = message.from_user.id
-    
-    # Проверяем, активен ли диалог
-    if client_id not in active_dialogs:
-        await state.clear()
-        await message.answer("ℹ️ Диалог завершён. Начните новый диалог через главное меню.", reply_markup=get_main_menu())
-        return
-    
-    # Обновляем время последней активности
-    active_dialogs[client_id] = datetime.now()
-    
-    # Формируем префикс для сообщения
-    prefix = f"👤 Клиент {client_id}"
-    if message.from_user.username:
-        prefix += f" (@{message.from_user.username})"
-    prefix += ":\n\n"
-    
-    try:
-        if message.text:
-            await message.bot.send_message(
-                chat_id=MANAGER_ID,
-                text=f"{prefix}{message.text}"
-            )
-        elif message.photo:
-            await message.bot.send_photo(
-                chat_id=MANAGER_ID,
-                photo=message.photo[-1].file_id,
-                caption=f"{prefix}{message.caption or ''}"
-            )
-        elif message.document:
-            await message.bot.send_document(
-                chat_id=MANAGER_ID,
-                document=message.document.file_id,
-                caption=f"{prefix}{message.caption or ''}"
-            )
-        else:
-            await message.answer("⚠️ Поддерживаются только текст, фото и документы.")
-            return
-        
-        logger.info(f"Сообщение от клиента {client_id} переслано менеджеру")
-    except Exception as e:
-        logger.error(f"Ошибка пересылки сообщения менеджеру: {e}")
-        await message.answer(
-            "⚠️ Менеджер временно недоступен. Попробуйте позже.",
-            reply_markup=get_main_menu()
-        )
-        if client_id in active_dialogs:
-            del active_dialogs[client_id]
-        await state.clear()
-
-@router.message(F.from_user.id == MANAGER_ID)
-async def forward_manager_message_to_client(message: Message) -> None:
-    """
-    Обработка сообщений от менеджера:
-    1. Если сообщение начинается с /стоп_{id} — завершаем диалог
-    2. Если сообщение начинается с /чат_{id} — пересылаем клиенту
-    3. Если менеджер отвечает через reply — пересылаем клиенту
-    """
-    bot = message.bot
-    text = message.text or ""
-    
-    # Обработка команды /стоп_{id}
-    if text.startswith("/стоп_"):
-        try:
-            client_id = int(text.split("_")[1])
-            if client_id in active_dialogs:
-                del active_dialogs[client_id]
-                await bot.send_message(
-                    chat_id=client_id,
-                    text="ℹ️ Менеджер завершил диалог.\n"
-                         "Спасибо за обращение! Возвращайтесь в главное меню.",
-                    reply_markup=get_main_menu()
-                )
-                await message.answer(f"✅ Диалог с клиентом {client_id} завершён.")
-                logger.info(f"Менеджер завершил диалог с клиентом {client_id}")
-            else:
-                await message.answer(f"⚠️ Клиент {client_id} не в активном диалоге.")
-        except (IndexError, ValueError):
-            await message.answer("⚠️ Неверный формат команды. Используйте: /стоп_123456789")
-        return
-    
-    # Обработка команды /чат_{id} для явного указания клиента
-    if text.startswith("/чат_"):
-        try:
-            parts = text.split(" ", 1)
-            client_id = int(parts[0].split("_")[1])
-            real_text = parts[1] if len(parts) > 1 else ""
-            
-            if client_id in active_dialogs:
-                await bot.send_message(
-                    chat_id=client_id,
-                    text=f"👤 *Менеджер ответил:*\n\n{real_text}",
-                    parse_mode="Markdown"
-                )
-                await message.answer(f"✅ Сообщение отправлено клиенту {client_id}.")
-                logger.info(f"Менеджер отправил сообщение клиенту {client_id}")
-            else:
-                await message.answer(f"⚠️ Клиент {client_id} не в активном диалоге.")
-        except (IndexError, ValueError):
-            await message.answer("⚠️ Неверный формат команды. Используйте: /чат_123456789 текст сообщения")
-        return
-    
-    # Если менеджер отвечает на сообщение клиента через reply
-    if message.reply_to_message:
-        # Извлекаем ID клиента из текста сообщения, на которое ответил менеджер
-        reply_text = message.reply_to_message.text or ""
-        # Ищем паттерн "Клиент 123456789"
-        import re
-        match = re.search(r"Клиент (\d+)", reply_text)
-        if match:
-            client_id = int(match.group(1))
-            if client_id in active_dialogs:
-                # Отправляем сообщение клиенту
-                try:
-                    if message.text:
-                        await bot.send_message(
-                            chat_id=client_id,
-                            text=f"👤 *Менеджер ответил:*\n\n{message.text}",
-                            parse_mode="Markdown"
-                        )
-                    elif message.photo:
-                        await bot.send_photo(
-                            chat_id=client_id,
-                            photo=message.photo[-1].file_id,
-                            caption=f"👤 *Менеджер ответил:*\n\n{message.caption or ''}",
-                            parse_mode="Markdown"
-                        )
-                    elif message.document:
-                        await bot.send_document(
-                            chat_id=client_id,
-                            document=message.document.file_id,
-                            caption=f"👤 *Менеджер ответил:*\n\n{message.caption or ''}",
-                            parse_mode="Markdown"
-                        )
-                    await message.answer(f"✅ Ответ отправлен клиенту {client_id}.")
-                    logger.info(f"Менеджер ответил клиенту {client_id}")
-                except Exception as e:
-                    await message.answer(f"❌ Не удалось отправить сообщение клиенту {client_id}: {e}")
-                return
-    
-    # Подсказка менеджеру
-    active_clients = list(active_dialogs.keys())
-    hint = "ℹ️ Чтобы ответить клиенту:\n"
-    if active_clients:
-        hint += f"• Нажмите «ответить» на его сообщение, ИЛИ\n"
-        hint += f"• Напишите /чат_{active_clients[0]} ваше сообщение\n"
-        hint += f"\nАктивные диалоги: {', '.join(map(str, active_clients))}"
-    else:
-        hint += "Нет активных диалогов."
-    
-    await message.answer(hint)
-
-@router.message()
-async def unknown_message(message: Message, state: FSMContext) -> None:
-    """Обработка неизвестных команд"""
-    client_id = message.from_user.id
-    
-    # Если клиент в диалоге — пересылаем сообщение менеджеру
-    if client_id in active_dialogs:
-        await forward_client_message_to_manager(message, state)
-        return
-    
-    await message.answer(
-        "❓ Я понимаю только команды из меню.\n"
-        "Выберите действие ниже 👇",
-        reply_markup=get_main_menu()
-    )
-
-# ============================================
-# 🧹 ФОНОВАЯ ЗАДАЧА: ОЧИСТКА НЕАКТИВНЫХ ДИАЛОГОВ
-# ============================================
-
-async def cleanup_inactive_dialogs(bot: Bot):
-    """Удаляет диалоги без активности более 1 часа"""
-    while True:
-        await asyncio.sleep(300)  # Проверяем каждые 5 минут
-        now = datetime.now()
-        inactive_clients = [
-            client_id for client_id, last_active in active_dialogs.items()
-            if (now - last_active) > timedelta(hours=1)
-        ]
-        
-        for client_id in inactive_clients:
-            del active_dialogs[client_id]
-            try:
-                await bot.send_message(
-                    chat_id=client_id,
-                    text="ℹ️ Диалог автоматически завершён из-за неактивности.\n"
-                         "Чтобы начать новый диалог, нажмите «💬 Начать диалог с менеджером».",
-                    reply_markup=get_main_menu()
-                )
-            except:
-                pass
-            logger.info(f"Неактивный диалог с клиентом {client_id} завершён автоматически")
-
-# ============================================
-# 🚀 ЗАПУСК БОТА
-# ============================================
-
-async def main() -> None:
-    bot = Bot(token=BOT_TOKEN)
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
-    dp.include_router(router)
-    
-    await bot.delete_webhook(drop_pending_updates=True)
-    
-    bot_info = await bot.get_me()
-    logger.info(f"Бот запущен: @{bot_info.username} (ID: {bot_info.id})")
-    logger.info(f"ID менеджера: {MANAGER_ID}")
-    logger.info("💡 Инструкция для менеджера:\n"
-                "• Чтобы ответить клиенту — нажмите «ответить» на его сообщение\n"
-                "• Чтобы завершить диалог — напишите /стоп_123456789\n"
-                "• Чтобы написать клиенту напрямую — /чат_123456789 текст")
-    
-    # Запускаем фоновую задачу очистки неактивных диалогов
-    asyncio.create_task(cleanup_inactive_dialogs(bot))
-    
-    await dp.start_polling(bot)
-
-if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        logger.info("Бот остановлен пользователем")
-    except Exception as e:
-        logger.error(f"Критическая ошибка: {e}")
+import time
+STARTED_AT = time.perf_counter()  # Отсчёт времени холодного запуска (до импорта aiogram)
+
+import os
+import base64
+import functools
+import hashlib
+import heapq
+import hmac
+import html
+import inspect
+import json
+import logging
+import re
+import signal
+import sys
+import tempfile
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict, deque
+from contextlib import suppress
+from dataclasses import dataclass, asdict, field
+from typing import TYPE_CHECKING, Any, Awaitable, Callable
+from aiohttp import ClientError, ClientTimeout, FormData, TCPConnector
+from dotenv import load_dotenv
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F, __version__ as aiogram_version
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import (
+    Message,
+    BufferedInputFile,
+    InputFile,
+    FSInputFile,
+    KeyboardButton,
+    ReplyKeyboardMarkup,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    MessageId,
+    CallbackQuery  # 🔑 КРИТИЧЕСКИ ВАЖНЫЙ ИМПОРТ
+)
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter
+from aiogram.methods import (
+    AnswerCallbackQuery, CopyMessage, CopyMessages, EditMessageText, PinChatMessage, SendAnimation, SendAudio,
+    SendDocument, SendMessage, SendPhoto, SendSticker, SendVideo, SendVideoNote, SendVoice, TelegramMethod
+)
+from aiogram.filters.callback_data import CallbackData
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+import asyncio
+
+if TYPE_CHECKING:
+    # Модули необязательных возможностей импортируются при их запуске: HTTP-сервер (webhook
+    # и метрики), SQLite (хранилища на диске) и gzip (снимок состояния)
+    import sqlite3
+    from aiohttp import web
+
+# ============================================
+# 🔧 КОНФИГУРАЦИЯ
+# ============================================
+
+load_dotenv()
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+MANAGER_ID = int(os.getenv("MANAGER_ID", "0"))
+# Пул менеджеров: MANAGER_IDS=111,222,333 (по умолчанию — единственный MANAGER_ID)
+MANAGER_IDS = [int(m) for m in os.getenv("MANAGER_IDS", "").split(",") if m.strip()] or [MANAGER_ID]
+MANAGER_STRATEGY = os.getenv("MANAGER_STRATEGY", "least_active")  # least_active | round_robin | sticky
+MANAGER_CAPACITY = int(os.getenv("MANAGER_CAPACITY", "0"))  # Диалогов на менеджера одновременно (0 — без ограничения)
+DIALOG_TIMEOUT = int(os.getenv("DIALOG_TIMEOUT", "3600"))  # Секунды неактивности до автозавершения диалога
+
+# Хранилище состояния диалогов: memory | sqlite | redis
+DIALOG_BACKEND = os.getenv("DIALOG_BACKEND", "memory")
+DIALOG_DB_PATH = os.getenv("DIALOG_DB_PATH", "dialogs.db")
+DIALOG_FLUSH_INTERVAL = float(os.getenv("DIALOG_FLUSH_INTERVAL", "1.0"))  # Период пакетной записи в SQLite
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Ограничения исходящих сообщений (лимиты Telegram: ~30 сообщений/с всего, ~1 сообщение/с в один чат)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "4"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))  # Рабочие задачи отдельной полосы отправки медиа
+
+# Режим получения обновлений: polling | webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))  # Одновременно обрабатываемых обновлений
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))  # Буфер принятых, но не обработанных обновлений
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "10"))
+
+# Шардированный режим: WORKERS процессов-обработчиков за общим приёмником обновлений (1 — один процесс)
+WORKERS = int(os.getenv("WORKERS", "1"))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "-1"))  # Номер обработчика; задаёт супервизор, вручную не указывается
+# Каталог Unix-сокетов обработчиков (по умолчанию — во временном каталоге, отдельный для каждого бота)
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR", "") or os.path.join(
+    tempfile.gettempdir(), f"tgbot-{(BOT_TOKEN or '').split(':')[0]}"
+)
+# Учёт менеджеров, запросов, панелей, заявок, рассылки и фоновые задачи ведёт один процесс:
+# единственный или обработчик №0; остальные обработчики передают ему изменения этого учёта
+IS_COORDINATOR = SHARD_INDEX <= 0
+
+# Индекс ответов менеджера: сколько пересланных сообщений помнить и как долго
+REPLY_INDEX_SIZE = int(os.getenv("REPLY_INDEX_SIZE", "50000"))
+REPLY_INDEX_TTL = int(os.getenv("REPLY_INDEX_TTL", str(7 * 24 * 3600)))
+
+# Окно склейки сообщений клиента перед пересылкой менеджеру, секунды (0 — пересылать сразу)
+COALESCE_DELAY = float(os.getenv("COALESCE_DELAY", "0.7"))
+
+# Пересылка медиа: если копирование не удалось, файл отправляется по file_id, а в крайнем случае
+# скачивается и загружается заново. Кэш file_unique_id -> file_id сохраняется в снимке состояния
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", "10000"))
+MEDIA_TRANSFERS = int(os.getenv("MEDIA_TRANSFERS", "4"))  # Одновременных повторных загрузок небольших файлов
+MEDIA_LARGE_TRANSFERS = int(os.getenv("MEDIA_LARGE_TRANSFERS", "1"))  # ...и крупных
+MEDIA_LARGE_FILE = int(os.getenv("MEDIA_LARGE_FILE", str(5 * 1024 * 1024)))  # Крупнее — через временный файл, а не в памяти
+MEDIA_CHUNK_SIZE = int(os.getenv("MEDIA_CHUNK_SIZE", str(256 * 1024)))  # Размер части при скачивании и загрузке
+MEDIA_TEMP_DIR = os.getenv("MEDIA_TEMP_DIR", "") or os.path.join(
+    tempfile.gettempdir(), f"tgbot-media-{(BOT_TOKEN or '').split(':')[0]}"
+)
+
+# Метрики в формате Prometheus (METRICS_PORT=0 — не запускать HTTP-сервер метрик)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# HTTP-сессия Bot API: пул keep-alive соединений, кэш DNS и тайм-ауты
+API_TRANSPORT = os.getenv("API_TRANSPORT", "aiohttp")  # aiohttp | httpx (HTTP/2, нужны пакеты httpx и h2)
+API_POOL_SIZE = int(os.getenv("API_POOL_SIZE", "100"))  # Одновременных соединений с Bot API
+API_KEEPALIVE = float(os.getenv("API_KEEPALIVE", "60"))  # Сколько держать простаивающее соединение, секунды
+API_DNS_TTL = int(os.getenv("API_DNS_TTL", "3600"))  # Время жизни кэша DNS, секунды
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "5"))  # Установка соединения
+API_TIMEOUT = float(os.getenv("API_TIMEOUT", "60"))  # Запрос целиком, если для метода не задано иное
+# Тайм-ауты отдельных методов: sendMessage=10,copyMessages=20 (загрузка файлов остаётся с API_TIMEOUT)
+API_METHOD_TIMEOUTS = {
+    method.strip(): float(seconds)
+    for method, _, seconds in (
+        item.partition("=") for item in os.getenv(
+            "API_METHOD_TIMEOUTS",
+            "sendMessage=10,editMessageText=10,editMessageReplyMarkup=10,answerCallbackQuery=5,"
+            "copyMessage=15,copyMessages=20,pinChatMessage=10,getMe=10"
+        ).split(",") if item.strip()
+    )
+}
+# Каталог (прайс и информация о компании) из JSON/YAML-файла; пустая строка — встроенные PRICE_LIST и COMPANY_INFO
+CATALOG_PATH = os.getenv("CATALOG_PATH", "")
+CATALOG_WATCH_INTERVAL = float(os.getenv("CATALOG_WATCH_INTERVAL", "5"))  # Период проверки файла каталога, секунды
+# История переписки: SQLite с WAL и полнотекстовым индексом FTS5 (пустая строка — не вести)
+TRANSCRIPT_DB_PATH = os.getenv("TRANSCRIPT_DB_PATH", "transcripts.db")
+TRANSCRIPT_FLUSH_INTERVAL = float(os.getenv("TRANSCRIPT_FLUSH_INTERVAL", "1.0"))  # Период пакетной записи
+TRANSCRIPT_BATCH_SIZE = int(os.getenv("TRANSCRIPT_BATCH_SIZE", "500"))  # Записать раньше, если накопилось столько
+TRANSCRIPT_PAGE_SIZE = int(os.getenv("TRANSCRIPT_PAGE_SIZE", "10"))  # Сообщений на странице /история
+# Реестр клиентов (все, кто нажимал /start) и рассылки по нему; пустая строка — не вести
+USERS_DB_PATH = os.getenv("USERS_DB_PATH", "users.db")
+USERS_FLUSH_INTERVAL = float(os.getenv("USERS_FLUSH_INTERVAL", "1.0"))  # Период пакетной записи реестра
+USERS_BATCH_SIZE = int(os.getenv("USERS_BATCH_SIZE", "500"))  # Записать раньше, если накопилось столько
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "200"))  # Получателей, читаемых из базы за раз
+# Заявки на звонок: база, окно дедупликации по номеру и обещанный срок звонка, секунды
+LEADS_DB_PATH = os.getenv("LEADS_DB_PATH", "leads.db")
+LEADS_FLUSH_INTERVAL = float(os.getenv("LEADS_FLUSH_INTERVAL", "1.0"))  # Период пакетной записи заявок
+LEADS_BATCH_SIZE = int(os.getenv("LEADS_BATCH_SIZE", "500"))  # Записать раньше, если накопилось столько
+LEAD_DEDUP_WINDOW = int(os.getenv("LEAD_DEDUP_WINDOW", "86400"))
+LEAD_SLA = int(os.getenv("LEAD_SLA", "1800"))
+# Больше LEAD_DIGEST_THRESHOLD заявок за LEAD_DIGEST_INTERVAL секунд — новые приходят менеджерам
+# одной сводкой раз в интервал, а не по одной (LEAD_DIGEST_INTERVAL=0 — всегда по одной)
+LEAD_DIGEST_INTERVAL = float(os.getenv("LEAD_DIGEST_INTERVAL", "300"))
+LEAD_DIGEST_THRESHOLD = int(os.getenv("LEAD_DIGEST_THRESHOLD", "10"))
+# Панель менеджера: диалогов на странице и задержка, за которую склеиваются обновления панели
+DASHBOARD_PAGE_SIZE = int(os.getenv("DASHBOARD_PAGE_SIZE", "10"))
+DASHBOARD_DEBOUNCE = float(os.getenv("DASHBOARD_DEBOUNCE", "3"))
+# Защита от флуда: сообщений в секунду от одного клиента и допустимый всплеск
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", "5"))
+# Повторный запрос диалога и заявка на звонок от одного клиента — не чаще, секунды
+DIALOG_REQUEST_COOLDOWN = float(os.getenv("DIALOG_REQUEST_COOLDOWN", "30"))
+CALL_REQUEST_COOLDOWN = float(os.getenv("CALL_REQUEST_COOLDOWN", "60"))
+DIALOG_REQUEST_TTL = int(os.getenv("DIALOG_REQUEST_TTL", "600"))  # Сколько неотвеченный запрос диалога считается ожидающим
+# По умолчанию накопившиеся обновления не сбрасываются при перезапуске
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0") == "1"
+# Ключ подписи данных inline-кнопок; по умолчанию выводится из BOT_TOKEN (одинаков во всех процессах)
+CALLBACK_SECRET = os.getenv("CALLBACK_SECRET", "")
+# Снимок состояния при остановке, восстанавливается при следующем запуске (пустая строка — не сохранять)
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "state.json.gz")
+
+if not BOT_TOKEN or 0 in MANAGER_IDS:
+    raise ValueError("❌ Отсутствуют обязательные переменные окружения: BOT_TOKEN или MANAGER_ID/MANAGER_IDS")
+
+if MANAGER_STRATEGY not in ("least_active", "round_robin", "sticky"):
+    raise ValueError(f"❌ Неизвестная MANAGER_STRATEGY: {MANAGER_STRATEGY}")
+
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    raise ValueError("❌ Для BOT_MODE=webhook укажите WEBHOOK_URL")
+
+if MEDIA_WORKERS < 1 or MEDIA_TRANSFERS < 1 or MEDIA_LARGE_TRANSFERS < 1:
+    raise ValueError("❌ MEDIA_WORKERS, MEDIA_TRANSFERS и MEDIA_LARGE_TRANSFERS должны быть не меньше 1")
+
+if API_TRANSPORT not in ("aiohttp", "httpx"):
+    raise ValueError(f"❌ Неизвестный API_TRANSPORT: {API_TRANSPORT}")
+
+if WORKERS > 1 and DIALOG_BACKEND != "redis":
+    raise ValueError("❌ Для WORKERS > 1 нужно общее хранилище состояния: DIALOG_BACKEND=redis")
+
+if SHARD_INDEX >= 0 and METRICS_PORT:
+    # Порты метрик — по номеру обработчика; глобальный лимит отправки обработчики делят через Redis
+    METRICS_PORT += SHARD_INDEX
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(name)s - "
+           + (f"[#{SHARD_INDEX}] " if SHARD_INDEX >= 0 else "") + "%(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# ============================================
+# 📋 ДАННЫЕ БОТА
+# ============================================
+
+PRICE_LIST = {
+    "💧 Картриджи и фильтрующие элементы":[],
+    "🌀 Картридж из нетканного полипропилена BB10 — 330 ₽": [
+        "Глубинная очистка от механических примесей: песок, ржавчина, илистые частицы"
+    ],
+    "⚫ Картридж из прессованного активированного угля BB20 — 1 100 ₽": [
+        "Удаление хлора, органики, неприятных запахов и привкусов",
+    ],
+    "🧂 Соль таблетированная для систем умягчения (мешок 25 кг) — от 875 ₽": [
+        "Высокая степень очистки, не содержит примесей, идеальна для регенерации ионообменных смол"
+    ],
+    "🛠️ Сервисное обслуживание систем очистки воды, всего — от 4 000 р.": []
+}
+
+COMPANY_INFO = """💧 Аквафреска — ваш эксперт в сфере водоочистки в Санкт-Петербурге и Ленинградской области! 🌊
+📍 Наше основное направление — профессиональная очистка воды из:
+• 🕳️ Скважин
+• 🪣 Колодцев
+• 🌊 Открытых источников
+• 🏠 Центрального водоснабжения
+❤️ Мы понимаем, насколько важны безопасность и качество воды для здоровья вашей семьи 👨‍👩‍👧‍👦 и бесперебойной работы предприятия 🏢. Поэтому мы используем передовые технологии ⚙️ и инновационные системы фильтрации 🔬, которые гарантируют полное удаление всех видов загрязнений:
+🚫 Эффективно удаляем:
+• 💎 Жёсткость воды
+• ⚫ Железо (двух- и трёхвалентное)
+• 🟣 Растворённый марганец
+• 🦠 Бактерии и микроорганизмы
+• ⚠️ Другие вещества, превышающие нормативы СанПиН
+🏭 Промышленная водоподготовка:
+Мы специализируемся на решениях для предприятий пищевой промышленности 🥫, котельных 🔥 и промышленных производств ⚙️. Каждая система разрабатывается индивидуально 📐✨ под ваши технические требования и производственные задачи.
+✅ Почему выбирают «Аквафреска»?
+• 🏆 10+ лет опыта работы в водоочистке СПб и ЛО
+• 🔬 Сертифицированное оборудование проверенных временем брендов
+• 👷‍♂️ Собственная сервисная служб
+• 💰 Честные цены без скрытых платежей
+• 📜 Гарантия до 3 лет на оборудование и монтажные работы
+📞 Свяжитесь с нами уже сегодня!
+Наши инженеры-экологи бесплатно проконсультируют вас и подберут оптимальное решение 💧✨ для чистой, безопасной и приятной на вкус воды.
+🌟 Вы заслуживаете чистую воду — «Аквафреска» сделает её такой! 💧💙"""
+
+# ============================================
+# 🛰️ ВЫЗОВЫ КООРДИНАТОРА
+# ============================================
+
+# Функции, которые выполняются только координатором: имя -> функция
+coordinator_calls: dict[str, Callable[..., Any]] = {}
+# Соединение с координатором; задаётся в обработчиках шардированного режима, кроме №0
+coordinator_link: "ShardLink | None" = None
+
+
+def on_coordinator(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Декоратор учёта, который ведёт координатор (пул менеджеров, запросы, панели, заявки).
+
+    В единственном процессе и в координаторе функция вызывается как обычно.
+    В остальных обработчиках вызов с JSON-аргументами ставится в очередь
+    координатору и выполняется там в порядке отправки, а обработчик сразу
+    продолжает работу, не дожидаясь результата.
+    """
+    coordinator_calls[func.__name__] = func
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def call_async(*args: Any) -> Any:
+            if coordinator_link is None:
+                return await func(*args)
+            coordinator_link.call(func.__name__, args)
+        return call_async
+
+    @functools.wraps(func)
+    def call(*args: Any) -> Any:
+        if coordinator_link is None:
+            return func(*args)
+        coordinator_link.call(func.__name__, args)
+    return call
+
+
+async def run_coordinator_call(name: str, args: list) -> None:
+    """Выполняет в координаторе вызов, присланный другим обработчиком"""
+    try:
+        result = coordinator_calls[name](*args)
+        if inspect.isawaitable(result):
+            await result
+    except Exception as e:
+        logger.error(f"Ошибка вызова {name} от обработчика: {e}")
+
+# ============================================
+# 🧠 FSM И ХРАНИЛИЩЕ ДИАЛОГОВ
+# ============================================
+
+class DialogState(StatesGroup):
+    in_dialog = State()  # Клиент находится в активном диалоге с менеджером
+
+@dataclass
+class DialogRecord:
+    """Состояние активного диалога"""
+    last_active: float  # Время последней активности (unix time)
+    manager_id: int = 0  # Менеджер, принявший диалог
+
+    def dump(self) -> str:
+        return json.dumps(asdict(self), separators=(",", ":"))
+
+    @classmethod
+    def load(cls, raw: str | bytes) -> "DialogRecord":
+        return cls(**json.loads(raw))
+
+
+class DialogStore(ABC):
+    """Интерфейс хранилища активных диалогов: {client_id: DialogRecord}"""
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    async def get(self, client_id: int) -> DialogRecord | None: ...
+
+    @abstractmethod
+    async def put(self, client_id: int, record: DialogRecord) -> None: ...
+
+    @abstractmethod
+    async def delete(self, client_id: int) -> bool:
+        """Удаляет диалог; возвращает True, если он существовал"""
+
+    @abstractmethod
+    async def all(self) -> dict[int, DialogRecord]: ...
+
+    async def count(self) -> int:
+        return len(await self.all())
+
+
+class MemoryDialogStore(DialogStore):
+    """Хранилище в памяти процесса (теряется при перезапуске)"""
+
+    def __init__(self):
+        self._dialogs: dict[int, DialogRecord] = {}
+
+    async def get(self, client_id: int) -> DialogRecord | None:
+        return self._dialogs.get(client_id)
+
+    async def put(self, client_id: int, record: DialogRecord) -> None:
+        self._dialogs[client_id] = record
+
+    async def delete(self, client_id: int) -> bool:
+        return self._dialogs.pop(client_id, None) is not None
+
+    async def all(self) -> dict[int, DialogRecord]:
+        return dict(self._dialogs)
+
+    async def count(self) -> int:
+        return len(self._dialogs)
+
+
+class SQLiteDialogStore(MemoryDialogStore):
+    """Локальный SQLite с отложенной пакетной записью.
+
+    Чтения обслуживаются из памяти, изменения накапливаются и раз в
+    DIALOG_FLUSH_INTERVAL секунд записываются одной транзакцией в фоновом потоке.
+    """
+
+    def __init__(self, path: str, flush_interval: float = DIALOG_FLUSH_INTERVAL):
+        super().__init__()
+        self.path = path
+        self.flush_interval = flush_interval
+        self._dirty: set[int] = set()
+        self._db: "sqlite3.Connection | None" = None
+        self._flusher: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        import sqlite3
+
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS dialogs (client_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        for client_id, data in self._db.execute("SELECT client_id, data FROM dialogs"):
+            self._dialogs[client_id] = DialogRecord.load(data)
+        self._flusher = asyncio.create_task(self._flush_loop())
+        logger.info(f"Загружено диалогов из {self.path}: {len(self._dialogs)}")
+
+    async def close(self) -> None:
+        if self._flusher:
+            self._flusher.cancel()
+        await self.flush()
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    async def put(self, client_id: int, record: DialogRecord) -> None:
+        await super().put(client_id, record)
+        self._dirty.add(client_id)
+
+    async def delete(self, client_id: int) -> bool:
+        self._dirty.add(client_id)
+        return await super().delete(client_id)
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения одной транзакцией"""
+        if not self._dirty or not self._db:
+            return
+        dirty, self._dirty = self._dirty, set()
+        upserts = [(cid, self._dialogs[cid].dump()) for cid in dirty if cid in self._dialogs]
+        deletes = [(cid,) for cid in dirty if cid not in self._dialogs]
+        await asyncio.to_thread(self._write, upserts, deletes)
+
+    def _write(self, upserts: list, deletes: list) -> None:
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO dialogs (client_id, data) VALUES (?, ?)", upserts)
+            self._db.executemany("DELETE FROM dialogs WHERE client_id = ?", deletes)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи диалогов в {self.path}: {e}")
+
+
+class RedisDialogStore(DialogStore):
+    """Общее хранилище в Redis-хэше для нескольких процессов бота.
+
+    Подходит любой асинхронный клиент с командами HGET/HSET/HDEL/HGETALL/HLEN
+    (redis.asyncio.Redis или совместимая локальная заглушка).
+    """
+
+    def __init__(self, client, key: str = "tgbot:dialogs"):
+        self.client = client
+        self.key = key
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisDialogStore":
+        try:
+            from redis.asyncio import Redis
+        except ImportError:
+            raise ValueError("❌ Для DIALOG_BACKEND=redis установите пакет redis")
+        return cls(Redis.from_url(url))
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+    async def get(self, client_id: int) -> DialogRecord | None:
+        raw = await self.client.hget(self.key, str(client_id))
+        return DialogRecord.load(raw) if raw is not None else None
+
+    async def put(self, client_id: int, record: DialogRecord) -> None:
+        await self.client.hset(self.key, str(client_id), record.dump())
+
+    async def delete(self, client_id: int) -> bool:
+        return bool(await self.client.hdel(self.key, str(client_id)))
+
+    async def all(self) -> dict[int, DialogRecord]:
+        raw = await self.client.hgetall(self.key)
+        return {int(k): DialogRecord.load(v) for k, v in raw.items()}
+
+    async def count(self) -> int:
+        return await self.client.hlen(self.key)
+
+
+def build_dialog_store() -> DialogStore:
+    """Создаёт хранилище диалогов согласно DIALOG_BACKEND"""
+    if DIALOG_BACKEND == "memory":
+        return MemoryDialogStore()
+    if DIALOG_BACKEND == "sqlite":
+        return SQLiteDialogStore(DIALOG_DB_PATH)
+    if DIALOG_BACKEND == "redis":
+        return RedisDialogStore.from_url(REDIS_URL)
+    raise ValueError(f"❌ Неизвестный DIALOG_BACKEND: {DIALOG_BACKEND}")
+
+
+# Хранилище активных диалогов (заменяется в main() согласно конфигурации)
+dialog_store: DialogStore = MemoryDialogStore()
+
+
+class ExpiryQueue:
+    """Очередь сроков истечения на min-heap: обрабатываются только записи, чей срок наступил"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._heap: list[tuple[float, int]] = []
+        self._deadlines: dict[int, float] = {}  # Актуальный срок для каждого ключа
+        self._wakeup = asyncio.Event()
+        self.expired_total = 0  # Увеличивается обработчиком истёкших записей
+
+    @property
+    def pending(self) -> int:
+        """Количество записей, ожидающих истечения"""
+        return len(self._deadlines)
+
+    def touch(self, key: int, since: float | None = None) -> None:
+        """Продлевает срок записи: O(log n), старая запись в куче становится устаревшей"""
+        deadline = (since or time.time()) + self.ttl
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        # Устаревшие записи удаляются лениво; если их накопилось слишком много — перестраиваем кучу
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(d, k) for k, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+        # Будим планировщик, только если новый срок оказался ближайшим
+        if self._heap[0] == (deadline, key):
+            self._wakeup.set()
+
+    def discard(self, key: int) -> None:
+        """Снимает запись с учёта (запись в куче будет пропущена при извлечении)"""
+        self._deadlines.pop(key, None)
+
+    def pop_due(self, now: float) -> list[int]:
+        """Извлекает все ключи, срок которых наступил к моменту now"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                due.append(key)
+        return due
+
+    async def wait_due(self) -> list[int]:
+        """Спит до ближайшего срока и возвращает истёкшие ключи"""
+        while True:
+            now = time.time()
+            due = self.pop_due(now)
+            if due:
+                return due
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class ManagerPool:
+    """Пул менеджеров: выбор менеджера для нового диалога, учёт нагрузки и очередь ожидания.
+
+    Стратегии (MANAGER_STRATEGY):
+    • least_active — менеджер с наименьшим числом активных диалогов и
+      предложенных ему, но ещё не принятых запросов;
+    • round_robin — по кругу;
+    • sticky — тот же менеджер, что вёл клиента раньше (если он свободен).
+    Если все менеджеры заняты (MANAGER_CAPACITY), запрос ждёт в очереди и
+    предлагается первому освободившемуся менеджеру. Отправленный менеджеру
+    запрос занимает у него место до принятия, отклонения или истечения —
+    иначе всплеск запросов достался бы одному менеджеру сверх его лимита.
+    """
+
+    STICKY_LIMIT = 10000
+
+    def __init__(self, manager_ids: list[int], strategy: str, capacity: int):
+        self.manager_ids = list(manager_ids)
+        self.strategy = strategy
+        self.capacity = capacity
+        self.load: dict[int, int] = dict.fromkeys(self.manager_ids, 0)
+        self.offered: dict[int, int] = dict.fromkeys(self.manager_ids, 0)  # Запросы, ожидающие ответа менеджера
+        self._sticky: OrderedDict[int, int] = OrderedDict()  # client_id -> последний менеджер
+        self._next = 0  # Позиция round-robin
+        self.waiting: OrderedDict[int, str] = OrderedDict()  # client_id -> текст запроса
+
+    def is_manager(self, user_id: int) -> bool:
+        return user_id in self.load
+
+    def busy(self, manager_id: int) -> int:
+        """Активные диалоги менеджера вместе с предложенными ему запросами"""
+        return self.load.get(manager_id, 0) + self.offered.get(manager_id, 0)
+
+    def has_capacity(self, manager_id: int, own_offer: bool = False) -> bool:
+        """Есть ли у менеджера место; own_offer — место уже занято принимаемым запросом"""
+        return not self.capacity or self.busy(manager_id) - own_offer < self.capacity
+
+    def least_loaded(self) -> int:
+        """Наименее загруженный менеджер без учёта лимита (для заявок на звонок)"""
+        return min(self.manager_ids, key=self.load.__getitem__)
+
+    def pick(self, client_id: int) -> int | None:
+        """Выбирает менеджера для нового диалога; None — все заняты"""
+        free = [m for m in self.manager_ids if self.has_capacity(m)]
+        if not free:
+            return None
+        if self.strategy == "sticky" and self._sticky.get(client_id) in free:
+            return self._sticky[client_id]
+        if self.strategy == "round_robin":
+            for _ in range(len(self.manager_ids)):
+                manager_id = self.manager_ids[self._next % len(self.manager_ids)]
+                self._next += 1
+                if manager_id in free:
+                    return manager_id
+        return min(free, key=self.busy)
+
+    def offer(self, manager_id: int) -> None:
+        """Занимает место под отправленный менеджеру запрос"""
+        if manager_id in self.offered:
+            self.offered[manager_id] += 1
+
+    def withdraw(self, manager_id: int) -> None:
+        """Освобождает место запроса: он принят, отклонён или истёк"""
+        if manager_id in self.offered:
+            self.offered[manager_id] = max(0, self.offered[manager_id] - 1)
+
+    def bind(self, client_id: int, manager_id: int) -> None:
+        self.load[manager_id] = self.load.get(manager_id, 0) + 1
+        self._sticky[client_id] = manager_id
+        self._sticky.move_to_end(client_id)
+        if len(self._sticky) > self.STICKY_LIMIT:
+            self._sticky.popitem(last=False)
+
+    def release(self, manager_id: int) -> None:
+        if manager_id in self.load:
+            self.load[manager_id] = max(0, self.load[manager_id] - 1)
+
+    def rebuild(self, dialogs: dict[int, "DialogRecord"]) -> None:
+        """Пересчитывает нагрузку по восстановленным диалогам"""
+        self.load = dict.fromkeys(self.manager_ids, 0)
+        for client_id, record in dialogs.items():
+            if record.manager_id in self.load:
+                self.bind(client_id, record.manager_id)
+
+    def enqueue(self, client_id: int, request_text: str) -> int:
+        """Ставит запрос в очередь ожидания; возвращает позицию в очереди"""
+        self.waiting[client_id] = request_text
+        return list(self.waiting).index(client_id) + 1
+
+    def cancel(self, client_id: int) -> bool:
+        return self.waiting.pop(client_id, None) is not None
+
+
+@dataclass
+class DialogRequest:
+    """Запрос клиента на диалог, отправленный менеджеру и ещё не отвеченный"""
+    manager_id: int
+    created: float  # unix time
+    messages: list[tuple[int, int]] = field(default_factory=list)  # (чат, message_id) сообщений с кнопками
+
+
+class DialogRequests:
+    """Ожидающие ответа запросы на диалог: {client_id: DialogRequest}.
+
+    Один клиент — не больше одного запроса: повторное нажатие не рассылает
+    новых уведомлений. Запрос живёт DIALOG_REQUEST_TTL секунд; истёкшие
+    запросы извлекаются через ту же очередь сроков, что и диалоги, а их
+    кнопки у менеджера сворачиваются, чтобы нельзя было открыть диалог по
+    устаревшему запросу.
+    """
+
+    def __init__(self, ttl: float):
+        self._items: dict[int, DialogRequest] = {}
+        self.expiry = ExpiryQueue(ttl)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, client_id: int) -> DialogRequest | None:
+        return self._items.get(client_id)
+
+    def add(self, client_id: int, manager_id: int, created: float | None = None) -> DialogRequest:
+        request = self._items[client_id] = DialogRequest(manager_id=manager_id, created=created or time.time())
+        self.expiry.touch(client_id, request.created)
+        manager_pool.offer(manager_id)
+        return request
+
+    def pop(self, client_id: int) -> DialogRequest | None:
+        self.expiry.discard(client_id)
+        request = self._items.pop(client_id, None)
+        if request is not None:
+            manager_pool.withdraw(request.manager_id)
+        return request
+
+    async def wait_expired(self) -> list[tuple[int, DialogRequest]]:
+        expired = [(client_id, self._items.pop(client_id)) for client_id in await self.expiry.wait_due()]
+        for _, request in expired:
+            manager_pool.withdraw(request.manager_id)
+        return expired
+
+    def recorder(self, client_id: int) -> Callable[[asyncio.Future], None]:
+        """Колбэк для future из очереди отправки: запоминает сообщение с кнопками"""
+        def record(future: asyncio.Future) -> None:
+            request = self._items.get(client_id)
+            if request is None or future.cancelled() or future.exception():
+                return
+            sent = future.result()
+            if isinstance(sent, Message):
+                request.messages.append((sent.chat.id, sent.message_id))
+        return record
+
+    def dump(self) -> dict[str, dict]:
+        return {str(client_id): asdict(request) for client_id, request in self._items.items()}
+
+    def load(self, items: dict[str, dict]) -> None:
+        for client_id, request in items.items():
+            self.add(int(client_id), request["manager_id"], request["created"])
+            self._items[int(client_id)].messages = [tuple(m) for m in request["messages"]]
+
+
+dialog_requests = DialogRequests(DIALOG_REQUEST_TTL)
+
+
+manager_pool = ManagerPool(MANAGER_IDS, MANAGER_STRATEGY, MANAGER_CAPACITY)
+
+
+dialog_expiry = ExpiryQueue(DIALOG_TIMEOUT)
+
+
+async def get_dialog(client_id: int) -> DialogRecord | None:
+    """Возвращает активный диалог клиента или None"""
+    return await dialog_store.get(client_id)
+
+
+async def open_dialog(client_id: int, manager_id: int) -> None:
+    """Открывает диалог клиента с менеджером"""
+    previous = await dialog_store.get(client_id)
+    if previous is None or previous.manager_id != manager_id:
+        if previous is not None:
+            manager_pool.release(previous.manager_id)
+        manager_pool.bind(client_id, manager_id)
+    await touch_dialog(client_id, manager_id)
+
+
+async def touch_dialog(client_id: int, manager_id: int) -> None:
+    """Обновляет время последней активности диалога"""
+    now = time.time()
+    await dialog_store.put(client_id, DialogRecord(last_active=now, manager_id=manager_id))
+    dialog_touched(client_id, manager_id, now)
+
+
+@on_coordinator
+def dialog_touched(client_id: int, manager_id: int, last_active: float) -> None:
+    dialog_expiry.touch(client_id, last_active)
+    dashboard.touch(manager_id, client_id, last_active)
+
+
+async def close_dialog(client_id: int) -> DialogRecord | None:
+    """Закрывает диалог; возвращает его запись, если он был активен"""
+    # Недосланная серия сообщений клиента должна дойти до менеджера раньше уведомления о завершении
+    coalescer.flush(client_id)
+    record = await dialog_store.get(client_id)
+    if record is None or not await dialog_store.delete(client_id):
+        return None
+    await dialog_closed(client_id, record.manager_id)
+    return record
+
+
+@on_coordinator
+async def dialog_closed(client_id: int, manager_id: int) -> None:
+    dialog_expiry.discard(client_id)
+    manager_pool.release(manager_id)
+    dashboard.remove(manager_id, client_id)
+    # У менеджера освободилось место — предлагаем ему следующий запрос из очереди
+    await dispatch_waiting_requests()
+
+
+async def restore_dialog_expiry() -> None:
+    """Восстанавливает сроки истечения из хранилища после перезапуска"""
+    dialogs = await dialog_store.all()
+    for client_id, record in dialogs.items():
+        dialog_expiry.touch(client_id, record.last_active)
+    manager_pool.rebuild(dialogs)
+    dashboard.rebuild(dialogs)
+
+# ============================================
+# 🔘 ДАННЫЕ INLINE-КНОПОК
+# ============================================
+
+class SignedCallbackData:
+    """Подпись для CallbackData: «префикс:поля:подпись».
+
+    Подпись — усечённый HMAC-SHA256 от версии формата и упакованных полей.
+    Кнопка с чужим префиксом отбрасывается сравнением строки, поддельная или
+    выпущенная до смены CALLBACK_VERSION — проверкой подписи; разбор полей
+    и их типы проверяет сама CallbackData.
+    """
+
+    CALLBACK_VERSION = 1
+    SIGNATURE_SIZE = 6  # Байт HMAC: 8 символов base64 в 64-байтовом лимите Telegram
+    _key = hashlib.sha256(f"callback:{CALLBACK_SECRET or BOT_TOKEN}".encode()).digest()
+
+    @classmethod
+    def sign(cls, payload: str) -> str:
+        digest = hmac.new(cls._key, f"{cls.CALLBACK_VERSION}:{payload}".encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:cls.SIGNATURE_SIZE]).decode()
+
+    def pack(self) -> str:
+        payload = super().pack()
+        return f"{payload}{self.__separator__}{self.sign(payload)}"
+
+    @classmethod
+    def unpack(cls, value: str):
+        if not value.startswith(cls.__prefix__ + cls.__separator__):
+            raise ValueError(f"Чужой префикс: {value!r}")
+        payload, _, signature = value.rpartition(cls.__separator__)
+        if not hmac.compare_digest(signature, cls.sign(payload)):
+            raise ValueError(f"Неверная подпись: {value!r}")
+        return super().unpack(payload)
+
+
+class DialogRequestCallback(SignedCallbackData, CallbackData, prefix="dr"):
+    """Кнопки запроса на диалог: accept | reject"""
+    action: str
+    client_id: int
+
+
+class CatalogPageCallback(SignedCallbackData, CallbackData, prefix="pg"):
+    """Листание раздела каталога; page = -1 — счётчик страниц без действия"""
+    section: str
+    page: int
+
+
+class DashboardCallback(SignedCallbackData, CallbackData, prefix="db"):
+    """Панель менеджера: page — страница, pick — клиент 🎯 (0 — сбросить выбор)"""
+    action: str
+    value: int
+
+
+class LeadCallback(SignedCallbackData, CallbackData, prefix="ld"):
+    """Заявка на звонок: take — менеджер берёт её в работу"""
+    action: str
+    lead_id: int
+
+# ============================================
+# 🎨 ФУНКЦИИ СОЗДАНИЯ КЛАВИАТУР
+# ============================================
+
+MAX_TEXT_LENGTH = 4096  # Ограничение Telegram на длину сообщения (в единицах UTF-16)
+
+# Разделы каталога, которые показываются постранично
+CATALOG_PRICE = "price"
+CATALOG_ABOUT = "about"
+# Разметка разделов: прайс собирается ботом из данных файла (HTML с экранированием),
+# текст о компании пишется вручную и может содержать свою Markdown-разметку
+CATALOG_PARSE_MODES = {CATALOG_PRICE: "HTML", CATALOG_ABOUT: "Markdown"}
+
+
+def tg_len(text: str) -> int:
+    """Длина текста так, как её считает Telegram: в кодовых единицах UTF-16 (эмодзи — две)"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def tg_cut(text: str, limit: int) -> int:
+    """Наибольшая длина префикса text (в символах Python), укладывающегося в limit единиц UTF-16"""
+    if tg_len(text) <= limit:
+        return len(text)
+    size = 0
+    for index, char in enumerate(text):
+        size += 2 if ord(char) > 0xFFFF else 1
+        if size > limit:
+            return index
+    return len(text)
+
+
+def render_price_block(category: str, items: list[str]) -> str:
+    """Раздел прайс-листа в HTML; названия из файла каталога экранируются"""
+    return f"<b>{html.escape(category)}</b>\n" + "".join(f"{html.escape(item)}\n" for item in items) + "\n"
+
+
+def paginate(blocks: list[str], header: str = "", limit: int = MAX_TEXT_LENGTH) -> list[str]:
+    """Раскладывает блоки текста по страницам не длиннее limit (в единицах UTF-16).
+
+    Блок переносится на следующую страницу целиком; блок длиннее страницы
+    режется по строкам. Заголовок повторяется на каждой странице.
+    """
+    budget = limit - tg_len(header)
+    pieces: list[str] = []
+    for block in blocks:
+        if tg_len(block) <= budget:
+            pieces.append(block)
+            continue
+        for line in block.splitlines(keepends=True):
+            while tg_len(line) > budget:
+                cut = tg_cut(line, budget)
+                pieces.append(line[:cut])
+                line = line[cut:]
+            pieces.append(line)
+    pages: list[str] = []
+    current = ""
+    size = 0
+    for piece in pieces:
+        piece_size = tg_len(piece)
+        if current and size + piece_size > budget:
+            pages.append(current)
+            current, size = "", 0
+        current += piece
+        size += piece_size
+    if current or not pages:
+        pages.append(current)
+    return [header + page for page in pages]
+
+
+def validate_catalog(data: Any) -> tuple[dict[str, list[str]], str]:
+    """Проверяет содержимое файла каталога; ValueError — каталог не применяется"""
+    if not isinstance(data, dict):
+        raise ValueError("каталог должен быть объектом с ключами price_list и company_info")
+    price_list = data.get("price_list")
+    company_info = data.get("company_info")
+    if not isinstance(price_list, dict) or not price_list:
+        raise ValueError("price_list должен быть непустым объектом {раздел: [позиции]}")
+    for category, items in price_list.items():
+        if not isinstance(category, str) or not category.strip():
+            raise ValueError(f"пустое или нестроковое название раздела: {category!r}")
+        if items is None:
+            price_list[category] = items = []
+        if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
+            raise ValueError(f"позиции раздела «{category}» должны быть списком строк")
+    if not isinstance(company_info, str) or not company_info.strip():
+        raise ValueError("company_info должен быть непустой строкой")
+    return price_list, company_info
+
+
+def load_catalog(path: str) -> tuple[dict[str, list[str]], str]:
+    """Читает каталог из JSON или YAML (.yaml/.yml, нужен PyYAML).
+
+    Формат: {"price_list": {"Раздел": ["позиция", ...], ...}, "company_info": "текст"}
+    """
+    with open(path, encoding="utf-8") as f:
+        raw = f.read()
+    if path.endswith((".yaml", ".yml")):
+        import yaml
+        try:
+            data = yaml.safe_load(raw)
+        except yaml.YAMLError as e:
+            raise ValueError(f"ошибка разбора YAML: {e}") from e
+    else:
+        data = json.loads(raw)
+    return validate_catalog(data)
+
+
+def build_page_keyboard(section: str, page: int, total: int) -> InlineKeyboardMarkup:
+    """Кнопки листания раздела каталога"""
+    def button(text: str, target: int) -> InlineKeyboardButton:
+        return InlineKeyboardButton(text=text, callback_data=CatalogPageCallback(section=section, page=target).pack())
+
+    row = []
+    if page > 0:
+        row.append(button("◀️", page - 1))
+    row.append(button(f"{page + 1}/{total}", -1))
+    if page < total - 1:
+        row.append(button("▶️", page + 1))
+    return InlineKeyboardMarkup(inline_keyboard=[row])
+
+
+class RenderCache:
+    """Готовые ответы статических экранов.
+
+    Клавиатуры создаются один раз при запуске, тексты каталога пересобираются
+    только через rebuild_catalog(). JSON клавиатур вычисляется при первой
+    отправке (или при прогреве warm()) и дальше переиспользуется сессией бота
+    (см. CachedMarkupSession.build_fields).
+
+    Разделы каталога (CATALOG_PRICE, CATALOG_ABOUT) хранятся постранично:
+    текст длиннее лимита Telegram делится на страницы с inline-кнопками
+    листания.
+    """
+
+    def __init__(self):
+        self.serialized: dict[int, str | None] = {}  # id(клавиатуры) -> готовый JSON
+        self.main_menu = self._keep(ReplyKeyboardMarkup(
+            keyboard=[
+                [KeyboardButton(text="ℹ️ О компании"), KeyboardButton(text="💰 Прайс материалов")],
+                [KeyboardButton(text="💬 Начать диалог с менеджером"), KeyboardButton(text="📞 Заказать звонок")]
+            ],
+            resize_keyboard=True,
+            input_field_placeholder="Выберите действие"
+        ))
+        self.dialog_menu = self._keep(ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text="⏹️ Завершить диалог")]],
+            resize_keyboard=True,
+            input_field_placeholder="Пишите сообщение менеджеру..."
+        ))
+        self.back_menu = self._keep(ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text="⬅️ Назад")]],
+            resize_keyboard=True
+        ))
+        self.contact_request_menu = self._keep(ReplyKeyboardMarkup(
+            keyboard=[
+                [KeyboardButton(text="📱 Отправить контакт", request_contact=True)],
+                [KeyboardButton(text="⬅️ Назад")]
+            ],
+            resize_keyboard=True
+        ))
+        self.pages: dict[str, list[str]] = {}  # Раздел каталога -> страницы
+        self.page_keyboards: dict[tuple[str, int], InlineKeyboardMarkup] = {}
+        self._price_blocks: dict[tuple[str, tuple[str, ...]], str] = {}  # (раздел, позиции) -> текст
+        self._sources: dict[str, Any] = {}  # Исходные данные, по которым собраны страницы
+        self.rebuild_catalog(PRICE_LIST, COMPANY_INFO)
+
+    def _keep(self, markup):
+        # Объект живёт столько же, сколько кэш, поэтому id() однозначно его идентифицирует
+        self.serialized[id(markup)] = None
+        return markup
+
+    def get(self, markup: Any, bot: Bot) -> str | None:
+        """Готовый JSON клавиатуры из кэша (сериализуется при первом обращении); None — не из кэша"""
+        if markup is None or id(markup) not in self.serialized:
+            return None
+        serialized = self.serialized[id(markup)]
+        if serialized is None:
+            serialized = self.serialized[id(markup)] = bot.session.prepare_value(
+                markup.model_dump(warnings=False), bot=bot, files={}
+            )
+        return serialized
+
+    def warm(self, bot: Bot) -> int:
+        """Сериализует все клавиатуры заранее, чтобы первые ответы клиентам не платили за это"""
+        markups = [self.main_menu, self.dialog_menu, self.back_menu, self.contact_request_menu,
+                   *self.page_keyboards.values()]
+        for markup in markups:
+            self.get(markup, bot)
+        return len(markups)
+
+    def rebuild_catalog(self, price_list: dict[str, list[str]], company_info: str) -> list[str]:
+        """Пересобирает изменившиеся разделы каталога; возвращает их список.
+
+        Тексты неизменившихся разделов прайса берутся из кэша. Новые страницы
+        и клавиатуры собираются целиком и подменяются одним присваиванием, так
+        что обработчики никогда не видят наполовину обновлённый каталог.
+        """
+        sources = {CATALOG_PRICE: price_list, CATALOG_ABOUT: company_info}
+        changed = [section for section, source in sources.items() if self._sources.get(section) != source]
+        if not changed:
+            return []
+        pages = dict(self.pages)
+        if CATALOG_PRICE in changed:
+            blocks = {}
+            for category, items in price_list.items():
+                key = (category, tuple(items))
+                blocks[key] = self._price_blocks.get(key) or render_price_block(category, items)
+            self._price_blocks = blocks
+            pages[CATALOG_PRICE] = paginate(
+                list(blocks.values()), header="📊 <b>Прайс-лист на расходные материалы для водоочистки</b>\n\n"
+            )
+        if CATALOG_ABOUT in changed:
+            pages[CATALOG_ABOUT] = paginate(company_info.splitlines(keepends=True))
+        keyboards = {key: markup for key, markup in self.page_keyboards.items() if key[0] not in changed}
+        for section in changed:
+            total = len(pages[section])
+            if total > 1:
+                for page in range(total):
+                    keyboards[(section, page)] = self._keep(build_page_keyboard(section, page, total))
+        # Старые клавиатуры ещё могут ждать в очереди отправки — они просто сериализуются заново
+        for key, markup in self.page_keyboards.items():
+            if keyboards.get(key) is not markup:
+                self.serialized.pop(id(markup), None)
+        self.pages, self.page_keyboards = pages, keyboards
+        self._sources = sources
+        return changed
+
+
+render_cache = RenderCache()
+
+
+class CachedMarkupSession(AiohttpSession):
+    """HTTP-сессия бота на aiohttp.
+
+    Подставляет готовый JSON клавиатур из render_cache, держит пул keep-alive
+    соединений (API_POOL_SIZE, API_KEEPALIVE) с кэшем DNS и ограничивает
+    время запросов по методам (API_METHOD_TIMEOUTS) с отдельным коротким
+    тайм-аутом установки соединения: зависшее соединение не задерживает
+    отправку на полную минуту.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("timeout", API_TIMEOUT)
+        super().__init__(limit=API_POOL_SIZE, **kwargs)
+        if self._connector_type is TCPConnector:
+            self._connector_init.update(keepalive_timeout=API_KEEPALIVE, ttl_dns_cache=API_DNS_TTL)
+
+    def request_timeout(self, method: TelegramMethod, timeout: float | None) -> float:
+        """Явно переданный тайм-аут (long polling) важнее настроек метода"""
+        if timeout is not None:
+            return timeout
+        return API_METHOD_TIMEOUTS.get(method.__api_method__, self.timeout)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: float | None = None):
+        total = self.request_timeout(method, timeout)
+        return await super().make_request(
+            bot, method, timeout=ClientTimeout(total=total, sock_connect=min(API_CONNECT_TIMEOUT, total))
+        )
+
+    def build_fields(self, bot: Bot, method: TelegramMethod) -> tuple[dict[str, Any], dict[str, InputFile]]:
+        """Поля запроса и загружаемые файлы.
+
+        Клавиатура из render_cache подставляется готовым JSON и исключается
+        из model_dump() метода — иначе pydantic сериализовал бы её заново
+        при каждой отправке.
+        """
+        fields: dict[str, Any] = {}
+        files: dict[str, InputFile] = {}
+        markup = render_cache.get(getattr(method, "reply_markup", None), bot)
+        exclude = {"reply_markup"} if markup is not None else None
+        for key, value in method.model_dump(warnings=False, exclude=exclude).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if value:
+                fields[key] = value
+        if markup is not None:
+            fields["reply_markup"] = markup
+        return fields, files
+
+    def build_form_data(self, bot: Bot, method: TelegramMethod) -> FormData:
+        fields, files = self.build_fields(bot, method)
+        form = FormData(quote_fields=False)
+        for key, value in fields.items():
+            form.add_field(key, value)
+        for key, upload in files.items():
+            form.add_field(key, upload.read(bot), filename=upload.filename or key)
+        return form
+
+
+class HttpxSession(CachedMarkupSession):
+    """Транспорт на httpx с HTTP/2: запросы мультиплексируются в немногих соединениях.
+
+    Используется при API_TRANSPORT=httpx; пакеты httpx и h2 необязательны и
+    импортируются только в этом режиме.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Клиент создаётся сразу, чтобы отсутствие httpx/h2 обнаружилось при запуске, а не на первом запросе
+        self._client = self._new_client()
+
+    def _new_client(self):
+        import httpx
+        return httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=API_POOL_SIZE, keepalive_expiry=API_KEEPALIVE),
+            timeout=httpx.Timeout(self.timeout, connect=API_CONNECT_TIMEOUT),
+            headers={"User-Agent": f"aiogram/{aiogram_version}"},
+        )
+
+    async def create_session(self):
+        if self._client is None:
+            self._client = self._new_client()
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: float | None = None):
+        import httpx
+        client = await self.create_session()
+        total = self.request_timeout(method, timeout)
+        data, uploads = self.build_fields(bot, method)
+        files = {key: (upload.filename or key, await self._upload_content(bot, upload))
+                 for key, upload in uploads.items()}
+        try:
+            response = await client.post(
+                self.api.api_url(token=bot.token, method=method.__api_method__),
+                data=data, files=files or None,
+                timeout=httpx.Timeout(total, connect=min(API_CONNECT_TIMEOUT, total)),
+            )
+        except httpx.TimeoutException as e:
+            raise TelegramNetworkError(method=method, message="Request timeout error") from e
+        except httpx.HTTPError as e:
+            raise TelegramNetworkError(method=method, message=f"{type(e).__name__}: {e}") from e
+        finally:
+            for _, content in files.values():
+                if hasattr(content, "close"):
+                    content.close()
+        return self.check_response(bot=bot, method=method, status_code=response.status_code,
+                                   content=response.text).result
+
+    @staticmethod
+    async def _upload_content(bot: Bot, upload: InputFile):
+        """Содержимое файла для multipart: файл с диска httpx читает частями по ходу отправки"""
+        if isinstance(upload, FSInputFile):
+            return open(upload.path, "rb")
+        if isinstance(upload, BufferedInputFile):
+            return upload.data
+        return b"".join([chunk async for chunk in upload.read(bot)])
+
+    async def stream_content(self, url: str, headers: dict | None = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True):
+        client = await self.create_session()
+        async with client.stream("GET", url, headers=headers, timeout=timeout) as response:
+            if raise_for_status:
+                response.raise_for_status()
+            async for chunk in response.aiter_bytes(chunk_size):
+                yield chunk
+
+
+def build_session(**kwargs) -> CachedMarkupSession:
+    """HTTP-сессия Bot API согласно API_TRANSPORT"""
+    if API_TRANSPORT == "httpx":
+        return HttpxSession(**kwargs)
+    return CachedMarkupSession(**kwargs)
+
+
+def get_main_menu() -> ReplyKeyboardMarkup:
+    """Главное меню"""
+    return render_cache.main_menu
+
+def get_dialog_menu() -> ReplyKeyboardMarkup:
+    """Меню во время диалога с менеджером"""
+    return render_cache.dialog_menu
+
+def get_back_menu() -> ReplyKeyboardMarkup:
+    """Клавиатура с кнопкой «Назад»"""
+    return render_cache.back_menu
+
+def get_contact_request_menu() -> ReplyKeyboardMarkup:
+    """Клавиатура для отправки контакта"""
+    return render_cache.contact_request_menu
+
+def get_manager_accept_keyboard(client_id: int) -> InlineKeyboardMarkup:
+    """Inline-кнопки для менеджера: принять/отклонить диалог"""
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="✅ Принять",
+                                 callback_data=DialogRequestCallback(action="accept", client_id=client_id).pack()),
+            InlineKeyboardButton(text="❌ Отклонить",
+                                 callback_data=DialogRequestCallback(action="reject", client_id=client_id).pack())
+        ]
+    ])
+    return keyboard
+
+# ============================================
+# 📤 ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ
+# ============================================
+
+# Приоритеты очереди: меньшее значение отправляется раньше
+PRIORITY_ACK = -1  # Ответы на нажатия inline-кнопок: снимают «часики» у нажавшего
+PRIORITY_MANAGER = 0  # Уведомления и запросы менеджеру
+PRIORITY_CLIENT = 1  # Ответы клиентам
+PRIORITY_BULK = 2  # Массовые уведомления (автозавершение диалогов)
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не более capacity"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до появления токена"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        """Запрещает отправку на seconds секунд (после RetryAfter)"""
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class SharedRateLimit:
+    """Общий для всех процессов бота лимит отправки в Redis (алгоритм GCRA).
+
+    Каждый запрос одним вызовом скрипта резервирует ближайший свободный
+    слот и ждёт его локально, так что обработчики шардированного режима
+    делят глобальный лимит Telegram по фактической нагрузке, а не поровну.
+    """
+
+    SCRIPT = """
+    local now = tonumber(ARGV[1])
+    local interval = tonumber(ARGV[2])
+    local tolerance = tonumber(ARGV[3])
+    local block = tonumber(ARGV[4])
+    local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or 0), now)
+    if block > 0 then
+        tat = math.max(tat, now + block)
+        redis.call('SET', KEYS[1], tostring(tat), 'PX', math.ceil((tat - now) * 1000) + 1000)
+        return '0'
+    end
+    local wait = math.max(0, tat - tolerance - now)
+    tat = tat + interval
+    redis.call('SET', KEYS[1], tostring(tat), 'PX', math.ceil((tat - now) * 1000) + 1000)
+    return tostring(wait)
+    """
+
+    def __init__(self, client, rate: float, key: str = "tgbot:send_rate"):
+        self.client = client
+        self.interval = 1 / rate
+        self.tolerance = (rate - 1) * self.interval  # Всплеск до rate запросов, как у локальной корзины
+        self.key = key
+        self._script = client.register_script(self.SCRIPT)
+
+    @classmethod
+    def from_url(cls, url: str, rate: float) -> "SharedRateLimit":
+        from redis.asyncio import Redis
+        return cls(Redis.from_url(url), rate)
+
+    async def _eval(self, block: float) -> float:
+        return float(await self._script(keys=[self.key], args=[time.time(), self.interval, self.tolerance, block]))
+
+    async def acquire(self) -> None:
+        """Резервирует слот отправки и ждёт его"""
+        delay = await self._eval(0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def block(self, seconds: float) -> None:
+        """Запрещает отправку всем процессам на seconds секунд (после RetryAfter)"""
+        await self._eval(seconds)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+@dataclass(order=True)
+class OutgoingItem:
+    """Запрос в очереди отправки (сравнивается по приоритету и порядку постановки)"""
+    priority: int
+    seq: int
+    method: TelegramMethod = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    on_error: Callable[[Exception], Awaitable[None]] | None = field(default=None, compare=False)
+    attempts: int = field(default=0, compare=False)
+    media: bool = field(default=False, compare=False)  # Полоса медиа: отдельные рабочие задачи
+
+
+class SendQueue:
+    """Центральная очередь исходящих запросов к Telegram.
+
+    Обработчики ставят методы в очередь и не ждут сетевого ответа. Рабочие
+    задачи соблюдают глобальный лимит и лимит на каждый чат, отправляют
+    запросы по приоритету и повторяют их после TelegramRetryAfter.
+
+    В каждом чате активен один запрос (в полёте или ждёт лимита); следующие
+    запросы в этот чат паркуются и возвращаются в очередь, когда он завершится.
+
+    Медиа идут отдельной полосой со своими MEDIA_WORKERS рабочими задачами:
+    медленные копирования и загрузки файлов не задерживают текстовые ответы.
+    Порядок в чате сохраняется — текст не обгоняет поставленное раньше медиа.
+    """
+
+    def __init__(self):
+        self.bot: Bot | None = None
+        self._queue: asyncio.PriorityQueue[OutgoingItem] = asyncio.PriorityQueue()
+        self._media_queue: asyncio.PriorityQueue[OutgoingItem] = asyncio.PriorityQueue()
+        self._media_pending: dict[int, set[int]] = {}  # chat_id -> порядковые номера неотправленных медиа
+        self._global = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self._shared: SharedRateLimit | None = None  # Общий лимит процессов шардированного режима
+        self._chats: dict[int, TokenBucket] = {}
+        self._seq = 0
+        self._deferred = 0  # Запросы, ожидающие лимита или своей очереди в чате
+        self._busy_chats: dict[int, int] = {}  # chat_id -> номер активного запроса: в чат — строго по одному
+        self._parked: dict[int, list[OutgoingItem]] = {}  # chat_id -> запросы, ждущие освобождения чата
+        self._workers: list[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        """Количество запросов, ожидающих отправки"""
+        return self._queue.qsize() + self._media_queue.qsize() + self._deferred
+
+    def start(self, bot: Bot, shared: SharedRateLimit | None = None) -> None:
+        """Запускает рабочие задачи; shared — глобальный лимит, общий с другими процессами"""
+        self.bot = bot
+        self._shared = shared
+        self._workers = [asyncio.create_task(self._worker(self._queue)) for _ in range(SEND_WORKERS)]
+        self._workers += [asyncio.create_task(self._worker(self._media_queue)) for _ in range(MEDIA_WORKERS)]
+
+    async def close(self, timeout: float = 10) -> None:
+        """Дожидается отправки очереди (не дольше timeout) и останавливает рабочие задачи"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(self._queue.join(), self._media_queue.join()),
+                    max(deadline - time.monotonic(), 0)
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"Очередь отправки не опустела за {timeout} с, осталось {self.depth}")
+                break
+            if not self._deferred:
+                break
+            await asyncio.sleep(0.05)
+        for worker in self._workers:
+            worker.cancel()
+        if self._shared:
+            await self._shared.close()
+
+    def submit(self, method: TelegramMethod, priority: int = PRIORITY_CLIENT, on_error=None,
+               media: bool = False) -> asyncio.Future:
+        """Ставит метод в очередь; возвращает future с результатом.
+
+        on_error — необязательная корутинная функция, вызываемая с исключением,
+        если запрос так и не удалось выполнить. media — отправить полосой медиа.
+        """
+        self._seq += 1
+        future = asyncio.get_running_loop().create_future()
+        # Ошибка уже залогирована рабочей задачей — не даём asyncio ругаться на неполученное исключение
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        item = OutgoingItem(priority, self._seq, method, future, on_error, media=media)
+        chat_id = getattr(method, "chat_id", None)
+        if media and isinstance(chat_id, int):
+            self._media_pending.setdefault(chat_id, set()).add(item.seq)
+        self._lane(item).put_nowait(item)
+        return future
+
+    def hold(self, chat_id: int) -> int:
+        """Придерживает текст в чат, как неотправленное медиа, до release().
+
+        Нужен, пока медиа отправляется в обход одного запроса (скачивание и
+        повторная загрузка): поставленный позже текст не должен его обогнать.
+        """
+        self._seq += 1
+        self._media_pending.setdefault(chat_id, set()).add(self._seq)
+        return self._seq
+
+    def release(self, chat_id: int, token: int) -> None:
+        self._media_done(chat_id, token)
+
+    def _lane(self, item: OutgoingItem) -> asyncio.PriorityQueue[OutgoingItem]:
+        return self._media_queue if item.media else self._queue
+
+    def _behind_media(self, item: OutgoingItem, chat_id: int) -> bool:
+        """Текст ждёт, пока не уйдут медиа, поставленные в этот чат раньше него"""
+        pending = self._media_pending.get(chat_id)
+        return not item.media and bool(pending) and min(pending) < item.seq
+
+    def _media_done(self, chat_id: int, seq: int) -> None:
+        pending = self._media_pending.get(chat_id)
+        if pending is not None:
+            pending.discard(seq)
+            if not pending:
+                del self._media_pending[chat_id]
+            self._wake(chat_id)
+
+    def _park(self, item: OutgoingItem, chat_id: int) -> None:
+        """Откладывает запрос до освобождения чата, не занимая рабочую задачу"""
+        self._deferred += 1
+        self._parked.setdefault(chat_id, []).append(item)
+
+    def _wake(self, chat_id: int) -> None:
+        """Возвращает в очередь запросы, припаркованные за чатом (их порядок задают приоритет и номер)"""
+        for item in self._parked.pop(chat_id, ()):
+            self._deferred -= 1
+            self._lane(item).put_nowait(item)
+
+    def _finish(self, item: OutgoingItem, chat_id: int) -> None:
+        """Запрос завершён: освобождает чат и будит ждущие его запросы"""
+        if self._busy_chats.get(chat_id) == item.seq:
+            del self._busy_chats[chat_id]
+        if item.media:
+            self._media_done(chat_id, item.seq)
+        self._wake(chat_id)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Выбрасываем корзины чатов, которые давно полностью восстановились
+                now = time.monotonic()
+                self._chats = {
+                    cid: b for cid, b in self._chats.items()
+                    if b.tokens + (now - b.updated) * b.rate < b.capacity
+                }
+            bucket = self._chats[chat_id] = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+        return bucket
+
+    def _defer(self, item: OutgoingItem, delay: float) -> None:
+        """Возвращает запрос в очередь через delay секунд, не занимая рабочую задачу"""
+        self._deferred += 1
+
+        def requeue():
+            self._deferred -= 1
+            self._lane(item).put_nowait(item)
+
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    async def _worker(self, queue: asyncio.PriorityQueue[OutgoingItem]) -> None:
+        while True:
+            item = await queue.get()
+            try:
+                await self._process(item)
+            except Exception as e:
+                logger.error(f"Ошибка в очереди отправки: {e}")
+            finally:
+                queue.task_done()
+
+    async def _process(self, item: OutgoingItem) -> None:
+        chat_id = getattr(item.method, "chat_id", None)
+        if not isinstance(chat_id, int):
+            if not item.future.cancelled():
+                await self._execute(item, None, None)
+            return
+        try:
+            if item.future.cancelled():
+                return  # Отправитель отказался от запроса (например, остановленная рассылка)
+            owner = self._busy_chats.get(chat_id)
+            if (owner is not None and owner != item.seq) or self._behind_media(item, chat_id):
+                self._park(item, chat_id)
+                return
+            # Чат занят этим запросом, пока он не завершится, в том числе пока ждёт лимита или повтора
+            self._busy_chats[chat_id] = item.seq
+            chat_bucket = self._chat_bucket(chat_id)
+            delay = chat_bucket.delay(time.monotonic())
+            if delay > 0:
+                self._defer(item, delay)
+                return
+            await self._execute(item, chat_id, chat_bucket)
+        finally:
+            if item.future.done():
+                self._finish(item, chat_id)
+
+    async def _execute(self, item: OutgoingItem, chat_id: int | None, chat_bucket: TokenBucket | None) -> None:
+        # Ответ на нажатие кнопки не сообщение: глобальный лимит на него не расходуется
+        if not isinstance(item.method, AnswerCallbackQuery):
+            if self._shared:
+                await self._shared.acquire()
+            else:
+                while (delay := self._global.delay(time.monotonic())) > 0:
+                    await asyncio.sleep(delay)
+                self._global.take()
+        if chat_bucket:
+            chat_bucket.take()
+
+        try:
+            result = await self.bot(item.method)
+        except TelegramRetryAfter as e:
+            item.attempts += 1
+            if chat_bucket:
+                chat_bucket.block(e.retry_after)
+            if not chat_bucket or e.retry_after > chat_bucket.capacity / chat_bucket.rate:
+                # Пауза дольше окна лимита чата — Telegram ограничил весь бот, а не один чат:
+                # останавливаются и остальные отправки (во всех процессах при общем лимите)
+                if self._shared:
+                    await self._shared.block(e.retry_after)
+                else:
+                    self._global.block(e.retry_after)
+            if item.attempts <= SEND_MAX_RETRIES:
+                logger.warning(f"Лимит Telegram для чата {chat_id}: повтор через {e.retry_after} с")
+                self._defer(item, e.retry_after)
+                return
+            self._fail(item, e)
+        except Exception as e:
+            self._fail(item, e)
+        else:
+            if not item.future.done():
+                item.future.set_result(result)
+
+    def _fail(self, item: OutgoingItem, error: Exception) -> None:
+        method_name = type(item.method).__name__
+        logger.warning(f"Не удалось выполнить {method_name} для чата {getattr(item.method, 'chat_id', None)}: {error}")
+        if not item.future.done():
+            item.future.set_exception(error)
+        if item.on_error:
+            asyncio.create_task(item.on_error(error))
+
+
+outbox = SendQueue()
+
+
+def ack(callback: CallbackQuery, text: str | None = None, show_alert: bool = False) -> None:
+    """Отвечает на нажатие кнопки вне очереди, не дожидаясь сети"""
+    outbox.submit(callback.answer(text, show_alert=show_alert), priority=PRIORITY_ACK)
+
+# ============================================
+# 🔗 ИНДЕКС ОТВЕТОВ МЕНЕДЖЕРА
+# ============================================
+
+# Запасной разбор подписи «Клиент 123456789» для сообщений, вытесненных из индекса
+CLIENT_REF_RE = re.compile(r"Клиент (\d+)")
+
+
+class ReplyIndex:
+    """Индекс (чат менеджера, message_id) -> client_id для маршрутизации ответов.
+
+    Ограничен по размеру (вытесняются давно не использованные записи) и по
+    времени жизни записи.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict[tuple[int, int], tuple[int, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, chat_id: int, message_id: int, client_id: int) -> None:
+        key = (chat_id, message_id)
+        self._items[key] = (client_id, time.time() + self.ttl)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def get(self, chat_id: int, message_id: int) -> int | None:
+        key = (chat_id, message_id)
+        item = self._items.get(key)
+        if item is None:
+            return None
+        client_id, expires = item
+        if expires < time.time():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return client_id
+
+    def dump(self) -> list[list[int | float]]:
+        """Неистёкшие записи в порядке использования: [[chat_id, message_id, client_id, expires], ...]"""
+        now = time.time()
+        return [[*key, client_id, expires] for key, (client_id, expires) in self._items.items() if expires > now]
+
+    def load(self, items: list[list[int | float]]) -> None:
+        now = time.time()
+        for chat_id, message_id, client_id, expires in items:
+            if expires > now:
+                self._items[(chat_id, message_id)] = (client_id, expires)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def recorder(self, client_id: int, chat_id: int) -> Callable[[asyncio.Future], None]:
+        """Колбэк для future из очереди отправки: запоминает отправленные в chat_id сообщения"""
+        def record(future: asyncio.Future) -> None:
+            if future.cancelled() or future.exception():
+                return
+            result = future.result()
+            for sent in result if isinstance(result, list) else [result]:
+                # Message для send_*, MessageId для copy_message(s)
+                if isinstance(sent, (Message, MessageId)):
+                    remember_reply(chat_id, sent.message_id, client_id)
+        return record
+
+
+reply_index = ReplyIndex(REPLY_INDEX_SIZE, REPLY_INDEX_TTL)
+
+
+@on_coordinator
+def remember_reply(chat_id: int, message_id: int, client_id: int) -> None:
+    """Запись индекса ответов: ответы менеджеров обрабатывает координатор"""
+    reply_index.add(chat_id, message_id, client_id)
+
+
+def resolve_reply_client(message: Message) -> int | None:
+    """Клиент, на сообщение которого ответил менеджер"""
+    replied = message.reply_to_message
+    client_id = reply_index.get(replied.chat.id, replied.message_id)
+    if client_id is None:
+        match = CLIENT_REF_RE.search(replied.text or replied.caption or "")
+        if match:
+            client_id = int(match.group(1))
+    return client_id
+
+# ============================================
+# 🖼️ ПЕРЕСЫЛКА МЕДИА
+# ============================================
+
+# Типы сообщений с файлом и методы их отправки по file_id
+MEDIA_SENDERS: dict[str, type[TelegramMethod]] = {
+    "photo": SendPhoto,
+    "video": SendVideo,
+    "document": SendDocument,
+    "audio": SendAudio,
+    "voice": SendVoice,
+    "animation": SendAnimation,
+    "video_note": SendVideoNote,
+    "sticker": SendSticker,
+}
+NO_CAPTION = ("video_note", "sticker")  # Методы без подписи
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024  # getFile в Bot API отдаёт файлы не больше 20 МБ
+
+
+def message_file(message: Message) -> tuple[str, Any] | None:
+    """Тип и файл сообщения (для фото — самый крупный размер); None — файла нет"""
+    for kind in MEDIA_SENDERS:
+        value = getattr(message, kind)
+        if value:
+            return kind, value[-1] if kind == "photo" else value
+    return None
+
+
+def token_fingerprint() -> str:
+    """Отпечаток токена: кэши, привязанные к боту, после смены токена не подхватываются"""
+    return hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:16]
+
+
+class FileIdCache:
+    """Кэш file_unique_id -> file_id, проверенного успешной отправкой.
+
+    file_unique_id одинаков для всех ботов, а file_id действует только для
+    бота, который его получил, поэтому в снимке кэш хранится вместе с
+    отпечатком токена и после смены токена не восстанавливается.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: OrderedDict[str, str] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, unique_id: str) -> str | None:
+        file_id = self._items.get(unique_id)
+        if file_id is not None:
+            self._items.move_to_end(unique_id)
+        return file_id
+
+    def add(self, unique_id: str, file_id: str) -> None:
+        self._items[unique_id] = file_id
+        self._items.move_to_end(unique_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def dump(self) -> list[list[str]]:
+        """Записи в порядке использования: [[file_unique_id, file_id], ...]"""
+        return [[unique_id, file_id] for unique_id, file_id in self._items.items()]
+
+    def load(self, items: list[list[str]]) -> None:
+        for unique_id, file_id in items:
+            self.add(unique_id, file_id)
+
+
+# Ошибки копирования, при которых исходного сообщения уже нет, но файл ещё можно отправить
+COPY_GONE_RE = re.compile(r"message (to copy )?not found|message can't be copied|MESSAGE_ID_INVALID", re.I)
+
+
+class MediaRelay:
+    """Копирование медиа между клиентом и менеджером с запасными путями.
+
+    Копирование идёт полосой медиа очереди отправки. Если Telegram его
+    отклонил, потому что исходного сообщения больше нет, файл отправляется
+    по file_id — сначала по проверенному из кэша, затем по file_id самого
+    сообщения. Если и это не удалось, файл скачивается и загружается заново:
+    небольшие — в памяти, крупнее MEDIA_LARGE_FILE — частями через временный
+    файл в MEDIA_TEMP_DIR. Число одновременных загрузок ограничено отдельно
+    для небольших и крупных файлов, чтобы всплеск медиа не раздувал память.
+    Пока пересылка не завершилась, тексты в тот же чат её не обгоняют.
+    Прочие ошибки (неверная разметка подписи, недоступный чат) не повторяются.
+    """
+
+    def __init__(self):
+        self.files = FileIdCache(MEDIA_CACHE_SIZE)
+        self._transfers = asyncio.Semaphore(MEDIA_TRANSFERS)
+        self._large_transfers = asyncio.Semaphore(MEDIA_LARGE_TRANSFERS)
+        self._tasks: set[asyncio.Task] = set()
+
+    def copy(self, method: CopyMessage, message: Message, priority: int,
+             on_error: Callable[[Exception], Awaitable[None]] | None = None) -> asyncio.Future:
+        """Копирует сообщение с файлом; future — как у outbox.submit (MessageId или Message)"""
+        # Копия встаёт в очередь сразу, а чат придерживается до конца пересылки, включая
+        # запасные пути: поставленный следом текст в тот же чат её не обгонит
+        hold = outbox.hold(method.chat_id)
+        copied = outbox.submit(method, priority=priority, media=True)
+        task = asyncio.create_task(self._copy(copied, method, message, priority, on_error, hold))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        # Ошибка уже передана в on_error — не даём asyncio ругаться на неполученное исключение
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def close(self, timeout: float) -> None:
+        """Дожидается начатых пересылок (не дольше timeout): им ещё нужна очередь отправки"""
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=timeout)
+
+    async def _copy(self, copied: asyncio.Future, method: CopyMessage, message: Message, priority: int,
+                    on_error: Callable[[Exception], Awaitable[None]] | None, hold: int) -> MessageId | Message:
+        try:
+            try:
+                return await copied
+            except TelegramBadRequest as e:
+                if not COPY_GONE_RE.search(e.message):
+                    raise
+                logger.warning(f"Копирование медиа в чат {method.chat_id} не удалось ({e}), отправляем файл")
+                return await self._resend(method, message, priority, e)
+        except Exception as e:
+            if on_error:
+                await on_error(e)
+            raise
+        finally:
+            outbox.release(method.chat_id, hold)
+
+    async def _resend(self, method: CopyMessage, message: Message, priority: int,
+                      error: Exception) -> Message:
+        kind, file = message_file(message)
+        sender = MEDIA_SENDERS[kind]
+        params: dict[str, Any] = {"chat_id": method.chat_id}
+        if kind not in NO_CAPTION:
+            if method.caption is not None:
+                params.update(caption=method.caption, parse_mode=method.parse_mode)
+            else:
+                params.update(caption=message.caption, caption_entities=message.caption_entities)
+
+        for file_id in dict.fromkeys(filter(None, (self.files.get(file.file_unique_id), file.file_id))):
+            try:
+                sent = await outbox.submit(sender(**params, **{kind: file_id}), priority=priority, media=True)
+            except TelegramBadRequest as e:
+                error = e
+                continue
+            metrics.inc("tgbot_media_fallbacks_total", (("way", "file_id"),))
+            self._remember(sent)
+            return sent
+
+        if (file.file_size or 0) > TELEGRAM_DOWNLOAD_LIMIT:
+            raise error  # Bot API не отдаст такой файл, загрузить его заново нельзя
+        sent = await self._transfer(sender, params, kind, file, priority)
+        metrics.inc("tgbot_media_fallbacks_total", (("way", "upload"),))
+        self._remember(sent)
+        return sent
+
+    async def _transfer(self, sender: type[TelegramMethod], params: dict[str, Any], kind: str,
+                        file: Any, priority: int) -> Message:
+        """Скачивает файл и загружает его заново"""
+        bot = outbox.bot
+        filename = getattr(file, "file_name", None) or kind
+        if (file.file_size or 0) <= MEDIA_LARGE_FILE:
+            async with self._transfers:
+                data = await bot.download(file, chunk_size=MEDIA_CHUNK_SIZE, timeout=int(API_TIMEOUT))
+                upload = BufferedInputFile(data.getvalue(), filename=filename)
+                del data
+                return await outbox.submit(sender(**params, **{kind: upload}), priority=priority, media=True)
+
+        async with self._large_transfers:
+            path = await asyncio.to_thread(self._temp_path)
+            try:
+                await bot.download(file, destination=path, chunk_size=MEDIA_CHUNK_SIZE, timeout=int(API_TIMEOUT))
+                upload = FSInputFile(path, filename=filename, chunk_size=MEDIA_CHUNK_SIZE)
+                return await outbox.submit(sender(**params, **{kind: upload}), priority=priority, media=True)
+            finally:
+                with suppress(OSError):
+                    os.remove(path)
+
+    @staticmethod
+    def _temp_path() -> str:
+        os.makedirs(MEDIA_TEMP_DIR, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=MEDIA_TEMP_DIR)
+        os.close(fd)
+        return path
+
+    def _remember(self, sent: Message) -> None:
+        found = message_file(sent)
+        if found:
+            self.files.add(found[1].file_unique_id, found[1].file_id)
+
+
+media_relay = MediaRelay()
+
+# ============================================
+# 🧺 СКЛЕЙКА СООБЩЕНИЙ КЛИЕНТА
+# ============================================
+
+MAX_CAPTION_LENGTH = 1024  # Ограничение Telegram на длину подписи
+MAX_COPY_BATCH = 100  # Ограничение copy_messages на число сообщений
+
+
+def has_caption(message: Message) -> bool:
+    """Можно ли заменить подпись сообщения при копировании"""
+    return bool(message.photo or message.video or message.document or message.audio
+                or message.voice or message.animation)
+
+
+@dataclass
+class ClientBurst:
+    """Накопленная серия сообщений одного клиента"""
+    manager_id: int
+    prefix: str
+    on_error: Callable[[Exception], Awaitable[None]]
+    texts: list[str] = field(default_factory=list)
+    copies: list[Message] = field(default_factory=list)  # Нетекстовые сообщения для копирования
+    timer: asyncio.TimerHandle | None = None
+
+
+class MessageCoalescer:
+    """Склеивает серии сообщений клиента и пересылает их менеджеру нативным копированием.
+
+    Тексты серии уходят одним сообщением с подписью клиента. Остальные
+    сообщения любого типа (фото, альбомы, голосовые, видео, стикеры,
+    геопозиции…) копируются одним copy_messages без загрузки содержимого;
+    одиночное медиа с подписью копируется одним copy_message, а подпись
+    клиента добавляется в caption. Серия отправляется, если клиент молчит
+    COALESCE_DELAY секунд или после медиа присылает текст (порядок сохраняется).
+
+    Перед отправкой по таймеру серия сверяется с хранилищем диалогов: диалог
+    мог завершить другой процесс (координатор по /стоп или по неактивности),
+    и тогда серия менеджеру не отправляется — в истории она уже записана.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._bursts: dict[int, ClientBurst] = {}
+        self._checks: set[asyncio.Task] = set()
+
+    def add(self, client_id: int, manager_id: int, prefix: str, message: Message,
+            on_error: Callable[[Exception], Awaitable[None]]) -> None:
+        burst = self._bursts.get(client_id)
+        if burst and (burst.manager_id != manager_id or self._breaks(burst, message)):
+            self.flush(client_id)
+            burst = None
+        if burst is None:
+            burst = self._bursts[client_id] = ClientBurst(manager_id, prefix, on_error)
+
+        if message.text:
+            burst.texts.append(message.text)
+        else:
+            burst.copies.append(message)
+
+        if burst.timer:
+            burst.timer.cancel()
+        if self.delay > 0:
+            burst.timer = asyncio.get_running_loop().call_later(self.delay, self._due, client_id)
+        else:
+            self.flush(client_id)
+
+    def _due(self, client_id: int) -> None:
+        burst = self._bursts.get(client_id)
+        if burst is None:
+            return
+        burst.timer = None
+        task = asyncio.create_task(self._flush_if_open(client_id, burst))
+        self._checks.add(task)
+        task.add_done_callback(self._checks.discard)
+
+    async def _flush_if_open(self, client_id: int, burst: ClientBurst) -> None:
+        """Отправляет серию, если её диалог ещё открыт"""
+        try:
+            record = await dialog_store.get(client_id)
+        except Exception as e:
+            logger.error(f"Не удалось проверить диалог клиента {client_id}: {e}")
+            record = DialogRecord(last_active=0, manager_id=burst.manager_id)  # Отправляем, как раньше
+        if self._bursts.get(client_id) is not burst:
+            return  # Серию уже отправили (следующее сообщение, закрытие диалога, остановка)
+        if record is None or record.manager_id != burst.manager_id:
+            del self._bursts[client_id]
+            logger.info(f"Серия сообщений клиента {client_id} не отправлена: диалог уже завершён")
+            outbox.submit(SendMessage(
+                chat_id=client_id,
+                text="ℹ️ Диалог завершён. Начните новый диалог через главное меню.",
+                reply_markup=get_main_menu()
+            ))
+            return
+        self.flush(client_id)
+
+    def flush(self, client_id: int) -> None:
+        """Отправляет накопленную серию клиента"""
+        burst = self._bursts.pop(client_id, None)
+        if burst is None:
+            return
+        if burst.timer:
+            burst.timer.cancel()
+        manager_id = burst.manager_id
+
+        if not burst.texts and len(burst.copies) == 1 and has_caption(burst.copies[0]):
+            # Одно медиа: подпись клиента помещается в caption — хватает одного запроса
+            message = burst.copies[0]
+            caption = f"{burst.prefix}{message.caption or ''}"
+            if tg_len(caption) <= MAX_CAPTION_LENGTH:
+                self._send(client_id, manager_id, CopyMessage(
+                    chat_id=manager_id, from_chat_id=client_id, message_id=message.message_id, caption=caption
+                ), burst.on_error, message)
+                return
+
+        header = burst.prefix + "\n".join(burst.texts) if burst.texts else burst.prefix.rstrip()
+        self._send(client_id, manager_id, SendMessage(chat_id=manager_id, text=header), burst.on_error)
+        if len(burst.copies) == 1:
+            self._send(client_id, manager_id, CopyMessage(
+                chat_id=manager_id, from_chat_id=client_id, message_id=burst.copies[0].message_id
+            ), burst.on_error, burst.copies[0])
+        elif burst.copies:
+            # Недоступные для копирования сообщения copy_messages пропускает сам, запасной путь не нужен
+            self._send(client_id, manager_id, CopyMessages(
+                chat_id=manager_id, from_chat_id=client_id,
+                message_ids=sorted(m.message_id for m in burst.copies)
+            ), burst.on_error, media=any(message_file(m) for m in burst.copies))
+
+    def flush_all(self) -> None:
+        for client_id in list(self._bursts):
+            self.flush(client_id)
+
+    @staticmethod
+    def _breaks(burst: ClientBurst, message: Message) -> bool:
+        """Нужно ли закрыть серию перед этим сообщением"""
+        if message.text:
+            if burst.copies:
+                return True  # Текст после медиа — иначе он окажется выше медиа
+            length = tg_len(burst.prefix) + sum(tg_len(t) + 1 for t in burst.texts) + tg_len(message.text)
+            return length > MAX_TEXT_LENGTH
+        return len(burst.copies) >= MAX_COPY_BATCH
+
+    @staticmethod
+    def _send(client_id: int, manager_id: int, method: TelegramMethod,
+              on_error: Callable[[Exception], Awaitable[None]], source: Message | None = None,
+              media: bool = False) -> None:
+        """Отправляет запрос серии; копия сообщения с файлом (source) идёт через media_relay"""
+        if source is not None and message_file(source):
+            future = media_relay.copy(method, source, PRIORITY_MANAGER, on_error)
+        else:
+            future = outbox.submit(method, priority=PRIORITY_MANAGER, on_error=on_error, media=media)
+        future.add_done_callback(reply_index.recorder(client_id, manager_id))
+
+
+coalescer = MessageCoalescer(COALESCE_DELAY)
+
+# ============================================
+# 📜 ИСТОРИЯ ПЕРЕПИСКИ
+# ============================================
+
+# Направление сообщения в истории
+FROM_CLIENT = "client"
+FROM_MANAGER = "manager"
+
+
+@dataclass
+class TranscriptEntry:
+    client_id: int
+    manager_id: int
+    sender: str  # FROM_CLIENT | FROM_MANAGER
+    kind: str  # Тип содержимого: text, photo, document, ...
+    text: str  # Текст или подпись
+    created: float  # unix time
+
+
+class SQLiteWriteBehind(ABC):
+    """Локальная база SQLite (WAL) с отложенной пакетной записью.
+
+    Обработчики лишь дописывают строки в буфер в памяти; фоновая задача раз
+    в flush_interval секунд (или при накоплении batch_size строк) записывает
+    буфер одной транзакцией в отдельном потоке, так что обработчики никогда
+    не ждут диска. Чтение идёт через отдельное соединение: в режиме WAL оно
+    не блокирует запись. Пустой path отключает хранилище.
+
+    В шардированном режиме один файл пишут все обработчики: транзакции
+    разных процессов сериализует блокировка файла SQLite, а занятая база
+    ожидается до BUSY_TIMEOUT секунд. Поэтому файл должен лежать на
+    локальном диске (не на сетевой ФС, где блокировки ненадёжны).
+    """
+
+    SCHEMA: tuple[str, ...] = ()
+    NAME = "базы"
+    BUSY_TIMEOUT = 30.0
+
+    def __init__(self, path: str, flush_interval: float, batch_size: int):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._buffer: list[tuple] = []
+        self._full = asyncio.Event()
+        self._db: "sqlite3.Connection | None" = None
+        self._reader: "sqlite3.Connection | None" = None
+        self._writer: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    async def start(self) -> None:
+        if not self.path:
+            return
+        import sqlite3
+
+        self._db = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            self._db.execute(statement)
+        self._db.commit()
+        self._reader = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+        self._writer = asyncio.create_task(self._write_loop())
+
+    async def close(self) -> None:
+        if self._writer:
+            self._writer.cancel()
+        await self.flush()
+        for db in (self._db, self._reader):
+            if db:
+                db.close()
+        self._db = self._reader = None
+
+    def _append(self, row: tuple) -> None:
+        if self._db is None:
+            return
+        self._buffer.append(row)
+        if len(self._buffer) >= self.batch_size:
+            self._full.set()
+
+    async def flush(self) -> None:
+        """Записывает накопленный буфер одной транзакцией"""
+        if not self._buffer or not self._db:
+            return
+        batch, self._buffer = self._buffer, []
+        await asyncio.to_thread(self._write, batch)
+
+    @abstractmethod
+    def _write(self, batch: list[tuple]) -> None:
+        """Записывает пакет строк буфера (вызывается в отдельном потоке)"""
+
+    async def _write_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи {self.NAME} в {self.path}: {e}")
+
+    async def _read(self, query: Callable[["sqlite3.Connection"], Any]) -> Any:
+        """Выполняет чтение в отдельном потоке, предварительно дописав буфер"""
+        await self.flush()
+        return await asyncio.to_thread(query, self._reader)
+
+    async def _execute(self, sql: str, params: tuple | list = ()) -> None:
+        """Немедленная запись вне буфера (редкие служебные изменения)"""
+        def execute() -> None:
+            with self._db:
+                self._db.execute(sql, params)
+        await asyncio.to_thread(execute)
+
+
+class TranscriptStore(SQLiteWriteBehind):
+    """Журнал пересланных сообщений (только добавление).
+
+    Пересылка лишь дописывает запись в буфер; поиск по тексту — через
+    внешний индекс FTS5, который заполняется триггером при вставке.
+    """
+
+    NAME = "истории"
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS transcript ("
+        " id INTEGER PRIMARY KEY, client_id INTEGER NOT NULL, manager_id INTEGER NOT NULL,"
+        " sender TEXT NOT NULL, kind TEXT NOT NULL, text TEXT NOT NULL, created REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS transcript_client ON transcript (client_id, id)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS transcript_fts USING fts5(text, content='transcript', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS transcript_ai AFTER INSERT ON transcript BEGIN"
+        " INSERT INTO transcript_fts (rowid, text) VALUES (new.id, new.text); END",
+    )
+
+    def __init__(self, path: str, flush_interval: float = TRANSCRIPT_FLUSH_INTERVAL,
+                 batch_size: int = TRANSCRIPT_BATCH_SIZE):
+        super().__init__(path, flush_interval, batch_size)
+
+    async def start(self) -> None:
+        await super().start()
+        if self.enabled:
+            logger.info(f"История переписки: {self.path}")
+
+    def add(self, client_id: int, manager_id: int, sender: str, message: Message | None = None,
+            text: str | None = None) -> None:
+        """Добавляет сообщение в буфер записи; не ждёт диска"""
+        if message is not None:
+            kind, text = message.content_type, text if text is not None else (message.text or message.caption or "")
+        else:
+            kind = "text"
+        self._append((client_id, manager_id, sender, kind, text or "", time.time()))
+
+    def _write(self, batch: list[tuple]) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO transcript (client_id, manager_id, sender, kind, text, created) VALUES (?, ?, ?, ?, ?, ?)",
+                batch
+            )
+
+    async def history(self, client_id: int, page: int = 1,
+                      page_size: int = TRANSCRIPT_PAGE_SIZE) -> tuple[list[TranscriptEntry], int]:
+        """Страница истории клиента (1 — самые свежие) в хронологическом порядке и число страниц"""
+        def read(db: "sqlite3.Connection") -> tuple[list[TranscriptEntry], int]:
+            total = db.execute("SELECT COUNT(*) FROM transcript WHERE client_id = ?", (client_id,)).fetchone()[0]
+            rows = db.execute(
+                "SELECT client_id, manager_id, sender, kind, text, created FROM transcript"
+                " WHERE client_id = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+                (client_id, page_size, (page - 1) * page_size)
+            ).fetchall()
+            return [TranscriptEntry(*row) for row in reversed(rows)], -(-total // page_size)
+
+        return await self._read(read)
+
+    async def search(self, query: str, limit: int = TRANSCRIPT_PAGE_SIZE) -> list[TranscriptEntry]:
+        """Самые свежие сообщения, содержащие все слова запроса"""
+        # Каждое слово — отдельная фраза FTS5, чтобы кавычки и операторы в запросе не ломали разбор
+        match = " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+        def read(db: "sqlite3.Connection") -> list[TranscriptEntry]:
+            rows = db.execute(
+                "SELECT t.client_id, t.manager_id, t.sender, t.kind, t.text, t.created"
+                " FROM transcript_fts JOIN transcript t ON t.id = transcript_fts.rowid"
+                " WHERE transcript_fts MATCH ? ORDER BY t.id DESC LIMIT ?",
+                (match, limit)
+            ).fetchall()
+            return [TranscriptEntry(*row) for row in rows]
+
+        return await self._read(read)
+
+
+def format_transcript(entries: list[TranscriptEntry], with_client: bool = False) -> str:
+    """Записи истории для менеджера: время, автор и текст (длинные тексты обрезаются)"""
+    lines = []
+    for entry in entries:
+        author = "👤 Клиент" if entry.sender == FROM_CLIENT else "🧑‍💼 Менеджер"
+        if with_client:
+            author += f" {entry.client_id}"
+        text = entry.text if len(entry.text) <= 300 else entry.text[:300] + "…"
+        if entry.kind != "text":
+            text = f"[{entry.kind}] {text}".rstrip()
+        lines.append(f"{time.strftime('%d.%m %H:%M', time.localtime(entry.created))} {author}: {text}")
+    return "\n".join(lines)
+
+
+transcripts = TranscriptStore(TRANSCRIPT_DB_PATH)
+
+# ============================================
+# 📋 ПАНЕЛЬ МЕНЕДЖЕРА
+# ============================================
+
+def format_age(seconds: float) -> str:
+    """Давность активности: «только что», «5 мин», «2 ч», «3 дн»"""
+    if seconds < 60:
+        return "только что"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} мин"
+    if seconds < 86400:
+        return f"{int(seconds // 3600)} ч"
+    return f"{int(seconds // 86400)} дн"
+
+
+class ManagerDashboard:
+    """Закреплённая у каждого менеджера панель его активных диалогов.
+
+    Панель показывает клиентов постранично (DASHBOARD_PAGE_SIZE), давность
+    последней активности и число непрочитанных сообщений, а кнопки 🎯
+    выбирают клиента, которому уходят обычные сообщения менеджера.
+
+    Данные панели обновляются инкрементально хуками открытия, продления и
+    закрытия диалога, без обхода хранилища. Изменения не отправляются сразу:
+    за DASHBOARD_DEBOUNCE секунд они склеиваются в одну правку
+    edit_message_text, а правка с неизменившимся текстом не отправляется.
+    """
+
+    def __init__(self, page_size: int, debounce: float):
+        self.page_size = page_size
+        self.debounce = debounce
+        self.dialogs: defaultdict[int, dict[int, float]] = defaultdict(dict)  # manager_id -> client_id -> last_active
+        self.unread: dict[int, int] = {}  # client_id -> непрочитанные менеджером сообщения
+        self.names: dict[int, str] = {}  # client_id -> имя клиента
+        self.messages: dict[int, int] = {}  # manager_id -> message_id панели
+        self.pages: dict[int, int] = {}  # manager_id -> открытая страница
+        self.targets: dict[int, int] = {}  # manager_id -> клиент, которому уходят обычные сообщения
+        self._timers: dict[int, asyncio.TimerHandle] = {}
+        self._rendered: dict[int, str] = {}  # manager_id -> текст последней отправленной версии
+
+    def rebuild(self, dialogs: dict[int, "DialogRecord"]) -> None:
+        """Заполняет панели по восстановленным диалогам"""
+        self.dialogs.clear()
+        for client_id, record in dialogs.items():
+            self.dialogs[record.manager_id][client_id] = record.last_active
+
+    def touch(self, manager_id: int, client_id: int, last_active: float) -> None:
+        self.dialogs[manager_id][client_id] = last_active
+        self.schedule(manager_id)
+
+    def client_message(self, manager_id: int, client_id: int, name: str) -> None:
+        self.unread[client_id] = self.unread.get(client_id, 0) + 1
+        self.names[client_id] = name
+        self.schedule(manager_id)
+
+    def read(self, manager_id: int, client_id: int) -> None:
+        """Менеджер ответил клиенту — его сообщения прочитаны"""
+        if self.unread.pop(client_id, None):
+            self.schedule(manager_id)
+
+    def remove(self, manager_id: int, client_id: int) -> None:
+        self.dialogs[manager_id].pop(client_id, None)
+        self.unread.pop(client_id, None)
+        self.names.pop(client_id, None)
+        if self.targets.get(manager_id) == client_id:
+            del self.targets[manager_id]
+        self.schedule(manager_id)
+
+    def target(self, manager_id: int) -> int | None:
+        """Выбранный на панели клиент, если диалог с ним ещё активен"""
+        client_id = self.targets.get(manager_id)
+        return client_id if client_id in self.dialogs[manager_id] else None
+
+    def select(self, manager_id: int, client_id: int) -> None:
+        if client_id in self.dialogs[manager_id]:
+            self.targets[manager_id] = client_id
+            self.unread.pop(client_id, None)
+        else:
+            self.targets.pop(manager_id, None)
+        self.schedule(manager_id)
+
+    def turn(self, manager_id: int, page: int) -> None:
+        self.pages[manager_id] = page
+        self.schedule(manager_id, 0)
+
+    def schedule(self, manager_id: int, delay: float | None = None) -> None:
+        """Откладывает обновление панели; события за время задержки склеиваются в одну правку"""
+        if manager_id not in self.messages or manager_id in self._timers:
+            return
+        self._timers[manager_id] = asyncio.get_running_loop().call_later(
+            self.debounce if delay is None else delay, self.flush, manager_id
+        )
+
+    def flush(self, manager_id: int) -> None:
+        timer = self._timers.pop(manager_id, None)
+        if timer:
+            timer.cancel()
+        message_id = self.messages.get(manager_id)
+        if message_id is None:
+            return
+        text, markup = self.render(manager_id)
+        if self._rendered.get(manager_id) == text:
+            return
+        self._rendered[manager_id] = text
+
+        async def on_error(error: Exception) -> None:
+            # Панель удалена менеджером — следующая команда /панель создаст новую
+            logger.warning(f"Панель менеджера {manager_id} не обновлена: {error}")
+            if self.messages.get(manager_id) == message_id:
+                del self.messages[manager_id]
+
+        outbox.submit(
+            EditMessageText(chat_id=manager_id, message_id=message_id, text=text, reply_markup=markup),
+            priority=PRIORITY_BULK, on_error=on_error
+        )
+
+    def show(self, manager_id: int) -> None:
+        """Отправляет менеджеру новую панель и закрепляет её; прежняя панель сворачивается"""
+        previous = self.messages.pop(manager_id, None)
+        if previous is not None:
+            outbox.submit(EditMessageText(chat_id=manager_id, message_id=previous, text="📋 Панель обновлена ниже ⬇️"),
+                          priority=PRIORITY_BULK)
+        text, markup = self.render(manager_id)
+        self._rendered[manager_id] = text
+
+        def pin(future: asyncio.Future) -> None:
+            if future.cancelled() or future.exception():
+                return
+            message_id = future.result().message_id
+            self.messages[manager_id] = message_id
+            outbox.submit(PinChatMessage(chat_id=manager_id, message_id=message_id, disable_notification=True),
+                          priority=PRIORITY_BULK)
+
+        outbox.submit(SendMessage(chat_id=manager_id, text=text, reply_markup=markup),
+                      priority=PRIORITY_MANAGER).add_done_callback(pin)
+
+    def render(self, manager_id: int) -> tuple[str, InlineKeyboardMarkup | None]:
+        now = time.time()
+        dialogs = sorted(self.dialogs[manager_id].items(), key=lambda item: item[1], reverse=True)
+        total_pages = max(1, -(-len(dialogs) // self.page_size))
+        page = min(self.pages.get(manager_id, 0), total_pages - 1)
+        target = self.target(manager_id)
+
+        lines = [f"📋 Активные диалоги: {len(dialogs)}" + (f" (стр. {page + 1}/{total_pages})" if total_pages > 1 else "")]
+        if target:
+            lines.append(f"🎯 Обычные сообщения уходят клиенту {self.names.get(target, target)}")
+        lines.append("")
+        buttons = []
+        for number, (client_id, last_active) in enumerate(
+            dialogs[page * self.page_size:(page + 1) * self.page_size], start=page * self.page_size + 1
+        ):
+            name = self.names.get(client_id, "Клиент")
+            line = f"{number}. {name} · {client_id} — {format_age(now - last_active)}"
+            if self.unread.get(client_id):
+                line += f" · 🔴 {self.unread[client_id]}"
+            if client_id == target:
+                line += " · 🎯"
+            lines.append(line)
+            buttons.append(InlineKeyboardButton(
+                text=f"🎯 {name[:20]} · {client_id}",
+                callback_data=DashboardCallback(action="pick", value=client_id).pack()
+            ))
+        if not dialogs:
+            lines.append("Нет активных диалогов.")
+        lines.append(f"\nОбновлено {time.strftime('%H:%M', time.localtime(now))}")
+
+        rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton(
+                text="◀️", callback_data=DashboardCallback(action="page", value=page - 1).pack()
+            ))
+        if target:
+            nav.append(InlineKeyboardButton(
+                text="✖️ Сбросить 🎯", callback_data=DashboardCallback(action="pick", value=0).pack()
+            ))
+        if page < total_pages - 1:
+            nav.append(InlineKeyboardButton(
+                text="▶️", callback_data=DashboardCallback(action="page", value=page + 1).pack()
+            ))
+        if nav:
+            rows.append(nav)
+        return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+
+
+dashboard = ManagerDashboard(DASHBOARD_PAGE_SIZE, DASHBOARD_DEBOUNCE)
+
+# ============================================
+# 📣 РЕЕСТР КЛИЕНТОВ И РАССЫЛКИ
+# ============================================
+
+class UserRegistry(SQLiteWriteBehind):
+    """Все клиенты, когда-либо нажимавшие /start, и состояние рассылок.
+
+    Запись из обработчиков отложенная и пакетная; получатели рассылки
+    читаются порциями по возрастанию user_id (keyset-пагинация), поэтому
+    ни реестр, ни рассылка не загружаются в память целиком. Клиенты,
+    заблокировавшие бота, помечаются и пропускаются до следующего /start.
+    """
+
+    NAME = "реестра клиентов"
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS users ("
+        " user_id INTEGER PRIMARY KEY, username TEXT, full_name TEXT NOT NULL,"
+        " first_seen REAL NOT NULL, last_seen REAL NOT NULL, blocked INTEGER NOT NULL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS broadcasts ("
+        " id INTEGER PRIMARY KEY, data TEXT NOT NULL, status TEXT NOT NULL)",
+    )
+
+    def __init__(self, path: str, flush_interval: float = USERS_FLUSH_INTERVAL, batch_size: int = USERS_BATCH_SIZE):
+        super().__init__(path, flush_interval, batch_size)
+
+    def add(self, user) -> None:
+        now = time.time()
+        self._append((user.id, user.username, user.full_name, now, now))
+
+    def _write(self, batch: list[tuple]) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO users (user_id, username, full_name, first_seen, last_seen) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (user_id) DO UPDATE SET username = excluded.username,"
+                " full_name = excluded.full_name, last_seen = excluded.last_seen, blocked = 0",
+                batch
+            )
+
+    async def count(self) -> int:
+        return await self._read(lambda db: db.execute("SELECT COUNT(*) FROM users WHERE blocked = 0").fetchone()[0])
+
+    async def recipients(self, after: int, limit: int) -> list[int]:
+        """Следующая порция получателей с user_id больше after"""
+        return await self._read(lambda db: [row[0] for row in db.execute(
+            "SELECT user_id FROM users WHERE user_id > ? AND blocked = 0 ORDER BY user_id LIMIT ?", (after, limit)
+        )])
+
+    async def mark_blocked(self, user_ids: list[int]) -> None:
+        if not user_ids:
+            return
+
+        def execute() -> None:
+            with self._db:
+                self._db.executemany("UPDATE users SET blocked = 1 WHERE user_id = ?", [(uid,) for uid in user_ids])
+        await asyncio.to_thread(execute)
+
+    async def save_broadcast(self, broadcast: "Broadcast") -> None:
+        if broadcast.id:
+            await self._execute("UPDATE broadcasts SET data = ?, status = ? WHERE id = ?",
+                                (broadcast.dump(), broadcast.status, broadcast.id))
+            return
+
+        def insert() -> int:
+            with self._db:
+                return self._db.execute("INSERT INTO broadcasts (data, status) VALUES (?, ?)",
+                                        (broadcast.dump(), broadcast.status)).lastrowid
+        broadcast.id = await asyncio.to_thread(insert)
+
+    async def running_broadcast(self) -> "Broadcast | None":
+        row = await self._read(lambda db: db.execute(
+            "SELECT id, data FROM broadcasts WHERE status = 'running' ORDER BY id DESC LIMIT 1"
+        ).fetchone())
+        if row is None:
+            return None
+        broadcast = Broadcast.load(row[1])
+        broadcast.id = row[0]
+        return broadcast
+
+
+@dataclass
+class Broadcast:
+    """Рассылка: копия сообщения менеджера всем клиентам из реестра"""
+    manager_id: int
+    from_chat_id: int
+    message_id: int
+    cursor: int = 0  # Наибольший user_id, до которого рассылка отправлена всем
+    delivered: int = 0
+    blocked: int = 0
+    failed: int = 0
+    status: str = "running"  # running | done | stopped
+    id: int = 0
+    sent: list[int] = field(default_factory=list)  # Уже отправленные получатели дальше cursor
+
+    def advance(self, cursor: int) -> None:
+        """Сдвигает контрольную точку; получатели до неё больше не нужны в sent"""
+        self.cursor = cursor
+        self.sent = [uid for uid in self.sent if uid > cursor]
+
+    def dump(self) -> str:
+        return json.dumps(asdict(self), separators=(",", ":"))
+
+    @classmethod
+    def load(cls, raw: str) -> "Broadcast":
+        return cls(**json.loads(raw))
+
+    def summary(self) -> str:
+        return (f"доставлено — {self.delivered}, заблокировали бота — {self.blocked}, "
+                f"ошибок — {self.failed}")
+
+
+class Broadcaster:
+    """Рассылка по реестру клиентов без ущерба живым диалогам.
+
+    Получатели читаются порциями по BROADCAST_CHUNK_SIZE и ставятся в общую
+    очередь отправки с низшим приоритетом (PRIORITY_BULK): глобальный лимит
+    и лимиты чатов соблюдаются, а ответы клиентам и менеджерам всегда
+    уходят раньше. После каждой порции прогресс сохраняется в базу, так что
+    после перезапуска рассылка продолжается с места остановки. Одновременно
+    идёт не больше одной рассылки.
+    """
+
+    def __init__(self, registry: UserRegistry, chunk_size: int):
+        self.registry = registry
+        self.chunk_size = chunk_size
+        self.current: Broadcast | None = None
+        self._task: asyncio.Task | None = None
+        self._status_message: int | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, manager_id: int, source: Message | Awaitable[Message]) -> Broadcast | None:
+        """Запускает рассылку в фоне; None — уже идёт другая.
+
+        source — сообщение для копирования или future сообщения, которое ещё
+        только отправляется менеджеру через очередь.
+        """
+        if self.running:
+            return None
+        broadcast = Broadcast(manager_id=manager_id, from_chat_id=0, message_id=0)
+        self._launch(broadcast, self._begin(broadcast, source))
+        return broadcast
+
+    async def resume(self) -> None:
+        """Продолжает рассылку, прерванную остановкой бота"""
+        broadcast = await self.registry.running_broadcast()
+        if broadcast:
+            logger.info(f"Рассылка #{broadcast.id} продолжается с клиента {broadcast.cursor}: {broadcast.summary()}")
+            self._launch(broadcast, self._run(broadcast))
+
+    def stop(self) -> bool:
+        if not self.running:
+            return False
+        self.current.status = "stopped"
+        return True
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _launch(self, broadcast: Broadcast, run: Awaitable[None]) -> None:
+        self.current = broadcast
+        self._status_message = None
+        self._task = asyncio.create_task(run)
+
+    async def _begin(self, broadcast: Broadcast, source: Message | Awaitable[Message]) -> None:
+        if not isinstance(source, Message):
+            try:
+                source = await source
+            except Exception as e:
+                logger.error(f"Не удалось отправить менеджеру {broadcast.manager_id} текст рассылки: {e}")
+                broadcast.status = "stopped"
+                outbox.submit(SendMessage(chat_id=broadcast.manager_id,
+                                          text="⚠️ Не удалось подготовить рассылку, повторите команду."),
+                              priority=PRIORITY_MANAGER)
+                return
+        broadcast.from_chat_id, broadcast.message_id = source.chat.id, source.message_id
+        await self.registry.save_broadcast(broadcast)
+        logger.info(f"Менеджер {broadcast.manager_id} запустил рассылку #{broadcast.id}")
+        await self._run(broadcast)
+
+    async def _run(self, broadcast: Broadcast) -> None:
+        while broadcast.status == "running":
+            chunk = await self.registry.recipients(broadcast.cursor, self.chunk_size)
+            if not chunk:
+                broadcast.status = "done"
+                break
+            sent = set(broadcast.sent)
+            recipients = [uid for uid in chunk if not manager_pool.is_manager(uid) and uid not in sent]
+            if not recipients:
+                # В порции одни менеджеры (или уже отправленные): рассылка не закончена, переходим к следующей
+                broadcast.advance(chunk[-1])
+                continue
+            futures = [
+                outbox.submit(CopyMessage(chat_id=uid, from_chat_id=broadcast.from_chat_id,
+                                          message_id=broadcast.message_id), priority=PRIORITY_BULK)
+                for uid in recipients
+            ]
+            try:
+                await asyncio.wait(futures)
+            except asyncio.CancelledError:
+                # Остановка бота: текущая порция дорассылается (не дольше SHUTDOWN_TIMEOUT), остаток
+                # снимается с очереди; отправленные после первого снятого получателя запоминаются в sent
+                await asyncio.wait(futures, timeout=SHUTDOWN_TIMEOUT)
+                for future in futures:
+                    future.cancel()
+                await self._account(broadcast, recipients, futures)
+                raise
+            await self._account(broadcast, recipients, futures)
+            self._report(broadcast)
+        await self.registry.save_broadcast(broadcast)
+        self._report(broadcast)
+        logger.info(f"Рассылка #{broadcast.id} завершена ({broadcast.status}): {broadcast.summary()}")
+
+    async def _account(self, broadcast: Broadcast, recipients: list[int], futures: list[asyncio.Future]) -> None:
+        """Подсчитывает итоги порции и сохраняет контрольную точку.
+
+        Отправка, снятая с очереди, не учитывается: контрольная точка встаёт перед
+        первой такой, а отправленные после неё получатели попадают в sent и при
+        продолжении рассылки пропускаются.
+        """
+        blocked = []
+        cursor = broadcast.cursor
+        gap = False
+        for uid, future in zip(recipients, futures):
+            if future.cancelled():
+                gap = True
+                continue
+            error = future.exception()
+            if error is None:
+                broadcast.delivered += 1
+            elif isinstance(error, TelegramForbiddenError):
+                broadcast.blocked += 1
+                blocked.append(uid)
+            else:
+                broadcast.failed += 1
+            if gap:
+                broadcast.sent.append(uid)
+            else:
+                cursor = uid
+        broadcast.advance(cursor)
+        await self.registry.mark_blocked(blocked)
+        await self.registry.save_broadcast(broadcast)
+
+    def _report(self, broadcast: Broadcast) -> None:
+        """Прогресс рассылки в одном сообщении менеджеру, которое правится после каждой порции"""
+        titles = {"running": "📣 Рассылка идёт", "done": "✅ Рассылка завершена", "stopped": "⏹️ Рассылка остановлена"}
+        text = f"{titles[broadcast.status]} (#{broadcast.id}): {broadcast.summary()}"
+        if broadcast.status == "running":
+            text += "\nОстановить: /рассылка_стоп"
+        if self._status_message is None:
+            def remember(future: asyncio.Future) -> None:
+                if not future.cancelled() and not future.exception():
+                    self._status_message = future.result().message_id
+            outbox.submit(SendMessage(chat_id=broadcast.manager_id, text=text),
+                          priority=PRIORITY_MANAGER).add_done_callback(remember)
+            self._status_message = 0  # Сообщение уже в очереди
+        elif self._status_message:
+            outbox.submit(EditMessageText(chat_id=broadcast.manager_id, message_id=self._status_message, text=text),
+                          priority=PRIORITY_MANAGER)
+
+
+users = UserRegistry(USERS_DB_PATH)
+broadcaster = Broadcaster(users, BROADCAST_CHUNK_SIZE)
+
+# ============================================
+# 📞 ЗАЯВКИ НА ЗВОНОК
+# ============================================
+
+LEAD_NEW = "new"  # Ждёт менеджера
+LEAD_TAKEN = "taken"  # Менеджер взял в работу
+
+
+@dataclass
+class Lead:
+    """Заявка на звонок"""
+    id: int
+    client_id: int
+    name: str
+    phone: str  # Только цифры
+    created: float
+    status: str = LEAD_NEW
+    manager_id: int = 0
+    taken_at: float = 0.0
+    repeats: int = 0  # Повторные заявки с тем же номером в окне LEAD_DEDUP_WINDOW
+    alerted: bool = False  # Менеджеры уже предупреждены о просрочке
+
+    @property
+    def deadline(self) -> float:
+        return self.created + LEAD_SLA
+
+
+class LeadStore(SQLiteWriteBehind):
+    """Заявки на звонок: дедупликация по номеру, срок ответа и сводки.
+
+    Заявки за последние LEAD_DEDUP_WINDOW секунд держатся в памяти с
+    индексом по номеру телефона, так что повторная заявка определяется без
+    обращения к базе; база (запись отложенная) хранит всю историю и
+    восстанавливает окно после перезапуска. Пустой path — заявки только в памяти.
+    """
+
+    NAME = "заявок"
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS leads ("
+        " id INTEGER PRIMARY KEY, client_id INTEGER NOT NULL, name TEXT NOT NULL, phone TEXT NOT NULL,"
+        " created REAL NOT NULL, status TEXT NOT NULL, manager_id INTEGER NOT NULL, taken_at REAL NOT NULL,"
+        " repeats INTEGER NOT NULL, alerted INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS leads_created ON leads (created)",
+    )
+
+    def __init__(self, path: str, window: float, digest_threshold: int, digest_interval: float):
+        super().__init__(path, LEADS_FLUSH_INTERVAL, LEADS_BATCH_SIZE)
+        self.window = window
+        self.digest_threshold = digest_threshold
+        self.digest_interval = digest_interval
+        self.leads: dict[int, Lead] = {}
+        self.by_phone: dict[str, int] = {}
+        self.digest: list[int] = []  # Заявки, ожидающие очередной сводки
+        self.last_digest = time.monotonic()
+        self._recent: deque[float] = deque()  # Время недавних заявок: решает, включать ли сводки
+        self._next_id = 1
+
+    async def start(self) -> None:
+        await super().start()
+        if not self.enabled:
+            return
+        since = time.time() - self.window
+        rows = await self._read(lambda db: db.execute(
+            "SELECT id, client_id, name, phone, created, status, manager_id, taken_at, repeats, alerted"
+            " FROM leads WHERE created >= ? ORDER BY id", (since,)
+        ).fetchall())
+        for row in rows:
+            lead = Lead(*row[:9], alerted=bool(row[9]))
+            self.leads[lead.id] = lead
+            self.by_phone[lead.phone] = lead.id
+        last_id = await self._read(lambda db: db.execute("SELECT MAX(id) FROM leads").fetchone()[0])
+        self._next_id = (last_id or 0) + 1
+
+    def _save(self, lead: Lead) -> None:
+        self._append((lead.id, lead.client_id, lead.name, lead.phone, lead.created, lead.status,
+                      lead.manager_id, lead.taken_at, lead.repeats, int(lead.alerted)))
+
+    def _write(self, batch: list[tuple]) -> None:
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO leads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+
+    def add(self, client_id: int, name: str, phone: str) -> tuple[Lead, bool]:
+        """Регистрирует заявку; False вторым значением — повтор уже известного номера"""
+        phone = re.sub(r"\D", "", phone)
+        now = time.time()
+        lead = self.leads.get(self.by_phone.get(phone, 0))
+        if lead and now - lead.created < self.window:
+            lead.repeats += 1
+            self._save(lead)
+            return lead, False
+        lead = Lead(id=self._next_id, client_id=client_id, name=name, phone=phone, created=now)
+        self._next_id += 1
+        self.leads[lead.id] = lead
+        self.by_phone[phone] = lead.id
+        self._recent.append(time.monotonic())
+        self._save(lead)
+        return lead, True
+
+    def take(self, lead_id: int, manager_id: int) -> Lead | None:
+        """Закрепляет заявку за менеджером; повторный вызов ничего не меняет"""
+        lead = self.leads.get(lead_id)
+        if lead and lead.status == LEAD_NEW:
+            lead.status, lead.manager_id, lead.taken_at = LEAD_TAKEN, manager_id, time.time()
+            self._save(lead)
+        return lead
+
+    def open(self) -> list[Lead]:
+        return [lead for lead in self.leads.values() if lead.status == LEAD_NEW]
+
+    def busy(self) -> bool:
+        """Заявок за последний интервал сводки больше порога — новые копятся в сводку"""
+        if not self.digest_interval:
+            return False
+        horizon = time.monotonic() - self.digest_interval
+        while self._recent and self._recent[0] < horizon:
+            self._recent.popleft()
+        return len(self._recent) > self.digest_threshold
+
+    def take_digest(self) -> list[Lead]:
+        """Заявки для сводки, если подошёл её срок"""
+        if not self.digest or time.monotonic() - self.last_digest < self.digest_interval:
+            return []
+        self.last_digest = time.monotonic()
+        batch, self.digest = self.digest, []
+        # Заявку из сводки могла уже удалить очистка (prune)
+        leads = (self.leads.get(lead_id) for lead_id in batch)
+        return [lead for lead in leads if lead and lead.status == LEAD_NEW]
+
+    def overdue(self) -> list[Lead]:
+        """Необработанные заявки, у которых истёк LEAD_SLA; каждая возвращается один раз"""
+        now = time.time()
+        result = [lead for lead in self.open() if not lead.alerted and lead.deadline <= now]
+        for lead in result:
+            lead.alerted = True
+            self._save(lead)
+        return result
+
+    def prune(self) -> None:
+        """Убирает из памяти заявки старше окна дедупликации (в базе они остаются)"""
+        horizon = time.time() - self.window
+        for lead_id in [i for i, lead in self.leads.items() if lead.created < horizon and lead.status != LEAD_NEW]:
+            lead = self.leads.pop(lead_id)
+            if self.by_phone.get(lead.phone) == lead_id:
+                del self.by_phone[lead.phone]
+
+
+def format_lead_line(lead: Lead, now: float) -> str:
+    """Строка заявки для сводок и списка /заявки (HTML)"""
+    mark = "⏰ " if lead.deadline <= now else ""
+    return (f"{mark}#{lead.id} {html.escape(lead.name)} · +{lead.phone} · {lead.client_id} · "
+            f"{format_age(now - lead.created)} — /беру_{lead.id}")
+
+
+def format_lead_list(title: str, items: list[Lead]) -> list[str]:
+    """Заголовок и строки заявок, разбитые на сообщения по лимиту Telegram"""
+    now = time.time()
+    return paginate([format_lead_line(lead, now) + "\n" for lead in items], header=title + "\n\n")
+
+
+def send_lead(lead: Lead, manager_id: int) -> None:
+    """Отдельное уведомление о заявке с кнопкой «Беру»"""
+    text = (
+        f"🔔 <b>Новая заявка на звонок!</b>\n"
+        f"👤 Имя: {html.escape(lead.name)}\n"
+        f"📱 Телефон: +{lead.phone}\n"
+        f"🆔 ID пользователя: {lead.client_id}\n"
+        f"⏰ Перезвонить до {time.strftime('%H:%M', time.localtime(lead.deadline))}"
+    )
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(
+        text="📞 Беру", callback_data=LeadCallback(action="take", lead_id=lead.id).pack()
+    )]])
+    async def on_error(error: Exception) -> None:
+        # Заявка не теряется: она уйдёт всем менеджерам в ближайшей сводке
+        logger.error(f"Заявка #{lead.id} не доставлена менеджеру {manager_id}: {error}")
+        leads.digest.append(lead.id)
+
+    outbox.submit(SendMessage(chat_id=manager_id, text=text, parse_mode="HTML", reply_markup=keyboard),
+                  priority=PRIORITY_MANAGER, on_error=on_error)
+
+
+def notify_managers(pages: list[str]) -> None:
+    """Сводка всем менеджерам пула: заявку может взять любой"""
+    for manager_id in manager_pool.manager_ids:
+        for page in pages:
+            outbox.submit(SendMessage(chat_id=manager_id, text=page, parse_mode="HTML"), priority=PRIORITY_MANAGER)
+
+
+leads = LeadStore(LEADS_DB_PATH, LEAD_DEDUP_WINDOW, LEAD_DIGEST_THRESHOLD, LEAD_DIGEST_INTERVAL)
+
+# ============================================
+# 🧭 МАРШРУТИЗАЦИЯ СООБЩЕНИЙ
+# ============================================
+
+router = Router()
+
+ROLE_MANAGER = "manager"  # Менеджер из пула
+ROLE_IN_DIALOG = "in_dialog"  # Клиент в активном диалоге
+ROLE_CLIENT = "client"  # Клиент вне диалога
+
+# Точный текст кнопки или команда -> обработчик
+menu_routes: dict[str, Callable[..., Awaitable[None]]] = {}
+# Команда менеджера без аргумента после «_» (/стоп_123 -> /стоп) -> обработчик(message, text)
+manager_routes: dict[str, Callable[[Message, str], Awaitable[None]]] = {}
+
+
+def menu_route(*keys: str):
+    """Регистрирует обработчик кнопок меню/команд в таблице menu_routes"""
+    def register(handler):
+        for key in keys:
+            menu_routes[key] = handler
+        return handler
+    return register
+
+
+def manager_command(*keys: str):
+    """Регистрирует обработчик команды менеджера в таблице manager_routes"""
+    def register(handler):
+        for key in keys:
+            manager_routes[key] = handler
+        return handler
+    return register
+
+
+def manager_command_key(text: str) -> str:
+    """Ключ таблицы manager_routes: /стоп_123 -> /стоп, /рассылка_статус -> /рассылка"""
+    return route_key(text).split("_", 1)[0] if text.startswith("/") else ""
+
+
+def route_key(text: str) -> str:
+    """Ключ таблицы маршрутов: команда без аргументов и @имени бота либо текст кнопки"""
+    if text.startswith("/"):
+        return text.split(maxsplit=1)[0].split("@", 1)[0]
+    return text
+
+
+class RoutingMiddleware(BaseMiddleware):
+    """Внешний middleware сообщений: один раз на обновление определяет роль
+    отправителя (с загрузкой его диалога) и обработчик кнопки меню.
+
+    В данные обработчиков попадают role, dialog и route; это заменяет цепочку
+    проверок F.text == ... и повторные проверки активного диалога в каждом обработчике.
+    """
+
+    async def __call__(self, handler, event: Message, data: dict[str, Any]) -> Any:
+        if event.from_user is None:
+            return await handler(event, data)
+        user_id = event.from_user.id
+        if manager_pool.is_manager(user_id):
+            data["role"], data["dialog"] = ROLE_MANAGER, None
+        else:
+            dialog = await get_dialog(user_id)
+            data["role"], data["dialog"] = (ROLE_IN_DIALOG if dialog else ROLE_CLIENT), dialog
+        data["route"] = menu_routes.get(route_key(event.text)) if event.text else None
+        return await handler(event, data)
+
+
+def has_route(message: Message, route: Callable | None = None) -> bool:
+    return route is not None
+
+
+def is_manager(message: Message, role: str | None = None) -> bool:
+    return role == ROLE_MANAGER
+
+
+def is_dialog_message(message: Message, role: str | None = None, raw_state: str | None = None) -> bool:
+    """Клиент в диалоге — или его FSM ещё помнит диалог, который уже завершён"""
+    return role == ROLE_IN_DIALOG or (role == ROLE_CLIENT and raw_state == DialogState.in_dialog.state)
+
+
+@router.message(has_route)
+async def dispatch_menu(message: Message, state: FSMContext, route: Callable, role: str,
+                        dialog: DialogRecord | None) -> None:
+    """Кнопки меню и команды: обработчик найден по таблице в RoutingMiddleware"""
+    await route(message, state=state, role=role, dialog=dialog)
+
+# ============================================
+# 🛡️ ЗАЩИТА ОТ ФЛУДА
+# ============================================
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Внешний middleware сообщений и callback-запросов клиентов.
+
+    У каждого клиента своя корзина токенов (THROTTLE_RATE в секунду, всплеск
+    до THROTTLE_BURST): сверх неё обновления отбрасываются, а клиент один раз
+    получает предупреждение. Действия, которые отправляют менеджеру
+    уведомление, дополнительно ограничены паузой между повторами
+    (cooldowns). Менеджеры не ограничиваются. Альбом расходует один токен:
+    остальные его части разделяют решение, принятое по первой.
+
+    Сообщения клиента в диалоге не отбрасываются: это переписка с менеджером,
+    и её всплески уже склеивает MessageCoalescer. Диалог узнаётся по
+    состоянию FSM (raw_state), без обращения к хранилищу диалогов.
+    Middleware стоит перед RoutingMiddleware, поэтому отброшенное обновление
+    не стоит загрузки диалога.
+
+    Корзины и паузы хранятся в обычных словарях и раз в SWEEP_INTERVAL
+    секунд очищаются от простаивающих клиентов: полностью восстановившаяся
+    корзина ничем не отличается от новой.
+    """
+
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, rate: float, burst: int, cooldowns: dict[str, float]):
+        self.rate = rate
+        self.burst = burst
+        self.cooldowns = cooldowns  # Действие -> пауза между повторами, секунды
+        self._buckets: dict[int, TokenBucket] = {}
+        self._until: dict[str, dict[int, float]] = {action: {} for action in cooldowns}  # Действие -> client_id -> конец паузы
+        self._warned: set[int] = set()
+        self._albums: dict[int, tuple[str, bool]] = {}  # client_id -> (последний альбом, пропущен ли он)
+        self._swept = time.monotonic()
+
+    @staticmethod
+    def action(event: Message | CallbackQuery) -> str | None:
+        """Действие с паузой: кнопка меню или отправка контакта"""
+        if isinstance(event, Message):
+            if event.contact:
+                return "contact"
+            if event.text:
+                return route_key(event.text)
+        return None
+
+    async def __call__(self, handler, event: Message | CallbackQuery, data: dict[str, Any]) -> Any:
+        if event.from_user is None or manager_pool.is_manager(event.from_user.id):
+            return await handler(event, data)
+        if isinstance(event, Message) and data.get("raw_state") == DialogState.in_dialog.state:
+            return await handler(event, data)
+        user_id = event.from_user.id
+        now = time.monotonic()
+        if now - self._swept > self.SWEEP_INTERVAL:
+            self._sweep(now)
+
+        album = event.media_group_id if isinstance(event, Message) else None
+        if album and self._albums.get(user_id, ("", False))[0] == album:
+            # Продолжение альбома: токен уже списан (или отказано) по его первой части
+            if self._albums[user_id][1]:
+                return await handler(event, data)
+            metrics.inc("tgbot_throttled_total", (("reason", "rate"),))
+            return None
+
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        allowed = not bucket.delay(now)
+        if album:
+            self._albums[user_id] = (album, allowed)
+        if not allowed:
+            metrics.inc("tgbot_throttled_total", (("reason", "rate"),))
+            if user_id not in self._warned:
+                self._warned.add(user_id)
+                await self._notify(event, "⏳ Слишком много сообщений. Подождите немного.")
+            elif isinstance(event, CallbackQuery):
+                ack(event)
+            return None
+        bucket.take()
+        self._warned.discard(user_id)
+
+        action = self.action(event)
+        if action in self.cooldowns:
+            until = self._until[action]
+            if until.get(user_id, 0) > now:
+                metrics.inc("tgbot_throttled_total", (("reason", "cooldown"),))
+                await self._notify(event, f"⏳ Запрос уже отправлен. Повторить можно через {until[user_id] - now:.0f} с.")
+                return None
+            until[user_id] = now + self.cooldowns[action]
+        return await handler(event, data)
+
+    async def _notify(self, event: Message | CallbackQuery, text: str) -> None:
+        if isinstance(event, CallbackQuery):
+            ack(event, text)
+        else:
+            outbox.submit(event.answer(text))
+
+    def _sweep(self, now: float) -> None:
+        self._swept = now
+        self._buckets = {
+            uid: b for uid, b in self._buckets.items()
+            if b.tokens + (now - b.updated) * b.rate < b.capacity
+        }
+        self._warned &= self._buckets.keys()
+        self._albums = {uid: album for uid, album in self._albums.items() if uid in self._buckets}
+        for action, until in self._until.items():
+            self._until[action] = {uid: t for uid, t in until.items() if t > now}
+
+
+throttling = ThrottlingMiddleware(THROTTLE_RATE, THROTTLE_BURST, {
+    "💬 Начать диалог с менеджером": DIALOG_REQUEST_COOLDOWN,
+    "contact": CALL_REQUEST_COOLDOWN,
+})
+# Порядок важен: сначала ограничение, затем определение роли (загрузка диалога)
+router.message.outer_middleware(throttling)
+router.message.outer_middleware(RoutingMiddleware())
+router.callback_query.outer_middleware(throttling)
+
+# ============================================
+# 🤖 ОСНОВНЫЕ ОБРАБОТЧИКИ
+# ============================================
+
+@menu_route("/start")
+async def cmd_start(message: Message, state: FSMContext, role: str, dialog: DialogRecord | None) -> None:
+    """Стартовая команда"""
+    await state.clear()
+    if role != ROLE_MANAGER:
+        users.add(message.from_user)
+    
+    # Если клиент в активном диалоге — продолжаем диалог
+    if dialog:
+        await state.set_state(DialogState.in_dialog)
+        outbox.submit(message.answer(
+            "💬 Вы возобновили диалог с менеджером.\n"
+            "Все ваши сообщения будут пересылаться менеджеру.\n"
+            "Нажмите «⏹️ Завершить диалог», чтобы выйти.",
+            reply_markup=get_dialog_menu()
+        ))
+        return
+    
+    greeting = (
+        "👋 Добро пожаловать в *«Аквафреска»*!\n\n"
+        "Ваш эксперт в сфере водоочистки в Санкт-Петербурге и Ленинградской области! 🌊\n"
+        "Выберите действие ниже 👇"
+    )
+    outbox.submit(message.answer(greeting, reply_markup=get_main_menu(), parse_mode="Markdown"))
+
+@menu_route("⬅️ Назад")
+async def back_to_menu(message: Message, state: FSMContext, role: str, dialog: DialogRecord | None) -> None:
+    """Возврат в главное меню"""
+    client_id = message.from_user.id
+    
+    # Если клиент в диалоге — завершаем диалог при нажатии «Назад»
+    if dialog and (record := await close_dialog(client_id)):
+        await state.clear()
+        outbox.submit(message.answer(
+            "ℹ️ Диалог с менеджером завершён.\n"
+            "Вы вернулись в главное меню.",
+            reply_markup=get_main_menu()
+        ))
+        # Уведомляем менеджера
+        outbox.submit(
+            SendMessage(chat_id=record.manager_id, text=f"ℹ️ Клиент {client_id} завершил диалог."),
+            priority=PRIORITY_MANAGER
+        )
+        return
+    
+    # Клиент передумал ждать менеджера — убираем его из очереди ожидания
+    withdraw_dialog_request(client_id)
+    await state.clear()
+    outbox.submit(message.answer("↩️ Вы вернулись в главное меню", reply_markup=get_main_menu()))
+
+@menu_route("ℹ️ О компании")
+async def about_company(message: Message, state: FSMContext, role: str, dialog: DialogRecord | None) -> None:
+    """Показать информацию о компании"""
+    if role == ROLE_IN_DIALOG:
+        outbox.submit(message.answer("⚠️ Сначала завершите диалог с менеджером.", reply_markup=get_dialog_menu()))
+        return
+    
+    send_catalog_section(message, CATALOG_ABOUT)
+
+@menu_route("💰 Прайс материалов")
+async def show_price_list(message: Message, state: FSMContext, role: str, dialog: DialogRecord | None) -> None:
+    """Показать прайс-лист"""
+    if role == ROLE_IN_DIALOG:
+        outbox.submit(message.answer("⚠️ Сначала завершите диалог с менеджером.", reply_markup=get_dialog_menu()))
+        return
+    
+    send_catalog_section(message, CATALOG_PRICE)
+
+def send_catalog_section(message: Message, section: str) -> None:
+    """Первая страница раздела каталога; при нескольких страницах — с кнопками листания"""
+    pages = render_cache.pages[section]
+    if len(pages) == 1:
+        outbox.submit(message.answer(pages[0], reply_markup=get_back_menu(), parse_mode=CATALOG_PARSE_MODES[section]))
+        return
+    outbox.submit(message.answer(pages[0], reply_markup=render_cache.page_keyboards[(section, 0)],
+                                 parse_mode=CATALOG_PARSE_MODES[section]))
+    outbox.submit(message.answer("Листайте страницы кнопками ◀️ ▶️", reply_markup=get_back_menu()))
+
+@router.callback_query(CatalogPageCallback.filter())
+async def turn_catalog_page(callback: CallbackQuery, callback_data: CatalogPageCallback) -> None:
+    """Листание раздела каталога: страница подменяется в том же сообщении"""
+    ack(callback)
+    section = callback_data.section
+    pages = render_cache.pages.get(section)
+    if callback_data.page < 0 or not pages or not callback.message:
+        return
+    # Каталог мог сократиться после обновления файла
+    page = min(callback_data.page, len(pages) - 1)
+    outbox.submit(callback.message.edit_text(
+        pages[page], reply_markup=render_cache.page_keyboards.get((section, page)),
+        parse_mode=CATALOG_PARSE_MODES[section]
+    ))
+
+@menu_route("📞 Заказать звонок")
+async def request_contact(message: Message, state: FSMContext, role: str, dialog: DialogRecord | None) -> None:
+    """Запросить контакт для звонка"""
+    if role == ROLE_IN_DIALOG:
+        outbox.submit(message.answer("⚠️ Сначала завершите диалог с менеджером.", reply_markup=get_dialog_menu()))
+        return
+    
+    outbox.submit(message.answer(
+        "📱 Нажмите кнопку ниже, чтобы отправить свой номер телефона.\n"
+        f"Менеджер перезвонит вам в течение {LEAD_SLA // 60} минут.",
+        reply_markup=get_contact_request_menu()
+    ))
+
+@router.message(F.contact)
+async def handle_contact(message: Message, state: FSMContext) -> None:
+    """Заявка на звонок: сохраняется до отправки, повтор номера менеджерам не уходит"""
+    await state.clear()
+    register_lead(message.from_user.id, message.contact.first_name or "Пользователь", message.contact.phone_number)
+
+@on_coordinator
+def register_lead(client_id: int, name: str, phone: str) -> None:
+    lead, created = leads.add(client_id, name, phone)
+    if not created:
+        metrics.inc("tgbot_leads_total", (("kind", "duplicate"),))
+        logger.info(f"Повторная заявка на звонок от {client_id} (заявка #{lead.id})")
+        outbox.submit(SendMessage(
+            chat_id=client_id,
+            text="✅ Ваша заявка уже у менеджера.\n"
+                 f"Менеджер перезвонит вам в течение {LEAD_SLA // 60} минут.",
+            reply_markup=get_main_menu()
+        ))
+        return
+    
+    metrics.inc("tgbot_leads_total", (("kind", "new"),))
+    if leads.busy():
+        # Поток заявок: менеджеры получат их одной сводкой
+        leads.digest.append(lead.id)
+        logger.info(f"Заявка #{lead.id} от {client_id} отложена в сводку")
+    else:
+        send_lead(lead, manager_pool.least_loaded())
+        logger.info(f"Заявка #{lead.id} от {client_id} поставлена в очередь менеджеру")
+    
+    outbox.submit(SendMessage(
+        chat_id=client_id,
+        text="✅ Заявка на звонок принята!\n"
+             f"Менеджер перезвонит вам в течение {LEAD_SLA // 60} минут.",
+        reply_markup=get_main_menu()
+    ))
+
+@router.callback_query(LeadCallback.filter(F.action == "take"))
+async def take_lead_button(callback: CallbackQuery, callback_data: LeadCallback) -> None:
+    """Кнопка «Беру» под заявкой"""
+    if not manager_pool.is_manager(callback.from_user.id):
+        ack(callback)
+        return
+    text, taken = take_lead(callback_data.lead_id, callback.from_user.id)
+    ack(callback, text, show_alert=not taken)
+    if taken and callback.message:
+        outbox.submit(callback.message.edit_reply_markup(reply_markup=None), priority=PRIORITY_MANAGER)
+
+def take_lead(lead_id: int, manager_id: int) -> tuple[str, bool]:
+    """Закрепляет заявку за менеджером; True — заявка за ним"""
+    lead = leads.take(lead_id, manager_id)
+    if lead is None:
+        return f"⚠️ Заявка #{lead_id} не найдена.", False
+    if lead.manager_id != manager_id:
+        return f"ℹ️ Заявку #{lead_id} уже взял менеджер {lead.manager_id}.", False
+    logger.info(f"Менеджер {manager_id} взял заявку #{lead_id}")
+    return f"✅ Заявка #{lead_id} за вами: {lead.name}, +{lead.phone}", True
+
+# ============================================
+# 💬 СИСТЕМА ДИАЛОГА С МЕНЕДЖЕРОМ
+# ============================================
+
+@menu_route("💬 Начать диалог с менеджером")
+async def start_dialog_request(message: Message, state: FSMContext, role: str, dialog: DialogRecord | None) -> None:
+    """Запрос на начало диалога с менеджером"""
+    client_id = message.from_user.id
+    
+    # Проверяем, не в диалоге ли уже клиент
+    if dialog:
+        outbox.submit(message.answer(
+            "💬 Вы уже находитесь в диалоге с менеджером.\n"
+            "Все ваши сообщения пересылаются менеджеру.",
+            reply_markup=get_dialog_menu()
+        ))
+        await state.set_state(DialogState.in_dialog)
+        return
+    
+    username = f"@{message.from_user.username}" if message.from_user.username else "не указан"
+    # Имя задаёт клиент, поэтому оно экранируется (запрос отправляется в HTML-разметке)
+    request_msg = (
+        f"💬 <b>Новый запрос на диалог!</b>\n"
+        f"👤 Имя: {html.escape(message.from_user.full_name)}\n"
+        f"🆔 ID: <code>{client_id}</code>\n"
+        f"🔗 Username: {username}\n\n"
+        f"Нажмите ✅ чтобы начать диалог"
+    )
+    request_dialog(client_id, request_msg)
+
+@on_coordinator
+def request_dialog(client_id: int, request_msg: str) -> None:
+    """Предлагает запрос клиента менеджеру или ставит его в очередь ожидания"""
+    # Повторное нажатие не создаёт новых уведомлений менеджерам
+    if client_id in manager_pool.waiting:
+        position = list(manager_pool.waiting).index(client_id) + 1
+        outbox.submit(SendMessage(
+            chat_id=client_id,
+            text=f"⏳ Вы уже в очереди ожидания менеджера, ваш номер: {position}.",
+            reply_markup=get_back_menu()
+        ))
+        return
+    if dialog_requests.get(client_id):
+        outbox.submit(SendMessage(
+            chat_id=client_id,
+            text="⏳ Запрос уже отправлен менеджеру, ожидайте подключения.",
+            reply_markup=get_back_menu()
+        ))
+        return
+    
+    manager_id = manager_pool.pick(client_id)
+    if manager_id is None:
+        # Все менеджеры заняты — запрос ждёт первого освободившегося
+        position = manager_pool.enqueue(client_id, request_msg)
+        logger.info(f"Запрос на диалог от {client_id} поставлен в очередь ожидания (позиция {position})")
+        outbox.submit(SendMessage(
+            chat_id=client_id,
+            text="⏳ Все менеджеры сейчас заняты.\n"
+                 f"Ваш номер в очереди: {position}. Мы подключим менеджера, как только он освободится.",
+            reply_markup=get_back_menu()
+        ))
+        return
+    
+    # Отправляем запрос менеджеру
+    send_dialog_request(client_id, manager_id, request_msg)
+    logger.info(f"Запрос на диалог от {client_id} поставлен в очередь менеджеру {manager_id}")
+    
+    outbox.submit(SendMessage(
+        chat_id=client_id,
+        text="⏳ Ожидайте подключения менеджера...\n"
+             "Как только менеджер примет запрос, вы сможете общаться в реальном времени.",
+        reply_markup=get_back_menu()
+    ))
+
+@on_coordinator
+def withdraw_dialog_request(client_id: int) -> None:
+    """Снимает запрос клиента на диалог: из очереди ожидания и у менеджера"""
+    manager_pool.cancel(client_id)
+    if request := dialog_requests.pop(client_id):
+        collapse_request_keyboards(request, f"↩️ Клиент {client_id} отозвал запрос на диалог.")
+
+def send_dialog_request(client_id: int, manager_id: int, request_msg: str) -> None:
+    """Отправляет менеджеру запрос на диалог с кнопками «Принять»/«Отклонить»"""
+    async def on_error(error: Exception) -> None:
+        logger.error(f"Ошибка отправки запроса менеджеру {manager_id}: {error}")
+        outbox.submit(SendMessage(
+            chat_id=client_id,
+            text="⚠️ Менеджер временно недоступен. Попробуйте позже или закажите звонок.",
+            reply_markup=get_main_menu()
+        ))
+    
+    dialog_requests.add(client_id, manager_id)
+    future = outbox.submit(
+        SendMessage(
+            chat_id=manager_id,
+            text=request_msg,
+            parse_mode="HTML",
+            reply_markup=get_manager_accept_keyboard(client_id)
+        ),
+        priority=PRIORITY_MANAGER,
+        on_error=on_error
+    )
+    future.add_done_callback(reply_index.recorder(client_id, manager_id))
+    future.add_done_callback(dialog_requests.recorder(client_id))
+
+def collapse_request_keyboards(request: DialogRequest, text: str, keep: tuple[int, int] | None = None) -> None:
+    """Заменяет кнопки «Принять»/«Отклонить» в сообщениях запроса итоговым текстом.
+
+    Правки идут в очередь с низшим приоритетом: при массовом истечении
+    запросов они не задерживают живые диалоги. keep — сообщение, которое
+    обработчик правит сам.
+    """
+    for chat_id, message_id in request.messages:
+        if (chat_id, message_id) != keep:
+            outbox.submit(EditMessageText(chat_id=chat_id, message_id=message_id, text=text), priority=PRIORITY_BULK)
+
+async def dispatch_waiting_requests() -> None:
+    """Предлагает ожидающие запросы менеджерам, у которых появилось место"""
+    while manager_pool.waiting:
+        client_id, request_msg = next(iter(manager_pool.waiting.items()))
+        manager_id = manager_pool.pick(client_id)
+        if manager_id is None:
+            return
+        manager_pool.cancel(client_id)
+        send_dialog_request(client_id, manager_id, request_msg)
+        logger.info(f"Запрос на диалог от {client_id} из очереди ожидания передан менеджеру {manager_id}")
+
+# Клиенты, чей запрос сейчас принимается: повторное нажатие не открывает диалог второй раз
+accepting: set[int] = set()
+
+@router.callback_query(DialogRequestCallback.filter(F.action == "accept"))
+async def accept_dialog(callback: CallbackQuery, callback_data: DialogRequestCallback,
+                        fsm_storage: BaseStorage) -> None:
+    """Менеджер принял запрос на диалог.
+
+    Нажатие подтверждается сразу после проверок в памяти; уведомления
+    и правки сообщений уходят через очередь отправки и ответа не задерживают.
+    """
+    client_id = callback_data.client_id
+    if client_id in accepting:
+        ack(callback, "⏳ Диалог уже открывается.")
+        return
+    accepting.add(client_id)
+    try:
+        await _accept_dialog(callback, client_id, fsm_storage)
+    finally:
+        accepting.discard(client_id)
+
+async def _accept_dialog(callback: CallbackQuery, client_id: int, fsm_storage: BaseStorage) -> None:
+    manager_id = callback.from_user.id
+    record = await get_dialog(client_id)
+    if record:
+        # Диалог уже открыт — повторное нажатие ничего не меняет
+        if record.manager_id == manager_id:
+            ack(callback, f"✅ Диалог с клиентом {client_id} уже начат.")
+        else:
+            ack(callback, "⚠️ Диалог уже принят другим менеджером.", show_alert=True)
+        return
+    request = dialog_requests.get(client_id)
+    if not request:
+        # Запрос истёк или отозван — устаревшая кнопка не открывает диалог
+        ack(callback)
+        outbox.submit(callback.message.edit_text(f"⌛ Запрос клиента {client_id} больше не актуален."),
+                      priority=PRIORITY_MANAGER)
+        return
+    if not manager_pool.has_capacity(manager_id, own_offer=request.manager_id == manager_id):
+        ack(callback, f"⚠️ Достигнут лимит одновременных диалогов ({MANAGER_CAPACITY}).", show_alert=True)
+        return
+    ack(callback, f"✅ Диалог с клиентом {client_id} начат.")
+    
+    # Открываем диалог и закрепляем клиента за принявшим менеджером
+    if request := dialog_requests.pop(client_id):
+        collapse_request_keyboards(request, f"✅ Диалог с клиентом {client_id} уже начат.",
+                                   keep=(callback.message.chat.id, callback.message.message_id))
+    await open_dialog(client_id, manager_id)
+    # Состояние клиента задаётся через ключ его чата в общем FSM-хранилище
+    await FSMContext(
+        storage=fsm_storage, key=StorageKey(bot_id=callback.bot.id, chat_id=client_id, user_id=client_id)
+    ).set_state(DialogState.in_dialog)
+    
+    # Уведомляем менеджера
+    outbox.submit(callback.message.edit_text(
+        f"✅ Диалог с клиентом {client_id} начат.\n"
+        f"Все ваши сообщения будут пересылаться клиенту.\n"
+        f"Чтобы завершить диалог, напишите /стоп_{client_id}"
+    ), priority=PRIORITY_MANAGER)
+    
+    async def on_error(error: Exception) -> None:
+        logger.error(f"Не удалось уведомить клиента {client_id}: {error}")
+        outbox.submit(
+            SendMessage(chat_id=manager_id, text=f"⚠️ Клиент {client_id} заблокировал бота или недоступен."),
+            priority=PRIORITY_MANAGER
+        )
+        await close_dialog(client_id)
+    
+    # Уведомляем клиента
+    outbox.submit(
+        SendMessage(
+            chat_id=client_id,
+            text="✅ Менеджер подключился к диалогу!\n"
+                 "Теперь вы можете общаться в реальном времени.\n"
+                 "Все сообщения будут доставлены мгновенно.",
+            reply_markup=get_dialog_menu()
+        ),
+        on_error=on_error
+    )
+    
+    logger.info(f"Диалог между клиентом {client_id} и менеджером {manager_id} начат")
+
+@router.callback_query(DialogRequestCallback.filter(F.action == "reject"))
+async def reject_dialog(callback: CallbackQuery, callback_data: DialogRequestCallback) -> None:
+    """Менеджер отклонил запрос на диалог"""
+    client_id = callback_data.client_id
+    request = dialog_requests.pop(client_id)
+    if request is None:
+        # Запрос уже принят, отклонён (повторное нажатие) или истёк — сообщение правит тот, кто его обработал
+        ack(callback, f"⌛ Запрос клиента {client_id} уже обработан или истёк.")
+        return
+    ack(callback)
+    collapse_request_keyboards(request, f"❌ Запрос от клиента {client_id} отклонён",
+                               keep=(callback.message.chat.id, callback.message.message_id))
+    
+    # Уведомляем клиента (клиент может быть недоступен — ошибка только логируется)
+    outbox.submit(SendMessage(
+        chat_id=client_id,
+        text="❌ Менеджер временно занят.\n"
+             "Попробуйте начать диалог позже или закажите обратный звонок.",
+        reply_markup=get_main_menu()
+    ))
+    
+    # Уведомляем менеджера
+    outbox.submit(callback.message.edit_text(f"❌ Запрос от клиента {client_id} отклонён"), priority=PRIORITY_MANAGER)
+    logger.info(f"Запрос на диалог от {client_id} отклонён менеджером")
+    # Место, занятое запросом, освободилось
+    await dispatch_waiting_requests()
+
+@menu_route("⏹️ Завершить диалог")
+async def end_dialog_by_client(message: Message, state: FSMContext, role: str, dialog: DialogRecord | None) -> None:
+    """Клиент завершил диалог"""
+    client_id = message.from_user.id
+    
+    if dialog and (record := await close_dialog(client_id)):
+        await state.clear()
+        
+        # Уведомляем менеджера
+        outbox.submit(
+            SendMessage(chat_id=record.manager_id, text=f"ℹ️ Клиент {client_id} завершил диалог."),
+            priority=PRIORITY_MANAGER
+        )
+        
+        outbox.submit(message.answer(
+            "✅ Диалог с менеджером завершён.\n"
+            "Спасибо за обращение! Возвращайтесь в главное меню.",
+            reply_markup=get_main_menu()
+        ))
+        logger.info(f"Клиент {client_id} завершил диалог")
+    else:
+        outbox.submit(message.answer("ℹ️ Диалог уже завершён.", reply_markup=get_main_menu()))
+        await state.clear()
+
+@router.message(is_dialog_message)
+async def forward_client_message_to_manager(message: Message, state: FSMContext, dialog: DialogRecord | None) -> None:
+    """Пересылка сообщений клиента менеджеру во время диалога"""
+    client_id = message.from_user.id
+    
+    # Проверяем, активен ли диалог
+    record = dialog
+    if not record:
+        await state.clear()
+        outbox.submit(message.answer("ℹ️ Диалог завершён. Начните новый диалог через главное меню.", reply_markup=get_main_menu()))
+        return
+    
+    # Обновляем время последней активности (продление срока в куче — O(log n))
+    await touch_dialog(client_id, record.manager_id)
+    manager_id = record.manager_id
+    
+    # Формируем префикс для сообщения
+    prefix = f"👤 Клиент {client_id}"
+    if message.from_user.username:
+        prefix += f" (@{message.from_user.username})"
+    prefix += ":\n\n"
+    
+    async def on_error(error: Exception) -> None:
+        logger.error(f"Ошибка пересылки сообщения менеджеру: {error}")
+        outbox.submit(message.answer(
+            "⚠️ Менеджер временно недоступен. Попробуйте позже.",
+            reply_markup=get_main_menu()
+        ))
+        await close_dialog(client_id)
+        await state.clear()
+    
+    # Серии сообщений склеиваются, содержимое копируется без повторной загрузки
+    coalescer.add(client_id, manager_id, prefix, message, on_error)
+    transcripts.add(client_id, manager_id, FROM_CLIENT, message)
+    client_message_noted(manager_id, client_id, message.from_user.full_name)
+    logger.info(f"Сообщение от клиента {client_id} поставлено в очередь менеджеру")
+
+@on_coordinator
+def client_message_noted(manager_id: int, client_id: int, name: str) -> None:
+    dashboard.client_message(manager_id, client_id, name)
+
+@router.message(is_manager)
+async def forward_manager_message_to_client(message: Message) -> None:
+    """
+    Обработка сообщений от менеджера:
+    1. Команды (/стоп_{id}, /чат_{id}, /история_{id}, /поиск, /панель,
+       /рассылка…, /заявки, /беру_{id}) — обработчик из таблицы manager_routes
+    2. Если менеджер отвечает через reply — пересылаем клиенту
+    3. Обычное сообщение уходит клиенту, выбранному на панели кнопкой 🎯
+    Менеджер управляет только диалогами, закреплёнными за ним.
+    """
+    text = message.text or ""
+    manager_id = message.from_user.id
+    
+    # Команды менеджера — одним поиском по таблице manager_routes
+    if command := manager_routes.get(manager_command_key(text)):
+        await command(message, text)
+        return
+    
+    # Если менеджер отвечает на сообщение клиента через reply
+    if message.reply_to_message:
+        # Клиент определяется по индексу пересланных сообщений (работает и для фото/документов)
+        client_id = resolve_reply_client(message)
+        if client_id:
+            record = await get_dialog(client_id)
+            if record and record.manager_id == manager_id:
+                relay_manager_message(message, client_id)
+                outbox.submit(message.answer(f"✅ Ответ отправлен клиенту {client_id}."), priority=PRIORITY_MANAGER)
+                logger.info(f"Менеджер ответил клиенту {client_id}")
+                return
+    
+    # Клиент, выбранный кнопкой 🎯 на панели, получает обычные сообщения без reply
+    client_id = dashboard.target(manager_id)
+    if client_id and not text.startswith("/"):
+        relay_manager_message(message, client_id)
+        logger.info(f"Менеджер написал выбранному клиенту {client_id}")
+        return
+    
+    # Подсказка менеджеру; список диалогов — на закреплённой панели
+    if manager_id not in dashboard.messages:
+        dashboard.show(manager_id)
+    outbox.submit(message.answer(
+        "ℹ️ Чтобы ответить клиенту, нажмите «ответить» на его сообщение "
+        "или выберите его кнопкой 🎯 на закреплённой панели.\n"
+        "Открыть панель заново: /панель"
+    ), priority=PRIORITY_MANAGER)
+
+@manager_command("/стоп")
+async def stop_dialog_command(message: Message, text: str) -> None:
+    """/стоп_{id} — менеджер завершает свой диалог с клиентом"""
+    try:
+        client_id = int(text.split("_")[1])
+    except (IndexError, ValueError):
+        outbox.submit(message.answer("⚠️ Неверный формат команды. Используйте: /стоп_123456789"), priority=PRIORITY_MANAGER)
+        return
+    record = await get_dialog(client_id)
+    if record and record.manager_id == message.from_user.id and await close_dialog(client_id):
+        outbox.submit(SendMessage(
+            chat_id=client_id,
+            text="ℹ️ Менеджер завершил диалог.\n"
+                 "Спасибо за обращение! Возвращайтесь в главное меню.",
+            reply_markup=get_main_menu()
+        ))
+        outbox.submit(message.answer(f"✅ Диалог с клиентом {client_id} завершён."), priority=PRIORITY_MANAGER)
+        logger.info(f"Менеджер завершил диалог с клиентом {client_id}")
+    else:
+        outbox.submit(message.answer(f"⚠️ Клиент {client_id} не в активном диалоге."), priority=PRIORITY_MANAGER)
+
+def manager_reply(text: str) -> str:
+    """Подпись ответа менеджера; его текст экранируется, чтобы разметка не ломала отправку"""
+    return f"👤 <b>Менеджер ответил:</b>\n\n{html.escape(text)}"
+
+@manager_command("/чат")
+async def chat_command(message: Message, text: str) -> None:
+    """/чат_{id} текст — сообщение клиенту без reply"""
+    manager_id = message.from_user.id
+    try:
+        parts = text.split(" ", 1)
+        client_id = int(parts[0].split("_")[1])
+    except (IndexError, ValueError):
+        outbox.submit(
+            message.answer("⚠️ Неверный формат команды. Используйте: /чат_123456789 текст сообщения"),
+            priority=PRIORITY_MANAGER
+        )
+        return
+    real_text = parts[1] if len(parts) > 1 else ""
+    record = await get_dialog(client_id)
+    if record and record.manager_id == manager_id:
+        outbox.submit(
+            SendMessage(chat_id=client_id, text=manager_reply(real_text), parse_mode="HTML"),
+            on_error=_report_delivery_error(message, client_id)
+        )
+        transcripts.add(client_id, manager_id, FROM_MANAGER, text=real_text)
+        dashboard.read(manager_id, client_id)
+        outbox.submit(message.answer(f"✅ Сообщение отправлено клиенту {client_id}."), priority=PRIORITY_MANAGER)
+        logger.info(f"Менеджер отправил сообщение клиенту {client_id}")
+    else:
+        outbox.submit(message.answer(f"⚠️ Клиент {client_id} не в активном диалоге."), priority=PRIORITY_MANAGER)
+
+@manager_command("/заявки")
+async def list_leads_command(message: Message, text: str) -> None:
+    """/заявки — необработанные заявки на звонок"""
+    open_leads = leads.open()
+    pages = format_lead_list(f"📞 <b>Необработанные заявки: {len(open_leads)}</b>", open_leads) if open_leads \
+        else ["✅ Необработанных заявок нет."]
+    for page in pages:
+        outbox.submit(message.answer(page, parse_mode="HTML"), priority=PRIORITY_MANAGER)
+
+@manager_command("/беру")
+async def take_lead_command(message: Message, text: str) -> None:
+    """/беру_{id} — взять заявку в работу"""
+    try:
+        reply, _ = take_lead(int(route_key(text).split("_")[1]), message.from_user.id)
+    except (IndexError, ValueError):
+        reply = "⚠️ Неверный формат команды. Используйте: /беру_12"
+    outbox.submit(message.answer(reply), priority=PRIORITY_MANAGER)
+
+@manager_command("/панель")
+async def dashboard_command(message: Message, text: str) -> None:
+    """/панель — закрепить панель активных диалогов заново"""
+    dashboard.show(message.from_user.id)
+
+def relay_manager_message(message: Message, client_id: int) -> None:
+    """Отправляет сообщение менеджера клиенту: текст — с подписью, остальное — копированием"""
+    manager_id = message.from_user.id
+    if message.text:
+        method = SendMessage(
+            chat_id=client_id,
+            text=manager_reply(message.text),
+            parse_mode="HTML"
+        )
+    elif has_caption(message):
+        method = CopyMessage(
+            chat_id=client_id,
+            from_chat_id=message.chat.id,
+            message_id=message.message_id,
+            caption=manager_reply(message.caption or ""),
+            parse_mode="HTML"
+        )
+    else:
+        method = CopyMessage(chat_id=client_id, from_chat_id=message.chat.id, message_id=message.message_id)
+    if message_file(message):
+        media_relay.copy(method, message, PRIORITY_CLIENT, _report_delivery_error(message, client_id))
+    else:
+        outbox.submit(method, on_error=_report_delivery_error(message, client_id))
+    transcripts.add(client_id, manager_id, FROM_MANAGER, message)
+    dashboard.read(manager_id, client_id)
+
+@manager_command("/рассылка")
+async def handle_broadcast_command(message: Message, text: str) -> None:
+    """/рассылка текст, ответ «/рассылка» на сообщение, /рассылка_статус, /рассылка_стоп"""
+    command = route_key(text)
+    if not users.enabled:
+        outbox.submit(message.answer("ℹ️ Реестр клиентов не ведётся (USERS_DB_PATH)."), priority=PRIORITY_MANAGER)
+        return
+    if command == "/рассылка_стоп":
+        stopped = broadcaster.stop()
+        outbox.submit(message.answer("⏹️ Рассылка будет остановлена после текущей порции." if stopped
+                                     else "ℹ️ Рассылка не идёт."), priority=PRIORITY_MANAGER)
+        return
+    if command == "/рассылка_статус":
+        current = broadcaster.current
+        status = f"#{current.id} ({current.status}): {current.summary()}" if current else "рассылок не было"
+        outbox.submit(message.answer(f"📣 Клиентов в реестре: {await users.count()}\nПоследняя рассылка {status}"),
+                      priority=PRIORITY_MANAGER)
+        return
+    if command != "/рассылка":
+        outbox.submit(message.answer("⚠️ Команды: /рассылка, /рассылка_статус, /рассылка_стоп"), priority=PRIORITY_MANAGER)
+        return
+    if broadcaster.running:
+        outbox.submit(message.answer("⚠️ Уже идёт рассылка. Статус: /рассылка_статус"), priority=PRIORITY_MANAGER)
+        return
+
+    if message.reply_to_message:
+        source = message.reply_to_message
+    elif text.partition(" ")[2].strip():
+        # Текст рассылки отправляется менеджеру отдельным сообщением, которое затем копируется клиентам;
+        # рассылка дождётся его в фоне, не задерживая обработку обновлений
+        source = outbox.submit(message.answer(text.partition(" ")[2].strip()), priority=PRIORITY_MANAGER)
+    else:
+        outbox.submit(message.answer(
+            "⚠️ Напишите /рассылка текст или ответьте командой /рассылка на готовое сообщение (можно с фото)."
+        ), priority=PRIORITY_MANAGER)
+        return
+    broadcaster.start(message.from_user.id, source)
+
+@router.callback_query(DashboardCallback.filter())
+async def dashboard_action(callback: CallbackQuery, callback_data: DashboardCallback) -> None:
+    """Кнопки панели менеджера: листание и выбор клиента 🎯"""
+    manager_id = callback.from_user.id
+    if not manager_pool.is_manager(manager_id):
+        ack(callback)
+        return
+    if callback_data.action == "page":
+        ack(callback)
+        dashboard.turn(manager_id, callback_data.value)
+        return
+    client_id = callback_data.value
+    dashboard.select(manager_id, client_id)
+    if client_id and dashboard.target(manager_id) != client_id:
+        ack(callback, "⚠️ Диалог с этим клиентом уже завершён.", show_alert=True)
+        return
+    ack(callback, f"🎯 Сообщения уходят клиенту {client_id}" if client_id else "🎯 Выбор клиента сброшен")
+
+@manager_command("/история")
+async def show_transcript(message: Message, text: str) -> None:
+    """Страница истории переписки с клиентом (1 — самые свежие сообщения)"""
+    try:
+        parts = text.split()
+        client_id = int(parts[0].split("_")[1])
+        page = max(int(parts[1]), 1) if len(parts) > 1 else 1
+    except (IndexError, ValueError):
+        outbox.submit(message.answer("⚠️ Неверный формат команды. Используйте: /история_123456789 [страница]"),
+                      priority=PRIORITY_MANAGER)
+        return
+    if not transcripts.enabled:
+        outbox.submit(message.answer("ℹ️ История переписки не ведётся."), priority=PRIORITY_MANAGER)
+        return
+    entries, pages = await transcripts.history(client_id, page)
+    if not entries:
+        outbox.submit(message.answer(f"ℹ️ Нет сообщений клиента {client_id} на странице {page}."),
+                      priority=PRIORITY_MANAGER)
+        return
+    answer = f"📜 История клиента {client_id}, страница {page}/{pages}:\n\n{format_transcript(entries)}"
+    if page < pages:
+        answer += f"\n\nРанее: /история_{client_id} {page + 1}"
+    outbox.submit(message.answer(answer[:tg_cut(answer, MAX_TEXT_LENGTH)]), priority=PRIORITY_MANAGER)
+
+@manager_command("/поиск")
+async def search_transcript_command(message: Message, text: str) -> None:
+    """/поиск текст — поиск по истории переписки"""
+    await search_transcript(message, text.partition(" ")[2].strip())
+
+async def search_transcript(message: Message, query: str) -> None:
+    """Поиск по истории переписки всех клиентов"""
+    if not query:
+        outbox.submit(message.answer("⚠️ Укажите текст: /поиск фильтр для скважины"), priority=PRIORITY_MANAGER)
+        return
+    if not transcripts.enabled:
+        outbox.submit(message.answer("ℹ️ История переписки не ведётся."), priority=PRIORITY_MANAGER)
+        return
+    entries = await transcripts.search(query)
+    if not entries:
+        outbox.submit(message.answer(f"🔍 По запросу «{query}» ничего не найдено."), priority=PRIORITY_MANAGER)
+        return
+    answer = f"🔍 Найдено по запросу «{query}»:\n\n{format_transcript(entries, with_client=True)}"
+    outbox.submit(message.answer(answer[:tg_cut(answer, MAX_TEXT_LENGTH)]), priority=PRIORITY_MANAGER)
+
+def _report_delivery_error(message: Message, client_id: int) -> Callable[[Exception], Awaitable[None]]:
+    """Колбэк очереди: сообщает менеджеру, что сообщение клиенту не доставлено"""
+    async def on_error(error: Exception) -> None:
+        outbox.submit(
+            message.answer(f"❌ Не удалось отправить сообщение клиенту {client_id}: {error}"),
+            priority=PRIORITY_MANAGER
+        )
+    return on_error
+
+@router.message()
+async def unknown_message(message: Message, state: FSMContext) -> None:
+    """Обработка неизвестных команд (сообщения клиентов в диалоге сюда не попадают)"""
+    outbox.submit(message.answer(
+        "❓ Я понимаю только команды из меню.\n"
+        "Выберите действие ниже 👇",
+        reply_markup=get_main_menu()
+    ))
+
+@router.callback_query()
+async def stale_callback(callback: CallbackQuery) -> None:
+    """Кнопки прежнего формата, с неверной подписью или от старой версии бота"""
+    ack(callback, "⌛ Кнопка устарела.")
+
+# ============================================
+# 🧹 ФОНОВАЯ ЗАДАЧА: ОЧИСТКА НЕАКТИВНЫХ ДИАЛОГОВ
+# ============================================
+
+async def cleanup_inactive_dialogs(bot: Bot):
+    """Завершает диалоги без активности дольше DIALOG_TIMEOUT.
+
+    Вместо периодического обхода всех диалогов задача спит до ближайшего
+    срока в очереди dialog_expiry и обрабатывает только истёкшие диалоги.
+    Уведомления идут в очередь отправки с низшим приоритетом, чтобы массовое
+    истечение не задерживало живые диалоги.
+    """
+    while True:
+        for client_id in await dialog_expiry.wait_due():
+            # Другой процесс мог продлить диалог — перепроверяем по хранилищу
+            record = await dialog_store.get(client_id)
+            if record is None:
+                continue
+            if record.last_active + DIALOG_TIMEOUT > time.time():
+                dialog_expiry.touch(client_id, record.last_active)
+                continue
+            if not await close_dialog(client_id):
+                continue
+            dialog_expiry.expired_total += 1
+            outbox.submit(SendMessage(
+                chat_id=client_id,
+                text="ℹ️ Диалог автоматически завершён из-за неактивности.\n"
+                     "Чтобы начать новый диалог, нажмите «💬 Начать диалог с менеджером».",
+                reply_markup=get_main_menu()
+            ), priority=PRIORITY_BULK)
+            logger.info(f"Неактивный диалог с клиентом {client_id} завершён автоматически")
+        logger.info(
+            f"Диалоги: ожидают истечения — {dialog_expiry.pending}, "
+            f"завершено по неактивности — {dialog_expiry.expired_total}"
+        )
+
+
+async def expire_dialog_requests() -> None:
+    """Снимает запросы на диалог, на которые не ответили за DIALOG_REQUEST_TTL.
+
+    Кнопки всех истёкших за проход запросов сворачиваются одной пачкой
+    правок в очереди отправки, клиенты получают уведомление.
+    """
+    while True:
+        expired = await dialog_requests.wait_expired()
+        for client_id, request in expired:
+            collapse_request_keyboards(request, f"⌛ Запрос клиента {client_id} истёк без ответа.")
+            outbox.submit(SendMessage(
+                chat_id=client_id,
+                text="⌛ Менеджер не успел ответить на запрос.\n"
+                     "Попробуйте начать диалог позже или закажите обратный звонок.",
+                reply_markup=get_main_menu()
+            ), priority=PRIORITY_BULK)
+        logger.info(f"Истекло запросов на диалог: {len(expired)}, ожидают ответа — {len(dialog_requests)}")
+        await dispatch_waiting_requests()
+
+async def watch_leads() -> None:
+    """Сводки накопившихся заявок, предупреждения о просроченных и очистка старых"""
+    tick = min(LEAD_DIGEST_INTERVAL or 60, 60)
+    while True:
+        await asyncio.sleep(tick)
+        if batch := leads.take_digest():
+            notify_managers(format_lead_list(f"📋 <b>Новые заявки на звонок: {len(batch)}</b>", batch))
+            logger.info(f"Отправлена сводка заявок: {len(batch)}")
+        if overdue := leads.overdue():
+            metrics.inc("tgbot_leads_overdue_total", value=len(overdue))
+            notify_managers(format_lead_list(
+                f"⏰ <b>Не перезвонили в течение {LEAD_SLA // 60} минут: {len(overdue)}</b>", overdue
+            ))
+            logger.warning(f"Просрочено заявок на звонок: {len(overdue)}")
+        leads.prune()
+
+# ============================================
+# 🔄 ФОНОВАЯ ЗАДАЧА: ОБНОВЛЕНИЕ КАТАЛОГА ИЗ ФАЙЛА
+# ============================================
+
+def catalog_signature(path: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+async def reload_catalog(path: str) -> bool:
+    """Загружает каталог из файла и подменяет его в render_cache; False — файл не применён"""
+    try:
+        price_list, company_info = await asyncio.to_thread(load_catalog, path)
+    except (OSError, ValueError) as e:
+        logger.error(f"Каталог {path} не применён, остаётся прежний: {e}")
+        return False
+    changed = render_cache.rebuild_catalog(price_list, company_info)
+    if changed:
+        pages = ", ".join(f"{section} — {len(render_cache.pages[section])} стр." for section in changed)
+        logger.info(f"Каталог обновлён из {path}: {pages}")
+    return True
+
+
+async def watch_catalog(path: str, signature: tuple[int, int] | None) -> None:
+    """Следит за файлом каталога и применяет его после каждого изменения.
+
+    Изменение определяется по времени модификации и размеру файла, так что
+    проверка раз в CATALOG_WATCH_INTERVAL секунд почти ничего не стоит.
+    Файл с ошибкой не применяется — бот продолжает работать с прежним
+    каталогом до следующего исправления.
+    """
+    while True:
+        await asyncio.sleep(CATALOG_WATCH_INTERVAL)
+        current = catalog_signature(path)
+        if current is None or current == signature:
+            continue
+        signature = current
+        await reload_catalog(path)
+
+# ============================================
+# 🌐 WEBHOOK-СЕРВЕР
+# ============================================
+
+class UpdateFeeder:
+    """Ограниченная очередь принятых обновлений и UPDATE_CONCURRENCY рабочих
+    задач, передающих их в диспетчер. При остановке новые обновления не
+    принимаются, а уже принятые дорабатываются (не дольше SHUTDOWN_TIMEOUT).
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot):
+        self.dp = dp
+        self.bot = bot
+        self._queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+        self._workers: list[asyncio.Task] = []
+        self._closing = False
+
+    def start_workers(self) -> None:
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(UPDATE_CONCURRENCY)]
+
+    async def _worker(self) -> None:
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.dp.feed_raw_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def drain(self) -> None:
+        """Перестаёт принимать обновления и дорабатывает уже принятые"""
+        self._closing = True
+        try:
+            await asyncio.wait_for(self._queue.join(), SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не обработано обновлений при остановке: {self._queue.qsize()}")
+        for worker in self._workers:
+            worker.cancel()
+
+
+def wait_for_stop_signal() -> asyncio.Event:
+    """Событие, которое устанавливается по SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+
+class WebhookServer(UpdateFeeder):
+    """Приём обновлений через webhook с ограниченной параллельной обработкой.
+
+    HTTP-обработчик только кладёт обновление в ограниченную очередь и сразу
+    отвечает Telegram. При переполнении очереди возвращается 503, и Telegram
+    доставит обновление повторно.
+    """
+
+    async def handle(self, request: "web.Request") -> "web.Response":
+        from aiohttp import web
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        if self._closing:
+            return web.Response(status=503)
+        try:
+            self._queue.put_nowait(await request.json())
+        except asyncio.QueueFull:
+            logger.warning("Очередь обновлений переполнена, Telegram повторит доставку")
+            return web.Response(status=503)
+        return web.Response()
+
+    def build_app(self) -> "web.Application":
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        return app
+
+    async def run(self) -> None:
+        """Запускает сервер и ждёт SIGINT/SIGTERM"""
+        from aiohttp import web
+        runner = web.AppRunner(self.build_app())
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        self.start_workers()
+
+        await self.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=self.dp.resolve_used_update_types(),
+            drop_pending_updates=DROP_PENDING_UPDATES,
+        )
+        logger.info(f"Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+        stop = wait_for_stop_signal()
+        await self.dp.emit_startup(bot=self.bot)
+        try:
+            await stop.wait()
+        finally:
+            await self.drain()
+            await runner.cleanup()
+            await self.dp.emit_shutdown(bot=self.bot)
+
+# ============================================
+# 🧩 ШАРДИРОВАННЫЙ РЕЖИМ (WORKERS > 1)
+# ============================================
+
+def shard_socket_path(index: int) -> str:
+    return os.path.join(SHARD_SOCKET_DIR, f"shard-{index}.sock")
+
+
+def shard_of(update: dict) -> int:
+    """Номер обработчика для обновления: по отправителю, менеджеры — координатору.
+
+    Разбирается только JSON без построения моделей aiogram, поэтому
+    приёмнику хватает малой доли ядра.
+    """
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        sender = event.get("from") or event.get("chat") or {}
+        user_id = sender.get("id", 0)
+        return 0 if manager_pool.is_manager(user_id) else user_id % WORKERS
+    return 0
+
+
+class ShardLink:
+    """Упорядоченная отправка обновлений одному обработчику по Unix-сокету.
+
+    Обновления шарда идут через одну очередь и одно соединение, поэтому
+    обработчик получает их в порядке приёма. Пока обработчик перезапускается,
+    обновления ждут в очереди (не больше UPDATE_QUEUE_SIZE), а строка,
+    на которой оборвалось соединение, отправляется заново. Потеряться могут
+    только обновления, уже переданные упавшему процессу.
+    """
+
+    RECONNECT_DELAY = 0.5
+
+    def __init__(self, index: int, maxsize: int = UPDATE_QUEUE_SIZE):
+        self.index = index
+        self.path = shard_socket_path(index)
+        self._queue: asyncio.Queue[bytes] = asyncio.Queue(maxsize=maxsize)
+        self._task: asyncio.Task | None = None
+
+    @staticmethod
+    def encode(update: dict) -> bytes:
+        return json.dumps(update, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._send_loop(), name=f"shard_link_{self.index}")
+
+    def offer(self, update: dict) -> bool:
+        """Ставит обновление в очередь без ожидания; False — очередь переполнена"""
+        try:
+            self._queue.put_nowait(self.encode(update))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def put(self, update: dict) -> None:
+        await self._queue.put(self.encode(update))
+
+    def call(self, name: str, args: tuple) -> None:
+        """Передаёт координатору вызов функции on_coordinator (очередь связи с ним не ограничена)"""
+        self._queue.put_nowait(self.encode({"call": name, "args": args}))
+
+    async def _send_loop(self) -> None:
+        writer: asyncio.StreamWriter | None = None
+        line: bytes | None = None
+        try:
+            while True:
+                if line is None:
+                    line = await self._queue.get()
+                try:
+                    if writer is None:
+                        _, writer = await asyncio.open_unix_connection(self.path)
+                    writer.write(line)
+                    await writer.drain()
+                except OSError:
+                    # Обработчик ещё не запущен или перезапускается
+                    if writer is not None:
+                        writer.close()
+                        writer = None
+                    await asyncio.sleep(self.RECONNECT_DELAY)
+                    continue
+                self._queue.task_done()
+                line = None
+        finally:
+            if writer is not None:
+                writer.close()
+
+    async def close(self, timeout: float) -> None:
+        """Досылает очередь (не дольше timeout) и закрывает соединение"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Обработчику #{self.index} не передано обновлений: {self._queue.qsize()}")
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+class ShardServer(UpdateFeeder):
+    """Процесс-обработчик: принимает обновления от приёмника по Unix-сокету.
+
+    Любой обработчик ведёт диалоги своих клиентов сам: диалоги и FSM лежат
+    в Redis. Координатору (№0) другие обработчики присылают по тому же сокету
+    только вызовы on_coordinator — изменения учёта менеджеров, запросов,
+    панелей и заявок; он выполняет их по порядку поступления.
+    """
+
+    LINE_LIMIT = 2 ** 22  # Обновление в одной строке JSON
+
+    def __init__(self, dp: Dispatcher, bot: Bot):
+        global coordinator_link
+        super().__init__(dp, bot)
+        if not IS_COORDINATOR:
+            coordinator_link = ShardLink(0, maxsize=0)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                item = json.loads(line)
+                if "call" in item:
+                    await run_coordinator_call(item["call"], item["args"])
+                    continue
+                # Очередь не отбрасывает обновления: при переполнении приёмник ждёт
+                await self._queue.put(item)
+        except (ConnectionError, ValueError) as e:
+            logger.error(f"Соединение с приёмником прервано: {e}")
+        finally:
+            writer.close()
+
+    async def run(self) -> None:
+        """Слушает сокет шарда и ждёт SIGINT/SIGTERM"""
+        path = shard_socket_path(SHARD_INDEX)
+        if os.path.exists(path):
+            os.remove(path)  # Сокет предыдущего, аварийно завершившегося процесса
+        server = await asyncio.start_unix_server(self._serve, path, limit=self.LINE_LIMIT)
+        self.start_workers()
+        if coordinator_link:
+            coordinator_link.start()
+        logger.info(f"Обработчик #{SHARD_INDEX} из {WORKERS} слушает {path}")
+
+        stop = wait_for_stop_signal()
+        await self.dp.emit_startup(bot=self.bot)
+        try:
+            await stop.wait()
+        finally:
+            server.close()
+            await self.drain()
+            await self.dp.emit_shutdown(bot=self.bot)
+
+
+class Supervisor:
+    """Шардированный режим: приёмник обновлений и WORKERS процессов-обработчиков.
+
+    Приёмник (polling или webhook) не строит модели aiogram: он берёт
+    отправителя из JSON и отдаёт обновление обработчику user_id % WORKERS,
+    так что обновления одного пользователя всегда обрабатываются одним
+    процессом и по порядку. Обновления менеджеров идут координатору (№0).
+    Состояние диалогов и FSM общее (Redis), поэтому диалог клиента ведёт его
+    обработчик, а координатору передаются только изменения учёта (on_coordinator). Упавший обработчик
+    перезапускается с нарастающей задержкой.
+    """
+
+    POLL_TIMEOUT = 10
+    RESTART_DELAY_MAX = 30.0
+    STABLE_UPTIME = 60.0  # Проработавший столько обработчик перезапускается без задержки
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.links = [ShardLink(index) for index in range(workers)]
+        self._processes: dict[int, asyncio.subprocess.Process] = {}
+        self._stopping = False
+
+    async def _supervise(self, index: int) -> None:
+        delay = 1.0
+        while not self._stopping:
+            started = time.monotonic()
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), env={**os.environ, "SHARD_INDEX": str(index)}
+            )
+            self._processes[index] = process
+            logger.info(f"Запущен обработчик #{index} (PID {process.pid})")
+            code = await process.wait()
+            if self._stopping:
+                return
+            if time.monotonic() - started > self.STABLE_UPTIME:
+                delay = 1.0
+            logger.error(f"Обработчик #{index} завершился с кодом {code}, перезапуск через {delay:.0f} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.RESTART_DELAY_MAX)
+
+    async def _poll(self, bot: Bot, allowed_updates: list[str]) -> None:
+        """getUpdates без разбора обновлений в модели aiogram"""
+        await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+        http = await bot.session.create_session()
+        url = bot.session.api.api_url(bot.token, "getUpdates")
+        timeout = ClientTimeout(total=self.POLL_TIMEOUT + API_CONNECT_TIMEOUT, sock_connect=API_CONNECT_TIMEOUT)
+        offset = 0
+        try:
+            while True:
+                payload = {"offset": offset, "timeout": self.POLL_TIMEOUT, "allowed_updates": allowed_updates}
+                try:
+                    async with http.post(url, json=payload, timeout=timeout) as response:
+                        data = await response.json()
+                except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                    logger.warning(f"Ошибка getUpdates: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                if not data.get("ok"):
+                    retry_after = data.get("parameters", {}).get("retry_after", 1)
+                    logger.warning(f"getUpdates отклонён: {data.get('description')}, повтор через {retry_after} с")
+                    await asyncio.sleep(retry_after)
+                    continue
+                for update in data["result"]:
+                    await self.links[shard_of(update)].put(update)
+                    offset = update["update_id"] + 1
+        finally:
+            if offset:
+                # Подтверждаем переданные обновления, чтобы Telegram не прислал их повторно после перезапуска
+                with suppress(ClientError, asyncio.TimeoutError):
+                    async with http.post(url, json={"offset": offset, "timeout": 0, "limit": 1}, timeout=timeout):
+                        pass
+
+    async def _handle_webhook(self, request: "web.Request") -> "web.Response":
+        from aiohttp import web
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        update = await request.json()
+        if not self.links[shard_of(update)].offer(update):
+            logger.warning("Очередь обработчика переполнена, Telegram повторит доставку")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _serve_webhook(self, bot: Bot, allowed_updates: list[str]) -> "web.AppRunner":
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self._handle_webhook)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=allowed_updates,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+        )
+        logger.info(f"Webhook-приёмник слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        return runner
+
+    async def _stop_processes(self) -> None:
+        self._stopping = True
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.terminate()
+        for index, process in self._processes.items():
+            try:
+                # Обработчику нужно дождаться своих обновлений и очереди отправки
+                await asyncio.wait_for(process.wait(), SHUTDOWN_TIMEOUT * 3)
+            except asyncio.TimeoutError:
+                logger.warning(f"Обработчик #{index} не завершился, принудительная остановка")
+                process.kill()
+
+    async def run(self) -> None:
+        os.makedirs(SHARD_SOCKET_DIR, exist_ok=True)
+        supervisors = [asyncio.create_task(self._supervise(index)) for index in range(self.workers)]
+        for link in self.links:
+            link.start()
+
+        bot = Bot(token=BOT_TOKEN, session=build_session())
+        probe = Dispatcher()
+        probe.include_router(router)
+        allowed_updates = probe.resolve_used_update_types()
+        logger.info(f"Шардированный режим: обработчиков — {self.workers}, сокеты в {SHARD_SOCKET_DIR}")
+
+        stop = wait_for_stop_signal()
+        runner = None
+        receiver = None
+        try:
+            if BOT_MODE == "webhook":
+                runner = await self._serve_webhook(bot, allowed_updates)
+            else:
+                receiver = asyncio.create_task(self._poll(bot, allowed_updates))
+            await stop.wait()
+        finally:
+            if receiver:
+                receiver.cancel()
+                await asyncio.gather(receiver, return_exceptions=True)
+            if runner:
+                await runner.cleanup()
+            for link in self.links:
+                await link.close(SHUTDOWN_TIMEOUT)
+            await self._stop_processes()
+            for task in supervisors:
+                task.cancel()
+            await asyncio.gather(*supervisors, return_exceptions=True)
+            await bot.session.close()
+            logger.info("Приёмник и обработчики остановлены")
+
+# ============================================
+# 📈 МЕТРИКИ
+# ============================================
+
+class Metrics:
+    """Счётчики и гистограммы в памяти с выдачей в текстовом формате Prometheus"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.help: dict[str, tuple[str, str]] = {}  # имя -> (тип, описание)
+        self.counters: dict[str, dict[tuple, float]] = defaultdict(lambda: defaultdict(float))
+        # имя -> метки -> [счётчики по корзинам..., сумма, количество]
+        self.histograms: dict[str, dict[tuple, list[float]]] = defaultdict(dict)
+        self.gauges: dict[str, Callable[[], Awaitable[float]]] = {}
+
+    def describe(self, name: str, kind: str, text: str) -> None:
+        self.help[name] = (kind, text)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        self.counters[name][labels] += value
+
+    def observe(self, name: str, value: float, labels: tuple = ()) -> None:
+        series = self.histograms[name].get(labels)
+        if series is None:
+            series = self.histograms[name][labels] = [0.0] * (len(self.BUCKETS) + 2)
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def gauge(self, name: str, text: str, getter: Callable[[], Awaitable[float]]) -> None:
+        self.describe(name, "gauge", text)
+        self.gauges[name] = getter
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{key}="{value}"' for key, value in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    async def render(self) -> str:
+        lines = []
+        for name, (kind, text) in self.help.items():
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for labels, value in self.counters[name].items():
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+            elif kind == "histogram":
+                for labels, series in self.histograms[name].items():
+                    for bound, count in zip(self.BUCKETS, series):
+                        le = self._labels(labels, 'le="%s"' % bound)
+                        lines.append(f"{name}_bucket{le} {count}")
+                    le = self._labels(labels, 'le="+Inf"')
+                    lines.append(f"{name}_bucket{le} {series[-1]}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {series[-2]}")
+                    lines.append(f"{name}_count{self._labels(labels)} {series[-1]}")
+            elif kind == "gauge":
+                lines.append(f"{name} {await self.gauges[name]()}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("tgbot_updates_total", "counter", "Полученные обновления по типам")
+metrics.describe("tgbot_update_seconds", "histogram", "Полное время обработки обновления")
+metrics.describe("tgbot_handler_seconds", "histogram", "Время работы обработчика")
+metrics.describe("tgbot_api_request_seconds", "histogram", "Время запроса к Bot API")
+metrics.describe("tgbot_api_errors_total", "counter", "Ошибки запросов к Bot API")
+metrics.describe("tgbot_throttled_total", "counter", "Отброшенные обновления клиентов (флуд и повторные запросы)")
+metrics.describe("tgbot_leads_total", "counter", "Заявки на звонок: новые и повторные")
+metrics.describe("tgbot_leads_overdue_total", "counter", "Заявки, не взятые в работу за LEAD_SLA")
+metrics.describe("tgbot_media_fallbacks_total", "counter", "Медиа, отправленные заново после неудачного копирования")
+
+
+async def _active_dialogs_count() -> float:
+    return await dialog_store.count()
+
+
+async def _send_queue_depth() -> float:
+    return outbox.depth
+
+
+async def _pending_expiry() -> float:
+    return dialog_expiry.pending
+
+
+async def _expired_dialogs() -> float:
+    return dialog_expiry.expired_total
+
+
+async def _waiting_requests() -> float:
+    return len(manager_pool.waiting)
+
+
+async def _pending_requests() -> float:
+    return len(dialog_requests)
+
+
+async def _open_leads() -> float:
+    return len(leads.open())
+
+
+metrics.gauge("tgbot_active_dialogs", "Активные диалоги", _active_dialogs_count)
+metrics.gauge("tgbot_send_queue_depth", "Запросы в очереди отправки", _send_queue_depth)
+metrics.gauge("tgbot_dialogs_pending_expiry", "Диалоги, ожидающие истечения", _pending_expiry)
+metrics.gauge("tgbot_dialogs_expired", "Диалоги, завершённые по неактивности", _expired_dialogs)
+metrics.gauge("tgbot_waiting_requests", "Запросы в очереди ожидания менеджера", _waiting_requests)
+metrics.gauge("tgbot_pending_requests", "Запросы на диалог, ожидающие ответа менеджера", _pending_requests)
+metrics.gauge("tgbot_open_leads", "Заявки на звонок, ещё не взятые в работу", _open_leads)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware диспетчера: счётчик и время обработки обновлений"""
+
+    async def __call__(self, handler, event, data: dict[str, Any]) -> Any:
+        update_type = event.event_type
+        metrics.inc("tgbot_updates_total", (("type", update_type),))
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.observe("tgbot_update_seconds", time.perf_counter() - started, (("type", update_type),))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware роутера: время работы конкретного обработчика"""
+
+    async def __call__(self, handler, event, data: dict[str, Any]) -> Any:
+        name = (data.get("route") or data["handler"].callback).__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.observe("tgbot_handler_seconds", time.perf_counter() - started, (("handler", name),))
+
+
+class APIMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время и ошибки запросов к Bot API"""
+
+    async def __call__(self, make_request, bot: Bot, method: TelegramMethod):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("tgbot_api_errors_total", (("method", name), ("error", type(e).__name__)))
+            raise
+        finally:
+            metrics.observe("tgbot_api_request_seconds", time.perf_counter() - started, (("method", name),))
+
+
+def setup_metrics(dp: Dispatcher, bot: Bot) -> None:
+    """Подключает сбор метрик к диспетчеру, роутеру и сессии бота"""
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    router.message.middleware(HandlerMetricsMiddleware())
+    router.callback_query.middleware(HandlerMetricsMiddleware())
+    bot.session.middleware(APIMetricsMiddleware())
+
+
+async def start_metrics_server() -> "web.AppRunner":
+    """Запускает HTTP-эндпоинт /metrics"""
+    from aiohttp import web
+
+    async def handle(request: "web.Request") -> "web.Response":
+        return web.Response(text=await metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+# ============================================
+# ♻️ ЖИЗНЕННЫЙ ЦИКЛ И СНИМОК СОСТОЯНИЯ
+# ============================================
+
+class InFlightMiddleware(BaseMiddleware):
+    """Внешний middleware диспетчера: учёт обновлений, которые ещё обрабатываются"""
+
+    def __init__(self):
+        self.count = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event, data: dict[str, Any]) -> Any:
+        self.count += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.count -= 1
+            if not self.count:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """Ждёт завершения всех обработчиков; False — не дождались за timeout"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class BotLifecycle:
+    """Запуск и корректная остановка бота.
+
+    При запуске поднимает хранилище диалогов, восстанавливает снимок
+    состояния, запускает очередь отправки и фоновые задачи. При остановке
+    дожидается обработчиков, досылает склеенные сообщения и очередь
+    отправки, сохраняет снимок и останавливает фоновые задачи.
+
+    Снимок (SNAPSHOT_PATH, JSON в gzip) содержит то, что иначе теряется при
+    перезапуске: диалоги и FSM-состояния при хранении в памяти, индекс
+    ответов менеджера, запросы на диалог, очередь ожидания менеджера и
+    закреплённые панели менеджеров. После восстановления файл удаляется,
+    чтобы после аварийного завершения не вернуть устаревшее состояние.
+    """
+
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, dp: Dispatcher, bot: Bot):
+        self.dp = dp
+        self.bot = bot
+        self.in_flight = InFlightMiddleware()
+        dp.update.outer_middleware(self.in_flight)
+        self._tasks: list[asyncio.Task] = []
+        self._metrics_runner: "web.AppRunner | None" = None
+
+    def spawn(self, coro: Awaitable, name: str) -> asyncio.Task:
+        """Фоновая задача, которая будет остановлена при завершении бота"""
+        task = asyncio.create_task(coro, name=name)
+        self._tasks.append(task)
+        return task
+
+    async def startup(self) -> None:
+        global dialog_store
+        dialog_store = build_dialog_store()
+        await dialog_store.start()
+        await users.start()
+        # Историю пишет каждый процесс: диалог клиента ведёт его обработчик (см. SQLiteWriteBehind)
+        await transcripts.start()
+        outbox.start(self.bot, SharedRateLimit.from_url(REDIS_URL, SEND_GLOBAL_RATE) if SHARD_INDEX >= 0 else None)
+        if IS_COORDINATOR:
+            await self.start_coordinator()
+        if CATALOG_PATH:
+            signature = catalog_signature(CATALOG_PATH)
+            if not await reload_catalog(CATALOG_PATH):
+                logger.warning("Используется встроенный каталог")
+            self.spawn(watch_catalog(CATALOG_PATH, signature), "watch_catalog")
+        if METRICS_PORT:
+            self._metrics_runner = await start_metrics_server()
+
+    async def start_coordinator(self) -> None:
+        """Учёт диалогов, менеджеры, заявки и рассылки: в шардированном режиме — только в обработчике №0"""
+        await leads.start()
+        restored = await self.restore()
+        await restore_dialog_expiry()
+        logger.info(f"Хранилище диалогов: {DIALOG_BACKEND}, активных диалогов: {await dialog_store.count()}")
+        if restored:
+            # Менеджеры могли освободиться, пока бот был остановлен
+            await dispatch_waiting_requests()
+        self.spawn(cleanup_inactive_dialogs(self.bot), "cleanup_inactive_dialogs")
+        self.spawn(expire_dialog_requests(), "expire_dialog_requests")
+        self.spawn(watch_leads(), "watch_leads")
+        if users.enabled:
+            await broadcaster.resume()
+
+    async def shutdown(self) -> None:
+        started = time.monotonic()
+        if not await self.in_flight.wait_idle(SHUTDOWN_TIMEOUT):
+            logger.warning(f"Не дождались обработчиков при остановке: {self.in_flight.count}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await broadcaster.close()
+        coalescer.flush_all()
+        await media_relay.close(SHUTDOWN_TIMEOUT)
+        await outbox.close(SHUTDOWN_TIMEOUT)
+        if coordinator_link:
+            # Связь закрывается после очереди отправки: вызовы учёта, поставленные при её досылке
+            # (записи индекса ответов для склеенных сообщений), тоже доходят до координатора
+            await coordinator_link.close(SHUTDOWN_TIMEOUT)
+        await self.save()
+        await dialog_store.close()
+        await transcripts.close()
+        await users.close()
+        await leads.close()
+        if self._metrics_runner:
+            await self._metrics_runner.cleanup()
+        await self.bot.session.close()
+        logger.info(f"Бот остановлен за {time.monotonic() - started:.2f} с")
+
+    async def snapshot(self) -> dict[str, Any]:
+        """Собирает состояние, которое не переживает перезапуск само по себе"""
+        state: dict[str, Any] = {
+            "version": self.SNAPSHOT_VERSION,
+            "saved_at": time.time(),
+            "reply_index": reply_index.dump(),
+            "waiting": list(manager_pool.waiting.items()),
+            "requests": dialog_requests.dump(),
+            "dashboards": {str(manager_id): message_id for manager_id, message_id in dashboard.messages.items()},
+            "media": {"token": token_fingerprint(), "files": media_relay.files.dump()},
+        }
+        # SQLite и Redis сохраняют диалоги сами
+        if isinstance(dialog_store, MemoryDialogStore) and not isinstance(dialog_store, SQLiteDialogStore):
+            state["dialogs"] = {
+                str(client_id): asdict(record) for client_id, record in (await dialog_store.all()).items()
+            }
+        storage = self.dp.fsm.storage
+        if isinstance(storage, MemoryStorage):
+            state["fsm"] = [
+                [asdict(key), record.state, record.data]
+                for key, record in storage.storage.items()
+                if record.state is not None or record.data
+            ]
+        return state
+
+    async def save(self) -> None:
+        if not SNAPSHOT_PATH or not IS_COORDINATOR:
+            return
+        import gzip
+
+        state = await self.snapshot()
+        raw = gzip.compress(json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode())
+
+        def write() -> None:
+            tmp = SNAPSHOT_PATH + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(raw)
+            os.replace(tmp, SNAPSHOT_PATH)
+
+        try:
+            await asyncio.to_thread(write)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить снимок состояния: {e}")
+            return
+        logger.info(
+            f"Снимок состояния сохранён в {SNAPSHOT_PATH} ({len(raw)} байт): "
+            f"диалогов — {len(state.get('dialogs', ()))}, FSM — {len(state.get('fsm', ()))}, "
+            f"ответов в индексе — {len(state['reply_index'])}"
+        )
+
+    async def restore(self) -> bool:
+        """Восстанавливает снимок, если он есть; True — состояние восстановлено"""
+        if not SNAPSHOT_PATH or not os.path.exists(SNAPSHOT_PATH):
+            return False
+        import gzip
+
+        def read() -> dict[str, Any]:
+            with open(SNAPSHOT_PATH, "rb") as f:
+                return json.loads(gzip.decompress(f.read()))
+
+        try:
+            state = await asyncio.to_thread(read)
+        except (OSError, ValueError) as e:
+            logger.error(f"Снимок состояния {SNAPSHOT_PATH} не прочитан: {e}")
+            return False
+        if state.get("version") != self.SNAPSHOT_VERSION:
+            logger.warning(f"Пропущен снимок состояния неизвестной версии {state.get('version')}")
+            return False
+
+        for client_id, record in state.get("dialogs", {}).items():
+            await dialog_store.put(int(client_id), DialogRecord(**record))
+        storage = self.dp.fsm.storage
+        if isinstance(storage, MemoryStorage):
+            for key, fsm_state, data in state.get("fsm", ()):
+                key = StorageKey(**key)
+                await storage.set_state(key, fsm_state)
+                await storage.set_data(key, data)
+        reply_index.load(state.get("reply_index", ()))
+        dialog_requests.load(state.get("requests", {}))
+        dashboard.messages.update({int(m): message_id for m, message_id in state.get("dashboards", {}).items()})
+        media = state.get("media", {})
+        if media.get("token") == token_fingerprint():
+            media_relay.files.load(media.get("files", ()))
+        for client_id, request_text in state.get("waiting", ()):
+            manager_pool.waiting.setdefault(client_id, request_text)
+
+        os.remove(SNAPSHOT_PATH)
+        logger.info(
+            f"Восстановлен снимок состояния от {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state['saved_at']))}: "
+            f"диалогов — {len(state.get('dialogs', ()))}, FSM — {len(state.get('fsm', ()))}, "
+            f"в очереди ожидания — {len(state.get('waiting', ()))}"
+        )
+        return True
+
+# ============================================
+# 🚀 ЗАПУСК БОТА
+# ============================================
+
+def build_fsm_storage() -> BaseStorage:
+    """FSM-хранилище: общее Redis при DIALOG_BACKEND=redis, иначе в памяти"""
+    if DIALOG_BACKEND == "redis":
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(REDIS_URL)
+    return MemoryStorage()
+
+
+class StartupTimer:
+    """Разбивка времени холодного запуска по этапам.
+
+    Отсчёт идёт от STARTED_AT — до импорта aiogram, поэтому первый этап
+    («импорт») включает загрузку зависимостей. Этапы, выполняемые
+    параллельно, замеряются через measure() и в отчёте соединяются «∥».
+    """
+
+    def __init__(self, started: float):
+        self.started = started
+        self._last = started
+        self.stages: list[tuple[str, float, bool]] = []  # (этап, секунды, параллельный)
+        self.total = 0.0
+
+    def mark(self, name: str) -> None:
+        """Закрыть последовательный этап, начавшийся с предыдущей отметки"""
+        now = time.perf_counter()
+        self.stages.append((name, now - self._last, False))
+        self._last = now
+        self.total = now - self.started
+
+    async def measure(self, name: str, coro: Awaitable) -> Any:
+        """Замерить этап, идущий параллельно с другими (без сдвига отметки)"""
+        began = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.stages.append((name, time.perf_counter() - began, True))
+
+    def parallel(self) -> None:
+        """Закрыть группу параллельных этапов, замеренных measure()"""
+        now = time.perf_counter()
+        self._last = now
+        self.total = now - self.started
+
+    def report(self) -> str:
+        parts: list[str] = []
+        previous_parallel = False
+        for name, seconds, is_parallel in self.stages:
+            text = f"{name} — {seconds:.2f} с"
+            if is_parallel and previous_parallel:
+                parts[-1] += f" ∥ {text}"
+            else:
+                parts.append(text)
+            previous_parallel = is_parallel
+        return f"⏱️ Запуск за {self.total:.2f} с: " + ", ".join(parts)
+
+
+startup = StartupTimer(STARTED_AT)
+
+
+async def _startup_seconds() -> float:
+    return startup.total
+
+
+metrics.gauge("tgbot_startup_seconds", "Время холодного запуска до приёма обновлений", _startup_seconds)
+
+
+async def prepare_bot(bot: Bot) -> None:
+    """Обращения к Bot API, без которых нельзя принимать обновления.
+
+    bot.me() запоминает ответ getMe, поэтому start_polling() не делает
+    повторного запроса. Снятие вебхука в режиме опроса идёт параллельно.
+    """
+    calls: list[Awaitable] = [bot.me()]
+    if BOT_MODE != "webhook" and SHARD_INDEX < 0:
+        calls.append(bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES))
+    await asyncio.gather(*calls)
+
+
+async def main() -> None:
+    if WORKERS > 1 and SHARD_INDEX < 0:
+        await Supervisor(WORKERS).run()
+        return
+    
+    bot = Bot(token=BOT_TOKEN, session=build_session())
+    storage = build_fsm_storage()
+    dp = Dispatcher(storage=storage)
+    dp.include_router(router)
+    setup_metrics(dp, bot)
+    lifecycle = BotLifecycle(dp, bot)
+    startup.mark("импорт")
+    
+    try:
+        # Хранилища, снимок состояния и очередь отправки поднимаются параллельно с обращениями к Bot API
+        await asyncio.gather(
+            startup.measure("хранилища", lifecycle.startup()),
+            startup.measure("Bot API", prepare_bot(bot)),
+        )
+        startup.parallel()
+        warmed = render_cache.warm(bot)
+        startup.mark(f"прогрев клавиатур ({warmed})")
+        logger.info(startup.report())
+        
+        bot_info = await bot.me()
+        logger.info(f"Бот запущен: @{bot_info.username} (ID: {bot_info.id})")
+        if SHARD_INDEX >= 0:
+            await ShardServer(dp, bot).run()
+            return
+        logger.info(f"Менеджеры: {', '.join(map(str, MANAGER_IDS))} (стратегия: {MANAGER_STRATEGY})")
+        logger.info("💡 Инструкция для менеджера:\n"
+                    "• Чтобы ответить клиенту — нажмите «ответить» на его сообщение\n"
+                    "• Чтобы завершить диалог — напишите /стоп_123456789\n"
+                    "• Чтобы написать клиенту напрямую — /чат_123456789 текст\n"
+                    "• История переписки — /история_123456789 [страница], поиск — /поиск текст\n"
+                    "• Панель активных диалогов — /панель\n"
+                    "• Рассылка всем клиентам — /рассылка текст (или ответом на сообщение)\n"
+                    "• Заявки на звонок — /заявки, взять заявку — /беру_12")
+        
+        if BOT_MODE == "webhook":
+            await WebhookServer(dp, bot).run()
+        else:
+            await dp.start_polling(bot, close_bot_session=False, tasks_concurrency_limit=UPDATE_CONCURRENCY)
+    finally:
+        await lifecycle.shutdown()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Бот остановлен пользователем")
+    except Exception as e:
+        logger.error(f"Критическая ошибка: {e}")
         raise
\ No newline at end of file
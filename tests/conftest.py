@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+# main.py читает настройки при импорте: задаём тестовые значения до него
+os.environ.update(
+    BOT_TOKEN="123456:TEST",
+    MANAGER_ID="1000",
+    SNAPSHOT_PATH="",
+    TRANSCRIPT_DB_PATH="",
+    USERS_DB_PATH="",
+    LEADS_DB_PATH="",
+    COALESCE_DELAY="0",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def dp():
+    """Диспетчер с роутером бота: роутер подключается к диспетчеру только один раз"""
+    from aiogram import Dispatcher
+    from aiogram.fsm.storage.memory import MemoryStorage
+
+    import main
+
+    dispatcher = Dispatcher(storage=MemoryStorage())
+    dispatcher.include_router(main.router)
+    return dispatcher
@@ -0,0 +1,76 @@
+"""Локальная заглушка Bot API для тестов: записывает вызовы и отвечает как Telegram"""
+import itertools
+import json
+
+from aiohttp import web
+from aiogram.client.telegram import TelegramAPIServer
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.calls: list[tuple[str, dict]] = []
+        self.uploads: dict[str, bytes] = {}
+        self.flood: dict[str, int] = {}  # метод -> сколько раз ответить 429
+        self.errors: dict[str, str] = {}  # метод -> описание ошибки 400
+        self._ids = itertools.count(100)
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+
+    def api(self, base_url: str) -> TelegramAPIServer:
+        return TelegramAPIServer.from_base(base_url)
+
+    def methods(self) -> list[str]:
+        return [method for method, _ in self.calls]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        fields: dict = {}
+        if request.content_type.startswith("multipart/"):
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename:
+                    self.uploads[part.name] = await part.read()
+                else:
+                    fields[part.name] = await part.text()
+        else:
+            fields = dict(await request.post())
+        self.calls.append((method, fields))
+        if self.flood.get(method):
+            self.flood[method] -= 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }, status=429)
+        if method in self.errors:
+            return web.json_response({
+                "ok": False, "error_code": 400, "description": f"Bad Request: {self.errors[method]}",
+            }, status=400)
+        return web.json_response({"ok": True, "result": self.result(method, fields)})
+
+    def result(self, method: str, fields: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Test", "username": "test_bot"}
+        if method == "copyMessage":
+            return {"message_id": next(self._ids)}
+        if method.startswith("send"):
+            message = {"message_id": next(self._ids), "date": 0,
+                       "chat": {"id": int(fields.get("chat_id", 0)), "type": "private"}}
+            if method == "sendMessage":
+                message["text"] = fields.get("text", "")
+            if method == "sendDocument":
+                message["document"] = {"file_id": "uploaded", "file_unique_id": "u1"}
+            return message
+        return True
+
+
+def update_json(update_id: int, user_id: int, text: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": "Клиент"}
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": {"id": user_id, "type": "private"},
+                    "from": user, "text": text},
+    }
+
+
+def dumps(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False)
@@ -0,0 +1,93 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiohttp.test_utils import TestServer
+from aiogram import Bot
+
+import main
+from fake_telegram import FakeTelegram, update_json
+
+
+def test_text_broadcast_skips_manager_only_chunks(monkeypatch, dp, tmp_path):
+    registry = main.UserRegistry(str(tmp_path / "users.db"))
+    broadcaster = main.Broadcaster(registry, chunk_size=1)
+    monkeypatch.setattr(main, "outbox", main.SendQueue())
+    monkeypatch.setattr(main, "users", registry)
+    monkeypatch.setattr(main, "broadcaster", broadcaster)
+    telegram = FakeTelegram()
+
+    async def run():
+        await registry.start()
+        # Первая порция (по одному получателю) — только сам менеджер
+        for user_id in (main.MANAGER_ID, 2000, 3000):
+            registry.add(SimpleNamespace(id=user_id, username=None, full_name=f"Клиент {user_id}"))
+        async with TestServer(telegram.app) as api_server:
+            bot = Bot(main.BOT_TOKEN, session=main.CachedMarkupSession(api=telegram.api(str(api_server.make_url("")))))
+            main.outbox.start(bot)
+            await dp.feed_raw_update(bot, update_json(1, main.MANAGER_ID, "/рассылка Скидки до пятницы"))
+            # Обработчик не ждёт отправки текста: рассылка стартует в фоне
+            assert broadcaster.running
+            await broadcaster._task
+            await main.outbox.close(5)
+            await bot.session.close()
+        await registry.close()
+
+    asyncio.run(run())
+    assert broadcaster.current.status == "done"
+    assert broadcaster.current.delivered == 2
+    copies = [int(fields["chat_id"]) for method, fields in telegram.calls if method == "copyMessage"]
+    assert copies == [2000, 3000]
+    assert telegram.calls[0][1]["text"] == "Скидки до пятницы"
+
+
+class ManualOutbox:
+    """Очередь отправки, в которой исход копий задаёт тест (deliver — доставлять сразу)"""
+
+    def __init__(self, deliver: bool):
+        self.deliver = deliver
+        self.copies: dict[int, asyncio.Future] = {}
+
+    def submit(self, method, *args, **kwargs) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if isinstance(method, main.CopyMessage):
+            self.copies[method.chat_id] = future
+            if self.deliver:
+                future.set_result(main.MessageId(message_id=1))
+        return future
+
+
+def test_resume_skips_recipients_sent_after_a_cancelled_one(monkeypatch, tmp_path):
+    registry = main.UserRegistry(str(tmp_path / "users.db"))
+    monkeypatch.setattr(main, "SHUTDOWN_TIMEOUT", 0.05)
+
+    async def run():
+        await registry.start()
+        for user_id in (2, 3, 4, 5, 6):
+            registry.add(SimpleNamespace(id=user_id, username=None, full_name=f"Клиент {user_id}"))
+        broadcast = main.Broadcast(manager_id=main.MANAGER_ID, from_chat_id=main.MANAGER_ID, message_id=1)
+        await registry.save_broadcast(broadcast)
+
+        # Остановка посреди порции: 2, 3 и 5 доставлены, 4 и 6 ещё в очереди
+        first = ManualOutbox(deliver=False)
+        monkeypatch.setattr(main, "outbox", first)
+        broadcaster = main.Broadcaster(registry, chunk_size=10)
+        broadcaster._launch(broadcast, broadcaster._run(broadcast))
+        while len(first.copies) < 5:
+            await asyncio.sleep(0.01)
+        for user_id in (2, 3, 5):
+            first.copies[user_id].set_result(main.MessageId(message_id=1))
+        await broadcaster.close()
+        interrupted = await registry.running_broadcast()
+
+        second = ManualOutbox(deliver=True)
+        monkeypatch.setattr(main, "outbox", second)
+        resumed = main.Broadcaster(registry, chunk_size=10)
+        await resumed.resume()
+        await resumed._task
+        await registry.close()
+        return interrupted, list(second.copies), resumed.current
+
+    interrupted, resent, final = asyncio.run(run())
+    assert (interrupted.cursor, interrupted.sent, interrupted.delivered) == (3, [5], 3)
+    assert resent == [4, 6]
+    assert (final.status, final.delivered, final.sent) == ("done", 5, [])
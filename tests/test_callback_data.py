@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+from aiogram.types import CallbackQuery
+
+import main
+
+
+def flip(value: str, index: int) -> str:
+    """Заменяет один символ строки другим допустимым в base64 и в числах"""
+    return value[:index] + ("1" if value[index] != "1" else "2") + value[index + 1:]
+
+
+def callback(data: str) -> CallbackQuery:
+    return CallbackQuery.model_validate({
+        "id": "1", "chat_instance": "c", "data": data,
+        "from": {"id": main.MANAGER_ID, "is_bot": False, "first_name": "Менеджер"},
+    })
+
+
+def test_signed_callback_round_trip():
+    packed = main.DialogRequestCallback(action="accept", client_id=42).pack()
+    assert packed.startswith("dr:accept:42:")
+    assert len(packed.encode()) <= 64
+    assert main.DialogRequestCallback.unpack(packed) == main.DialogRequestCallback(action="accept", client_id=42)
+    match = asyncio.run(main.DialogRequestCallback.filter(main.F.action == "accept")(callback(packed)))
+    assert match == {"callback_data": main.DialogRequestCallback(action="accept", client_id=42)}
+
+
+@pytest.mark.parametrize("index", [-1, len("dr:accept:4")], ids=["signature", "payload"])
+def test_tampered_callback_is_rejected(index):
+    tampered = flip(main.DialogRequestCallback(action="accept", client_id=42).pack(), index)
+    with pytest.raises(ValueError):
+        main.DialogRequestCallback.unpack(tampered)
+    assert asyncio.run(main.DialogRequestCallback.filter()(callback(tampered))) is False
+
+
+def test_foreign_prefix_is_rejected():
+    packed = main.LeadCallback(action="take", lead_id=42).pack()
+    with pytest.raises(ValueError):
+        main.DialogRequestCallback.unpack(packed)
@@ -0,0 +1,21 @@
+import main
+
+
+def test_paginate_counts_utf16_units():
+    blocks = [f"💧 Позиция {i} 🌀🌀🌀\n" for i in range(400)]
+    pages = main.paginate(blocks, header="📊 Прайс\n\n", limit=main.MAX_TEXT_LENGTH)
+    assert len(pages) > 1
+    assert all(main.tg_len(page) <= main.MAX_TEXT_LENGTH for page in pages)
+    assert "".join(page.removeprefix("📊 Прайс\n\n") for page in pages) == "".join(blocks)
+
+
+def test_paginate_cuts_long_lines_by_utf16_units():
+    line = "🌊" * 3000
+    pages = main.paginate([line], limit=1000)
+    assert all(main.tg_len(page) <= 1000 for page in pages)
+    assert "".join(pages) == line
+
+
+def test_price_block_escapes_catalog_names():
+    block = main.render_price_block("BB10_pro <new> & *hit*", ["Картридж_5 — 100 ₽"])
+    assert block == "<b>BB10_pro &lt;new&gt; &amp; *hit*</b>\nКартридж_5 — 100 ₽\n\n"
@@ -0,0 +1,100 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import main
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+requires_fakeredis = pytest.mark.skipif(fakeredis is None, reason="fakeredis не установлен")
+
+
+def make_store(server) -> main.RedisDialogStore:
+    return main.RedisDialogStore(fakeredis.aioredis.FakeRedis(server=server))
+
+
+@requires_fakeredis
+def test_redis_store_crud():
+    async def run():
+        store = make_store(fakeredis.FakeServer())
+        await store.put(1, main.DialogRecord(last_active=10.0, manager_id=1000))
+        assert await store.get(1) == main.DialogRecord(last_active=10.0, manager_id=1000)
+        assert await store.count() == 1
+        assert await store.delete(1) is True
+        assert await store.delete(1) is False
+        assert await store.get(1) is None
+        await store.close()
+
+    asyncio.run(run())
+
+
+@requires_fakeredis
+def test_bind_unbind_restore_round_trip(monkeypatch):
+    """Диалоги, открытые одним процессом, видит и восстанавливает другой"""
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(main, "dispatch_waiting_requests", lambda: asyncio.sleep(0))
+
+    async def run():
+        monkeypatch.setattr(main, "dialog_store", make_store(server))
+        monkeypatch.setattr(main, "manager_pool", main.ManagerPool([1000, 2000], "least_active", 0))
+        await main.open_dialog(5, 1000)
+        await main.open_dialog(6, 2000)
+        await main.open_dialog(7, 2000)
+        assert await main.close_dialog(6) is not None
+        assert await main.close_dialog(6) is None
+
+        # «Перезапуск»: новое подключение к тому же Redis и пустое состояние процесса
+        monkeypatch.setattr(main, "dialog_store", make_store(server))
+        monkeypatch.setattr(main, "manager_pool", main.ManagerPool([1000, 2000], "least_active", 0))
+        monkeypatch.setattr(main, "dialog_expiry", main.ExpiryQueue(main.DIALOG_TIMEOUT))
+        await main.restore_dialog_expiry()
+
+        dialogs = await main.dialog_store.all()
+        assert {client_id: record.manager_id for client_id, record in dialogs.items()} == {5: 1000, 7: 2000}
+        assert main.manager_pool.load == {1000: 1, 2000: 1}
+        assert main.dialog_expiry.pending == 2
+
+    asyncio.run(run())
+
+
+def test_sqlite_store_writes_on_close_and_restores(tmp_path):
+    path = str(tmp_path / "dialogs.db")
+
+    async def run():
+        # Интервал записи больше теста: на диск изменения попадают только при закрытии
+        store = main.SQLiteDialogStore(path, flush_interval=3600)
+        await store.start()
+        await store.put(1, main.DialogRecord(last_active=10.0, manager_id=1000))
+        await store.put(2, main.DialogRecord(last_active=20.0, manager_id=2000))
+        await store.put(3, main.DialogRecord(last_active=30.0, manager_id=1000))
+        assert await store.get(2) == main.DialogRecord(last_active=20.0, manager_id=2000)
+        assert await store.delete(2) is True
+        assert await store.delete(2) is False
+        assert await store.get(2) is None
+        assert await store.count() == 2
+        with sqlite3.connect(path) as db:
+            assert db.execute("SELECT COUNT(*) FROM dialogs").fetchone()[0] == 0
+        await store.close()
+
+        with sqlite3.connect(path) as db:
+            assert sorted(row[0] for row in db.execute("SELECT client_id FROM dialogs")) == [1, 3]
+
+        reopened = main.SQLiteDialogStore(path, flush_interval=3600)
+        await reopened.start()
+        dialogs = await reopened.all()
+        await reopened.close()
+        return dialogs
+
+    assert asyncio.run(run()) == {
+        1: main.DialogRecord(last_active=10.0, manager_id=1000),
+        3: main.DialogRecord(last_active=30.0, manager_id=1000),
+    }
+
+
+def test_dialog_store_is_abstract():
+    with pytest.raises(TypeError):
+        main.DialogStore()
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestServer
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendDocument, SendMessage
+from aiogram.types import BufferedInputFile, FSInputFile
+
+import main
+from fake_telegram import FakeTelegram
+
+pytest.importorskip("httpx")
+pytest.importorskip("h2")
+
+CLIENT = 42
+
+
+def with_bot(telegram: FakeTelegram, scenario) -> None:
+    """Запускает scenario(bot) с ботом на HttpxSession, направленной в заглушку Bot API"""
+    async def run():
+        async with TestServer(telegram.app) as api_server:
+            bot = Bot(main.BOT_TOKEN, session=main.HttpxSession(api=telegram.api(str(api_server.make_url("")))))
+            try:
+                await scenario(bot)
+            finally:
+                await bot.session.close()
+
+    asyncio.run(run())
+
+
+def test_json_call():
+    telegram = FakeTelegram()
+    sent = []
+
+    async def scenario(bot):
+        sent.append(await bot(SendMessage(chat_id=CLIENT, text="привет", reply_markup=main.get_main_menu())))
+
+    with_bot(telegram, scenario)
+    method, fields = telegram.calls[0]
+    assert method == "sendMessage"
+    assert fields["text"] == "привет"
+    assert fields["reply_markup"] == main.render_cache.get(main.get_main_menu(), None)
+    assert sent[0].text == "привет"
+
+
+def test_multipart_upload(tmp_path):
+    telegram = FakeTelegram()
+    path = tmp_path / "report.txt"
+    path.write_bytes(b"x" * 200_000)
+
+    async def scenario(bot):
+        await bot(SendDocument(chat_id=CLIENT, document=BufferedInputFile(b"small", filename="a.txt")))
+        await bot(SendDocument(chat_id=CLIENT, document=FSInputFile(path), caption="отчёт"))
+
+    with_bot(telegram, scenario)
+    assert telegram.methods() == ["sendDocument", "sendDocument"]
+    # Файл приходит отдельной частью, на которую ссылается поле document: attach://<имя части>
+    small, large = (telegram.uploads[fields["document"].removeprefix("attach://")] for _, fields in telegram.calls)
+    assert small == b"small"
+    assert large == path.read_bytes()
+    assert telegram.calls[1][1]["caption"] == "отчёт"
+
+
+def test_retry_after(monkeypatch):
+    monkeypatch.setattr(main, "outbox", main.SendQueue())
+    telegram = FakeTelegram()
+    telegram.flood["sendMessage"] = 2
+    raised = []
+
+    async def scenario(bot):
+        try:
+            await bot(SendMessage(chat_id=CLIENT, text="сразу"))
+        except TelegramRetryAfter as e:
+            raised.append(e.retry_after)
+        main.outbox.start(bot)
+        message = await main.outbox.submit(SendMessage(chat_id=CLIENT, text="с повтором"))
+        await main.outbox.close(5)
+        assert message.text == "с повтором"
+
+    with_bot(telegram, scenario)
+    assert raised == [1]
+    assert telegram.methods() == ["sendMessage"] * 3
@@ -0,0 +1,18 @@
+import time
+
+import main
+
+
+def test_digest_skips_pruned_leads():
+    store = main.LeadStore("", window=60, digest_threshold=0, digest_interval=1)
+    first, _ = store.add(1, "Первый", "+7 900 000-00-01")
+    second, _ = store.add(2, "Второй", "+7 900 000-00-02")
+    store.digest = [first.id, second.id]
+    store.last_digest = time.monotonic() - 2
+
+    # Первую заявку взяли и она вышла из окна дедупликации до сводки
+    store.take(first.id, main.MANAGER_ID)
+    first.created -= 120
+    store.prune()
+
+    assert store.take_digest() == [second]
@@ -0,0 +1,39 @@
+import asyncio
+
+from aiohttp.test_utils import TestServer
+from aiogram import Bot
+
+import main
+from fake_telegram import FakeTelegram, update_json
+
+
+def test_manager_command_keys():
+    assert main.manager_command_key("/стоп_123") == "/стоп"
+    assert main.manager_command_key("/рассылка_статус") == "/рассылка"
+    assert main.manager_command_key("/чат_5@test_bot текст") == "/чат"
+    assert main.manager_command_key("просто текст") == ""
+    assert set(main.manager_routes) == {
+        "/стоп", "/чат", "/заявки", "/беру", "/история", "/поиск", "/панель", "/рассылка"
+    }
+
+
+def test_manager_commands_are_dispatched(monkeypatch, dp):
+    monkeypatch.setattr(main, "outbox", main.SendQueue())
+    telegram = FakeTelegram()
+
+    async def run():
+        async with TestServer(telegram.app) as api_server:
+            bot = Bot(main.BOT_TOKEN, session=main.CachedMarkupSession(api=telegram.api(str(api_server.make_url("")))))
+            main.outbox.start(bot)
+            for update_id, text in enumerate(["/заявки", "/стоп_abc", "/стоп_42"], 1):
+                await dp.feed_raw_update(bot, update_json(update_id, main.MANAGER_ID, text))
+            await main.outbox.close(5)
+            await bot.session.close()
+
+    asyncio.run(run())
+    replies = [fields["text"] for method, fields in telegram.calls if method == "sendMessage"]
+    assert replies == [
+        "✅ Необработанных заявок нет.",
+        "⚠️ Неверный формат команды. Используйте: /стоп_123456789",
+        "⚠️ Клиент 42 не в активном диалоге.",
+    ]
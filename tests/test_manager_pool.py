@@ -0,0 +1,49 @@
+import asyncio
+
+import main
+
+
+def test_offers_reserve_capacity(monkeypatch):
+    pool = main.ManagerPool([1000, 2000], "least_active", 2)
+    monkeypatch.setattr(main, "manager_pool", pool)
+    requests = main.DialogRequests(600)
+
+    offered = []
+    for client_id in range(1, 7):
+        manager_id = pool.pick(client_id)
+        if manager_id is not None:
+            requests.add(client_id, manager_id)
+        offered.append(manager_id)
+    assert sorted(offered[:4]) == [1000, 1000, 2000, 2000]
+    assert offered[4:] == [None, None]
+
+    # Принятие: место запроса переходит в активный диалог, лимит не превышается
+    assert pool.has_capacity(1000, own_offer=True)
+    request = requests.pop(1)
+    pool.bind(1, request.manager_id)
+    assert pool.busy(request.manager_id) == 2
+
+    # Отклонение освобождает место
+    rejected = next(client_id for client_id in range(2, 5) if requests.get(client_id).manager_id == 2000)
+    requests.pop(rejected)
+    assert pool.pick(5) == 2000
+
+
+def test_dialog_request_escapes_client_name(monkeypatch):
+    monkeypatch.setattr(main, "outbox", main.SendQueue())
+    monkeypatch.setattr(main, "manager_pool", main.ManagerPool([1000], "least_active", 0))
+    monkeypatch.setattr(main, "dialog_requests", main.DialogRequests(600))
+    message = main.Message.model_validate({
+        "message_id": 1, "date": 0, "chat": {"id": 42, "type": "private"},
+        "from": {"id": 42, "is_bot": False, "first_name": "<b>Ann</b> & *Bob_", "username": "bob_smith"},
+        "text": "💬 Начать диалог с менеджером",
+    })
+
+    async def run():
+        await main.start_dialog_request(message, state=None, role=main.ROLE_CLIENT, dialog=None)
+        return [item.method for item in main.outbox._queue._queue]
+
+    [request] = [method for method in asyncio.run(run()) if method.chat_id == 1000]
+    assert request.parse_mode == "HTML"
+    assert "👤 Имя: &lt;b&gt;Ann&lt;/b&gt; &amp; *Bob_\n" in request.text
+    assert "🔗 Username: @bob_smith\n" in request.text
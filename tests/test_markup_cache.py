@@ -0,0 +1,45 @@
+import json
+
+from aiogram import Bot
+from aiogram.methods import SendMessage
+from aiogram.types import ReplyKeyboardMarkup
+
+import main
+
+
+def form_fields(form) -> dict:
+    return {options["name"]: value for options, _, value in form._fields}
+
+
+def test_cached_markup_is_serialized_once(monkeypatch):
+    session = main.CachedMarkupSession()
+    bot = Bot(main.BOT_TOKEN, session=session)
+    method = SendMessage(chat_id=1, text="меню", reply_markup=main.get_main_menu())
+    expected = session.prepare_value(main.get_main_menu().model_dump(warnings=False), bot=bot, files={})
+    main.render_cache.warm(bot)
+
+    dumps = 0
+    original = ReplyKeyboardMarkup.model_dump
+
+    def counting_dump(self, *args, **kwargs):
+        nonlocal dumps
+        dumps += 1
+        return original(self, *args, **kwargs)
+
+    monkeypatch.setattr(ReplyKeyboardMarkup, "model_dump", counting_dump)
+    first = form_fields(session.build_form_data(bot, method))
+    second = form_fields(session.build_form_data(bot, method))
+
+    assert dumps == 0
+    assert first["reply_markup"] is second["reply_markup"]
+    assert json.loads(first["reply_markup"]) == json.loads(expected)
+    assert first["chat_id"] == "1" and first["text"] == "меню"
+
+
+def test_other_markups_are_not_cached():
+    session = main.CachedMarkupSession()
+    bot = Bot(main.BOT_TOKEN, session=session)
+    markup = main.get_manager_accept_keyboard(5)
+    fields = form_fields(session.build_form_data(bot, SendMessage(chat_id=1, text="x", reply_markup=markup)))
+    assert json.loads(fields["reply_markup"])["inline_keyboard"]
+    assert id(markup) not in main.render_cache.serialized
@@ -0,0 +1,61 @@
+import asyncio
+
+from aiohttp.test_utils import TestServer
+from aiogram import Bot
+from aiogram.methods import CopyMessage, SendMessage
+from aiogram.types import Message
+
+import main
+from fake_telegram import FakeTelegram
+
+CLIENT = 42
+
+
+def photo_message() -> Message:
+    return Message.model_validate({
+        "message_id": 7, "date": 0, "chat": {"id": main.MANAGER_ID, "type": "private"},
+        "from": {"id": main.MANAGER_ID, "is_bot": False, "first_name": "Менеджер"},
+        "photo": [{"file_id": "PHOTO", "file_unique_id": "P1", "width": 10, "height": 10}],
+        "caption": "<b>не разметка</b>",
+    })
+
+
+def relay(monkeypatch, error: str) -> tuple[FakeTelegram, list[Exception]]:
+    """Пересылает фото менеджера клиенту при ошибке копирования error, следом ставит текст"""
+    monkeypatch.setattr(main, "outbox", main.SendQueue())
+    monkeypatch.setattr(main, "media_relay", main.MediaRelay())
+    telegram = FakeTelegram()
+    telegram.errors["copyMessage"] = error
+    errors: list[Exception] = []
+
+    async def on_error(e: Exception) -> None:
+        errors.append(e)
+
+    async def run():
+        async with TestServer(telegram.app) as api_server:
+            bot = Bot(main.BOT_TOKEN, session=main.CachedMarkupSession(api=telegram.api(str(api_server.make_url("")))))
+            main.outbox.start(bot)
+            message = photo_message()
+            method = CopyMessage(chat_id=CLIENT, from_chat_id=message.chat.id, message_id=message.message_id,
+                                 caption=main.manager_reply(message.caption), parse_mode="HTML")
+            main.media_relay.copy(method, message, main.PRIORITY_CLIENT, on_error)
+            main.outbox.submit(SendMessage(chat_id=CLIENT, text="после фото"))
+            await main.media_relay.close(5)
+            await main.outbox.close(5)
+            await bot.session.close()
+
+    asyncio.run(run())
+    return telegram, errors
+
+
+def test_text_waits_for_media_fallback(monkeypatch):
+    telegram, errors = relay(monkeypatch, "message to copy not found")
+    assert telegram.methods() == ["copyMessage", "sendPhoto", "sendMessage"]
+    assert telegram.calls[1][1]["caption"] == "👤 <b>Менеджер ответил:</b>\n\n&lt;b&gt;не разметка&lt;/b&gt;"
+    assert not errors
+
+
+def test_other_copy_errors_are_not_retried(monkeypatch):
+    telegram, errors = relay(monkeypatch, "can't parse entities: unsupported start tag")
+    assert telegram.methods() == ["copyMessage", "sendMessage"]
+    assert len(errors) == 1
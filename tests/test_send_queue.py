@@ -0,0 +1,37 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+
+import main
+
+
+def retry_after(seconds: int) -> tuple[float, float]:
+    """Один ответ 429 на сообщение в чат; возвращает паузы лимита чата и глобального лимита"""
+    queue = main.SendQueue()
+
+    async def bot(method):
+        raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=seconds)
+
+    async def run():
+        queue.bot = bot
+        queue.submit(main.SendMessage(chat_id=42, text="Привет"))
+        item = queue._queue.get_nowait()
+        chat_bucket = queue._chat_bucket(42)
+        await queue._execute(item, 42, chat_bucket)
+        now = time.monotonic()
+        return chat_bucket.delay(now), queue._global.delay(now)
+
+    return asyncio.run(run())
+
+
+def test_short_chat_retry_after_blocks_only_the_chat():
+    chat_delay, global_delay = retry_after(1)
+    assert chat_delay > 0
+    assert global_delay == 0
+
+
+def test_long_retry_after_blocks_every_chat():
+    chat_delay, global_delay = retry_after(30)
+    assert chat_delay > 25
+    assert global_delay > 25
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import time
+
+import pytest
+from aiohttp.test_utils import TestServer
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+
+import main
+from fake_telegram import FakeTelegram, update_json
+
+CLIENT = 42
+
+
+class RecordingLink:
+    """Связь с координатором, которая только запоминает вызовы (в JSON, как в сокете)"""
+
+    def __init__(self):
+        self.calls: list[tuple[str, list]] = []
+
+    def call(self, name: str, args: tuple) -> None:
+        self.calls.append((name, json.loads(json.dumps(args))))
+
+
+def test_dialog_message_is_handled_on_any_shard(monkeypatch, dp):
+    link = RecordingLink()
+    monkeypatch.setattr(main, "coordinator_link", link)
+    monkeypatch.setattr(main, "outbox", main.SendQueue())
+    monkeypatch.setattr(main, "dialog_store", main.MemoryDialogStore())
+    monkeypatch.setattr(main, "dashboard", main.ManagerDashboard(10, 0))
+    monkeypatch.setattr(main, "reply_index", main.ReplyIndex(100, 60))
+    monkeypatch.setattr(main, "dialog_expiry", main.ExpiryQueue(60))
+    telegram = FakeTelegram()
+
+    async def run():
+        await main.dialog_store.put(CLIENT, main.DialogRecord(last_active=time.time(), manager_id=main.MANAGER_ID))
+        async with TestServer(telegram.app) as api_server:
+            bot = Bot(main.BOT_TOKEN, session=main.CachedMarkupSession(api=telegram.api(str(api_server.make_url("")))))
+            main.outbox.start(bot)
+            await dp.feed_raw_update(bot, update_json(1, CLIENT, "Здравствуйте"))
+            await main.outbox.close(5)
+            await bot.session.close()
+        # Учёт координатора в обработчике не менялся — он передан вызовами
+        assert not main.dashboard.unread and not len(main.reply_index) and not main.dialog_expiry.pending
+
+        monkeypatch.setattr(main, "coordinator_link", None)
+        for name, args in link.calls:
+            await main.run_coordinator_call(name, args)
+
+    asyncio.run(run())
+    # Обработчик сам переслал сообщение менеджеру
+    assert [(m, int(f["chat_id"])) for m, f in telegram.calls] == [("sendMessage", main.MANAGER_ID)]
+    assert [name for name, _ in link.calls] == ["dialog_touched", "client_message_noted", "remember_reply"]
+    assert main.dashboard.unread == {CLIENT: 1}
+    assert main.reply_index.get(main.MANAGER_ID, 100) == CLIENT
+    assert main.dialog_expiry.pending == 1
+
+
+def test_shared_rate_limit_spreads_budget(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    # Время скрипта остановлено: ожидания не зависят от скорости выполнения Lua
+    monkeypatch.setattr(main.time, "time", lambda: 1_000_000.0)
+
+    async def run():
+        server = fakeredis.FakeServer()
+        # Два процесса с одним лимитом 10 в секунду
+        first, second = (main.SharedRateLimit(fakeredis.aioredis.FakeRedis(server=server), 10) for _ in range(2))
+        waits = [await limit._eval(0) for limit in (first, second) * 8]
+        await first.block(2)
+        blocked = await second._eval(0)
+        await first.close()
+        await second.close()
+        return waits, blocked
+
+    waits, blocked = asyncio.run(run())
+    # Всплеск из 10 запросов — сразу, дальше по слоту в 0.1 с на оба процесса вместе
+    assert waits[:10] == [0] * 10
+    assert waits[10:] == pytest.approx([0.1 * n for n in range(1, 7)], abs=0.05)
+    assert blocked == pytest.approx(2 - 0.9, abs=0.05)
+
+
+def test_replies_recorded_during_shutdown_reach_coordinator(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "SHARD_SOCKET_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "outbox", main.SendQueue())
+    # Серия клиента ждёт таймера склейки и уходит менеджеру только при остановке
+    monkeypatch.setattr(main, "coalescer", main.MessageCoalescer(60))
+    telegram = FakeTelegram()
+    received: list[dict] = []
+
+    async def coordinator(reader, writer):
+        while line := await reader.readline():
+            received.append(json.loads(line))
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_unix_server(coordinator, main.shard_socket_path(0))
+        link = main.ShardLink(0, maxsize=0)
+        monkeypatch.setattr(main, "coordinator_link", link)
+        link.start()
+        async with TestServer(telegram.app) as api_server:
+            bot = Bot(main.BOT_TOKEN, session=main.CachedMarkupSession(api=telegram.api(str(api_server.make_url("")))))
+            lifecycle = main.BotLifecycle(Dispatcher(), bot)
+            main.outbox.start(bot)
+            message = Message.model_validate(update_json(1, CLIENT, "Последнее сообщение")["message"])
+            main.coalescer.add(CLIENT, main.MANAGER_ID, "👤 Клиент 42:\n\n", message, None)
+            await lifecycle.shutdown()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
+    assert telegram.methods() == ["sendMessage"]
+    assert received == [{"call": "remember_reply", "args": [main.MANAGER_ID, 100, CLIENT]}]
+
+
+def test_burst_is_dropped_when_dialog_closed_elsewhere(monkeypatch):
+    monkeypatch.setattr(main, "outbox", main.SendQueue())
+    monkeypatch.setattr(main, "dialog_store", main.MemoryDialogStore())
+    coalescer = main.MessageCoalescer(0.05)
+    message = Message.model_validate(update_json(1, CLIENT, "Успею?")["message"])
+
+    async def run():
+        await main.dialog_store.put(CLIENT, main.DialogRecord(last_active=time.time(), manager_id=main.MANAGER_ID))
+        coalescer.add(CLIENT, main.MANAGER_ID, "👤 Клиент 42:\n\n", message, None)
+        # Координатор завершил диалог, пока серия ждала в этом процессе
+        await main.dialog_store.delete(CLIENT)
+        await asyncio.sleep(0.2)
+        return [item.method for item in main.outbox._queue._queue]
+
+    sent = asyncio.run(run())
+    assert [(method.chat_id, method.text) for method in sent] == [
+        (CLIENT, "ℹ️ Диалог завершён. Начните новый диалог через главное меню.")
+    ]
+
+
+def test_shards_share_transcript_file(tmp_path):
+    """Историю одного файла пишут несколько процессов — здесь несколько соединений"""
+    path = str(tmp_path / "transcripts.db")
+
+    async def run():
+        stores = [main.TranscriptStore(path, flush_interval=0.01) for _ in range(3)]
+        for store in stores:
+            await store.start()
+        for n in range(30):
+            stores[n % 3].add(CLIENT, main.MANAGER_ID, main.FROM_CLIENT, text=f"сообщение {n}")
+        for store in stores:
+            await store.close()
+        reader = main.TranscriptStore(path)
+        await reader.start()
+        entries, pages = await reader.history(CLIENT, page_size=100)
+        await reader.close()
+        return entries
+
+    entries = asyncio.run(run())
+    assert sorted(entry.text for entry in entries) == sorted(f"сообщение {n}" for n in range(30))
@@ -0,0 +1,67 @@
+import asyncio
+
+from aiogram.types import CallbackQuery, Message
+
+import main
+
+CLIENT = 42
+
+
+def photo(message_id: int, album: str | None = None) -> Message:
+    return Message.model_validate({
+        "message_id": message_id, "date": 0, "chat": {"id": CLIENT, "type": "private"},
+        "from": {"id": CLIENT, "is_bot": False, "first_name": "Клиент"},
+        "photo": [{"file_id": f"F{message_id}", "file_unique_id": f"U{message_id}", "width": 1, "height": 1}],
+        "media_group_id": album,
+    })
+
+
+def throttle(monkeypatch, events, data: dict | None = None) -> tuple[list, list]:
+    """Пропускает события через middleware (всплеск — 5); возвращает пропущенные и поставленные в outbox"""
+    monkeypatch.setattr(main, "outbox", main.SendQueue())
+    middleware = main.ThrottlingMiddleware(rate=0.01, burst=5, cooldowns={})
+    passed = []
+
+    async def handler(event, data):
+        passed.append(event)
+
+    async def run():
+        for event in events:
+            await middleware(handler, event, dict(data or {}))
+        return [item.method for item in main.outbox._queue._queue]
+
+    return passed, asyncio.run(run())
+
+
+def test_album_takes_one_token(monkeypatch):
+    album = [photo(i, "A1") for i in range(10)]
+    passed, sent = throttle(monkeypatch, album + [photo(20 + i) for i in range(5)])
+    assert len(passed) == 14  # Альбом целиком и ещё 4 одиночных фото
+    assert [method.text for method in sent] == ["⏳ Слишком много сообщений. Подождите немного."]
+
+
+def test_throttled_album_is_dropped_whole(monkeypatch):
+    passed, _ = throttle(monkeypatch, [photo(i) for i in range(5)] + [photo(10 + i, "A2") for i in range(3)])
+    assert len(passed) == 5
+
+
+def test_throttled_callback_is_acked_through_outbox(monkeypatch):
+    callbacks = [CallbackQuery.model_validate({
+        "id": str(i), "chat_instance": "c", "data": "x",
+        "from": {"id": CLIENT, "is_bot": False, "first_name": "Клиент"},
+    }) for i in range(7)]
+    passed, sent = throttle(monkeypatch, callbacks)
+    assert len(passed) == 5
+    assert [type(method).__name__ for method in sent] == ["AnswerCallbackQuery"] * 2
+    assert sent[0].text == "⏳ Слишком много сообщений. Подождите немного."
+
+
+def test_dialog_messages_are_not_dropped(monkeypatch):
+    passed, sent = throttle(monkeypatch, [photo(i) for i in range(20)], {"raw_state": main.DialogState.in_dialog.state})
+    assert len(passed) == 20
+    assert sent == []
+
+
+def test_throttling_runs_before_dialog_lookup():
+    middlewares = [type(m).__name__ for m in main.router.message.outer_middleware]
+    assert middlewares.index("ThrottlingMiddleware") < middlewares.index("RoutingMiddleware")
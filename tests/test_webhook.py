@@ -0,0 +1,38 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import Bot
+
+import main
+from fake_telegram import FakeTelegram, update_json
+
+
+def test_webhook_dispatches_updates_and_checks_secret(monkeypatch, dp):
+    monkeypatch.setattr(main, "WEBHOOK_SECRET", "s3cret")
+    monkeypatch.setattr(main, "outbox", main.SendQueue())
+    telegram = FakeTelegram()
+
+    async def run():
+        async with TestServer(telegram.app) as api_server:
+            bot = Bot(main.BOT_TOKEN, session=main.CachedMarkupSession(api=telegram.api(str(api_server.make_url("")))))
+            server = main.WebhookServer(dp, bot)
+            server.start_workers()
+            main.outbox.start(bot)
+            async with TestClient(TestServer(server.build_app())) as client:
+                update = update_json(1, 5, "/start")
+                denied = await client.post(main.WEBHOOK_PATH, json=update)
+                wrong = await client.post(main.WEBHOOK_PATH, json=update,
+                                          headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+                accepted = await client.post(main.WEBHOOK_PATH, json=update,
+                                             headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+                assert (denied.status, wrong.status, accepted.status) == (401, 401, 200)
+
+                await server.drain()
+                await main.outbox.close(5)
+            await bot.session.close()
+
+    asyncio.run(run())
+    assert telegram.methods() == ["sendMessage"]
+    method, fields = telegram.calls[0]
+    assert fields["chat_id"] == "5"
+    assert "reply_markup" in fields